@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import json
+import os
+import tempfile
+import unittest
+
+from unifree import QueryHistoryItem, QueryContext, query_context
+from unifree.llms import BatchJobLLM, DeferredResponseError, TrivialLLM
+from unifree.llms.batch_job_llm import answer_requests
+from unifree.utils import to_default_dict, migration_scope
+
+
+class TestBatchJobLLM(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.requests_file = os.path.join(self.temp_dir.name, "requests.jsonl")
+        self.responses_file = os.path.join(self.temp_dir.name, "responses.jsonl")
+
+    def test_export_answer_and_import(self):
+        export_llm = self._create_llm()
+        history = [QueryHistoryItem("user", "example"), QueryHistoryItem("assistant", "translated example")]
+
+        for user in ["first", "second", "first"]:
+            with query_context(QueryContext(chunk_kind="full", source_file_path="Assets/Player.cs")):
+                with self.assertRaises(DeferredResponseError):
+                    export_llm.query(user, "system", history)
+
+        with open(self.requests_file) as file:
+            requests = [json.loads(line) for line in file]
+
+        self.assertEqual(2, len(requests))  # Identical request is exported once
+        self.assertEqual("/v1/chat/completions", requests[0]["url"])
+        self.assertEqual("test-model", requests[0]["body"]["model"])
+        self.assertEqual(["system", "user", "assistant", "user"], [message["role"] for message in requests[0]["body"]["messages"]])
+        self.assertTrue(requests[0]["custom_id"].startswith("Assets/Player.cs:full:"))
+
+        trivial_llm = TrivialLLM({})
+        self.assertEqual(2, answer_requests(self.requests_file, self.responses_file, lambda messages: trivial_llm.query(messages[-1]["content"])))
+
+        import_llm = self._create_llm(self.responses_file)
+        fragments = []
+        with query_context(QueryContext(chunk_kind="full", source_file_path="Assets/Player.cs")):
+            self.assertEqual("second", import_llm.query_streaming("second", "system", history, fragments.append))
+
+        self.assertEqual(["second"], fragments)
+
+    def test_missing_and_failed_responses(self):
+        with open(self.responses_file, 'w') as file:
+            file.write(json.dumps({"custom_id": "failed", "response": None, "error": {"message": "Rate limit"}}) + "\n")
+
+        llm = self._create_llm(self.responses_file)
+        self.assertEqual({}, llm._responses)
+
+        for _ in range(2):
+            with self.assertRaises(DeferredResponseError):
+                llm.query("not exported")
+
+        with open(os.path.join(self.temp_dir.name, "requests.followup.jsonl")) as file:
+            requests = [json.loads(line) for line in file]
+
+        self.assertEqual(1, len(requests))
+        self.assertEqual("not exported", requests[0]["body"]["messages"][-1]["content"])
+
+    def test_each_migration_starts_requests_over(self):
+        for user in ["first", "second"]:
+            with migration_scope():
+                with self.assertRaises(DeferredResponseError):
+                    self._create_llm().query(user)
+                with self.assertRaises(DeferredResponseError):
+                    self._create_llm().query(user)
+
+        with open(self.requests_file) as file:
+            requests = [json.loads(line) for line in file]
+
+        self.assertEqual(["second"], [request["body"]["messages"][-1]["content"] for request in requests])
+
+    def _create_llm(self, responses_file: str = None) -> BatchJobLLM:
+        llm = BatchJobLLM(to_default_dict({
+            "batch_job_config": {"requests_file": self.requests_file, "responses_file": responses_file},
+            "llm_config": {"class": "TrivialLLM", "config": {"model": "test-model"}},
+        }))
+        llm.initialize()
+
+        return llm
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import unittest
+from typing import List
+
+from unifree.llms import ChatGptLLM
+
+
+class WhitespaceEncoding:
+    encoded_texts: List[str]
+
+    def __init__(self) -> None:
+        self.encoded_texts = []
+
+    def encode_ordinary_batch(self, texts: List[str]) -> List[List[str]]:
+        self.encoded_texts.extend(texts)
+        return [text.split() for text in texts]
+
+
+class ChatGptLLMProxy(ChatGptLLM):
+    test_encoding: WhitespaceEncoding
+
+    @property
+    def encoding(self) -> WhitespaceEncoding:
+        return self.test_encoding
+
+
+class TestChatGptLLM(unittest.TestCase):
+    def test_count_tokens_is_memoized(self):
+        llm = self._create_llm("memoized-model")
+
+        self.assertEqual(3, llm.count_tokens("one two three"))
+        self.assertEqual(3, llm.count_tokens("one two three"))
+        self.assertEqual(["one two three"], llm.test_encoding.encoded_texts)
+
+    def test_count_tokens_batch(self):
+        llm = self._create_llm("batch-model")
+        llm.count_tokens("a b")
+
+        self.assertEqual([2, 1, 3, 1, 0], llm.count_tokens_batch(["a b", "c", "d e f", "c", ""]))
+        self.assertEqual(["a b", "c", "d e f", ""], llm.test_encoding.encoded_texts)
+
+    def test_count_tokens_memo_is_per_model(self):
+        first_llm = self._create_llm("first-model")
+        second_llm = self._create_llm("second-model")
+
+        first_llm.count_tokens("a b")
+        second_llm.count_tokens("a b")
+
+        self.assertEqual(["a b"], second_llm.test_encoding.encoded_texts)
+
+    @staticmethod
+    def _create_llm(model: str) -> ChatGptLLMProxy:
+        llm = ChatGptLLMProxy({
+            "class": "ChatGptLLM",
+            "config": {
+                "model": model,
+                "max_tokens": 100,
+            }
+        })
+        llm.test_encoding = WhitespaceEncoding()
+
+        return llm
+
+
+if __name__ == '__main__':
+    unittest.main()
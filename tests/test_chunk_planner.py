@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import unittest
+from typing import Optional, List
+
+from unifree import LLM, QueryHistoryItem
+from unifree.chunk_planner import ChunkPlanner
+
+
+class CharacterCountingLLM(LLM):
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        return user
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        return token_count <= 100
+
+    def count_tokens(self, source_text: str) -> int:
+        return len(source_text)
+
+    def initialize(self) -> None:
+        pass
+
+
+class TestChunkPlanner(unittest.TestCase):
+    def test_fits_accounts_for_overhead(self):
+        planner = ChunkPlanner(CharacterCountingLLM({}), overhead_token_count=40)
+
+        self.assertTrue(planner.fits(60))
+        self.assertFalse(planner.fits(61))
+        self.assertTrue(planner.fits_text("a" * 60))
+
+    def test_pack_consecutive_items(self):
+        planner = ChunkPlanner(CharacterCountingLLM({}), overhead_token_count=0, separator="|")
+        items = ["a" * 60, "b" * 50, "c" * 38, "d" * 48, "e" * 10]
+
+        batches = planner.pack(items)
+
+        # Batches only take consecutive items, so methods are not reordered when the class is put back together
+        self.assertEqual(["a" * 60, "b" * 50 + "|" + "c" * 38, "d" * 48 + "|" + "e" * 10], batches)
+        for batch in batches:
+            self.assertTrue(planner.fits_text(batch), batch)
+
+    def test_pack_preserves_source_order(self):
+        planner = ChunkPlanner(CharacterCountingLLM({}), overhead_token_count=50, separator="|")
+        items = [f"{ix}" * (ix * 5) for ix in range(1, 10)]
+
+        batches = planner.pack(items)
+
+        packed_items = [item for batch in batches for item in batch.split("|")]
+        self.assertEqual(sorted(items), sorted(packed_items))
+        for batch in batches:
+            self.assertTrue(planner.fits_text(batch), batch)
+
+        self.assertEqual(items, packed_items)
+
+    def test_pack_oversized_item(self):
+        planner = ChunkPlanner(CharacterCountingLLM({}), overhead_token_count=10, separator="|")
+        items = ["a" * 200, "b" * 20, "c" * 20]
+
+        self.assertEqual(["a" * 200, "b" * 20 + "|" + "c" * 20], planner.pack(items))
+
+    def test_pack_empty(self):
+        planner = ChunkPlanner(CharacterCountingLLM({}), overhead_token_count=10)
+        self.assertEqual([], planner.pack([]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List
+
+from unifree import LLM, QueryHistoryItem, utils
+from unifree.llms import CoalescingLLM, MultiprocessLocalLLM
+
+
+class SlowLLM(LLM):
+    query_count: int
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        super().__init__({})
+
+        self.query_count = 0
+        self._lock = threading.Lock()
+
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        with self._lock:
+            self.query_count += 1
+
+        time.sleep(0.2)
+
+        if user == "FAIL":
+            raise RuntimeError("Query failed")
+
+        return f"RESPONSE {user}"
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        return True
+
+    def count_tokens(self, source_text: str) -> int:
+        return len(source_text)
+
+    def initialize(self) -> None:
+        pass
+
+
+class TestCoalescingLLM(unittest.TestCase):
+    def test_identical_queries_are_coalesced(self):
+        wrapped_llm = SlowLLM()
+        coalesced_count = utils.get_statistics().get("Coalesced LLM queries", 0)
+
+        def query(ix: int) -> str:
+            return self._create_llm(wrapped_llm).query("same query", "system", [QueryHistoryItem(role="user", content="history")])
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(query, range(8)))
+
+        self.assertEqual(["RESPONSE same query"] * 8, responses)
+        self.assertEqual(1, wrapped_llm.query_count)
+        self.assertEqual(coalesced_count + 7, utils.get_statistics()["Coalesced LLM queries"])
+
+        # Once the query is complete, the same query is issued again
+        self.assertEqual("RESPONSE same query", query(0))
+        self.assertEqual(2, wrapped_llm.query_count)
+
+    def test_different_queries_are_not_coalesced(self):
+        wrapped_llm = SlowLLM()
+
+        def query(ix: int) -> str:
+            history = [QueryHistoryItem(role="user", content=f"history {ix % 2}")]
+            return self._create_llm(wrapped_llm).query(f"query {ix // 2}", "system", history)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(query, range(8)))
+
+        self.assertEqual([f"RESPONSE query {ix // 2}" for ix in range(8)], responses)
+        self.assertEqual(8, wrapped_llm.query_count)
+
+    def test_failures_are_shared(self):
+        wrapped_llm = SlowLLM()
+
+        def query(ix: int) -> str:
+            try:
+                return self._create_llm(wrapped_llm).query("FAIL")
+            except RuntimeError as e:
+                return str(e)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(query, range(4)))
+
+        self.assertEqual(["Query failed"] * 4, responses)
+        self.assertEqual(1, wrapped_llm.query_count)
+
+    def test_wraps_multiprocess_local_llm(self):
+        self.addCleanup(MultiprocessLocalLLM.shutdown_shared_executor)
+
+        llm = CoalescingLLM({
+            "class": "CoalescingLLM",
+            "llm_config": {
+                "class": "MultiprocessLocalLLM",
+                "llm_config": {
+                    "class": "TrivialLLM",
+                    "config": {},
+                },
+                "wrapper_config": {
+                    "num_workers": 2,
+                    "query_timeout_sec": 10,
+                }
+            }
+        })
+        llm.initialize()
+
+        self.assertEqual("query", llm.query("query"))
+        self.assertEqual(9, llm.count_tokens("some text"))
+        self.assertTrue(llm.fits_in_one_prompt(123))
+
+    def test_initialize_tokenizer_only(self):
+        llm = CoalescingLLM({
+            "class": "CoalescingLLM",
+            "llm_config": {
+                "class": "TrivialLLM",
+                "config": {"weights_mb": 16},
+            }
+        })
+        llm.initialize_tokenizer()
+
+        self.assertIsNone(llm._wrapped_llm.weights)
+        self.assertEqual(9, llm.count_tokens("some text"))
+
+    @staticmethod
+    def _create_llm(wrapped_llm: LLM) -> CoalescingLLM:
+        llm = CoalescingLLM({
+            "class": "CoalescingLLM",
+            "llm_config": {
+                "class": "SlowLLM",
+            }
+        })
+        llm._wrapped_llm = wrapped_llm
+
+        return llm
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,9 +2,13 @@
 # Copyright (c) Unifree
 # This code is licensed under MIT license (see LICENSE.txt for details)
 
+import random
+import time
 import unittest
+from typing import Tuple
 
-from unifree.llms.code_extrators import extract_first_source_code, extract_header_implementation
+from unifree.llms.code_extrators import extract_first_source_code, extract_header_implementation, extract_delimited_files, FirstSourceCodeExtractor, \
+    HeaderImplementationExtractor
 
 
 class TestCodeExtractors(unittest.TestCase):
@@ -55,6 +59,34 @@ Some ending comment
             extracted_code = extract_first_source_code(response)
             self.assertEqual(target_code, extracted_code)
 
+    def test_first_source_code_extractor(self):
+        responses = [
+            "Some beginning comment\n```cpp\nsome code here!\n```\nSome ending comment",
+            "```\nsome code here!\n```",
+            "```\nfirst\n```\n```\nsecond\n```",
+            "no code at all",
+            "```\nunterminated code",
+            "```no new line",
+            "``\n`` ``\n```\ncode\n``` ``",
+        ]
+
+        for response in responses:
+            for fragment_size in [1, 2, 3, 7, len(response)]:
+                extractor = FirstSourceCodeExtractor()
+                consumed_length = 0
+                for ix in range(0, len(response), fragment_size):
+                    consumed_length = ix + fragment_size
+                    if extractor.feed(response[ix:consumed_length]):
+                        break
+
+                self.assertEqual(extract_first_source_code(response), extractor.result(), f"Response: {response}, fragment size: {fragment_size}")
+                if extractor.is_complete:
+                    # Nothing after the fragment with the closing delimiter was consumed
+                    self.assertLessEqual(consumed_length, response.index("```", response.index("\n", response.index("```"))) + 3 + fragment_size)
+
+        self.assertFalse(FirstSourceCodeExtractor().feed("```\ncode"))
+        self.assertTrue(FirstSourceCodeExtractor().feed("```\ncode\n```"))
+
     def test_extract_header_implementation(self):
         target_header = "header here!"
         target_implementation = "implementation here!"
@@ -105,6 +137,270 @@ Some ending comment
             self.assertEqual(target_header, extracted_header, f"Response: {response}")
             self.assertEqual(target_implementation, extracted_implementation, f"Response: {response}")
 
+    def test_extract_delimited_files(self):
+        file_names = ["Assets/Player.cs", "Assets/Enemy.cs"]
+        responses = [
+            """
+### FILE: Assets/Player.cs
+```gdscript
+player code
+```
+### FILE: Assets/Enemy.cs
+```gdscript
+enemy code
+```
+""",
+            """
+Here are the migrated files:
+
+### FILE: Assets/Player.cs
+```
+player code
+```
+Some explanation
+
+### FILE: `Assets/Enemy.cs`
+```
+enemy code
+```
+""",
+        ]
+
+        for response in responses:
+            extracted_files = extract_delimited_files(response, file_names)
+            self.assertEqual({"Assets/Player.cs": "player code", "Assets/Enemy.cs": "enemy code"}, extracted_files, f"Response: {response}")
+
+    def test_extract_delimited_files_markers_in_code(self):
+        response = """
+### FILE: Assets/Player.cs
+```
+// FILE: Assets/Enemy.cs is loaded later
+### FILE: Assets/Enemy.cs
+player code
+```
+### FILE: Assets/Enemy.cs
+```
+enemy code
+```
+"""
+
+        self.assertEqual({
+            "Assets/Player.cs": "// FILE: Assets/Enemy.cs is loaded later\n### FILE: Assets/Enemy.cs\nplayer code",
+            "Assets/Enemy.cs": "enemy code",
+        }, extract_delimited_files(response, ["Assets/Player.cs", "Assets/Enemy.cs"]))
+
+    def test_extract_delimited_files_ambiguous(self):
+        file_names = ["Assets/Player.cs", "Assets/Enemy.cs"]
+        responses = [
+            # Missing file
+            """
+### FILE: Assets/Player.cs
+```
+player code
+```
+""",
+            # Duplicate file
+            """
+### FILE: Assets/Player.cs
+```
+player code
+```
+### FILE: Assets/Player.cs
+```
+player code
+```
+### FILE: Assets/Enemy.cs
+```
+enemy code
+```
+""",
+            # Unknown file
+            """
+### FILE: Assets/Player.cs
+```
+player code
+```
+### FILE: Assets/Enemy.cs
+```
+enemy code
+```
+### FILE: Assets/Boss.cs
+```
+boss code
+```
+""",
+            # Empty file
+            """
+### FILE: Assets/Player.cs
+### FILE: Assets/Enemy.cs
+```
+enemy code
+```
+""",
+            # No delimiters at all
+            """
+```
+player code
+enemy code
+```
+""",
+        ]
+
+        for response in responses:
+            self.assertIsNone(extract_delimited_files(response, file_names), f"Response: {response}")
+
+
+class TestCodeExtractorsEquivalence(unittest.TestCase):
+    """
+    Fuzz and benchmark state machine extractors against the original single-pass implementations
+    """
+
+    _LINES = ["```", "```cpp", "  ```h", "`` not a delimiter", "// Player.h", "// Player.cpp", "  // Player.cpp:", "// comment",
+              "code();", "    indented code;", "", " ", "Some explanation", "int a = b ? c : d;"]
+    _LINE_ENDINGS = ["\n", "\n", "\n", "\r\n", "\r", ""]
+
+    def test_fuzz_first_source_code(self):
+        rng = random.Random(1)
+
+        for _ in range(2_000):
+            response = self._random_response(rng)
+            expected = _reference_extract_first_source_code(response)
+
+            self.assertEqual(expected, extract_first_source_code(response), f"Response: {response!r}")
+
+            extractor = FirstSourceCodeExtractor()
+            for fragment in self._random_fragments(rng, response):
+                extractor.feed(fragment)
+            self.assertEqual(expected, extractor.result(), f"Response: {response!r}")
+
+    def test_fuzz_header_implementation(self):
+        rng = random.Random(2)
+
+        for _ in range(2_000):
+            response = self._random_response(rng)
+            expected = _reference_extract_header_implementation(response)
+
+            self.assertEqual(expected, extract_header_implementation(response), f"Response: {response!r}")
+
+            extractor = HeaderImplementationExtractor()
+            for fragment in self._random_fragments(rng, response):
+                extractor.feed(fragment)
+            self.assertEqual(expected, extractor.result(), f"Response: {response!r}")
+
+    def test_header_implementation_completion(self):
+        response = "Player.h:\n```cpp\nheader\n```\nPlayer.cpp:\n```cpp\nimplementation\n```\nExplanation\n"
+
+        extractor = HeaderImplementationExtractor()
+        completion_states = []
+        for line in response.splitlines(keepends=True):
+            extractor.feed(line)
+            completion_states.append((extractor.is_header_done, extractor.is_implementation_done))
+
+        self.assertEqual([(False, False), (False, False), (False, False), (True, False), (True, False), (True, False), (True, False), (True, True), (True, True)],
+                         completion_states)
+        self.assertEqual(("header", "implementation"), extractor.result())
+
+        extractor = HeaderImplementationExtractor()
+        extractor.feed("// Player.h\nheader\n// Player.cpp\nimplementation\n")
+        self.assertTrue(extractor.is_header_done)
+        self.assertFalse(extractor.is_complete)
+
+    def test_benchmark(self):
+        rng = random.Random(3)
+        responses = [self._random_response(rng, max_line_count=2_000) for _ in range(20)]
+
+        for reference_fn, fn in [(_reference_extract_first_source_code, extract_first_source_code),
+                                 (_reference_extract_header_implementation, extract_header_implementation)]:
+            reference_duration = self._measure(reference_fn, responses)
+            duration = self._measure(fn, responses)
+
+            self.assertLess(duration, reference_duration * 5 + 0.1, f"{fn.__name__}: {duration:.3f}s vs {reference_duration:.3f}s")
+
+    @staticmethod
+    def _measure(fn, responses) -> float:
+        start_time = time.perf_counter()
+        for response in responses:
+            fn(response)
+
+        return time.perf_counter() - start_time
+
+    def _random_response(self, rng: random.Random, max_line_count: int = 12) -> str:
+        line_count = rng.randint(0, max_line_count)
+        return "".join(rng.choice(self._LINES) + rng.choice(self._LINE_ENDINGS) for _ in range(line_count))
+
+    @staticmethod
+    def _random_fragments(rng: random.Random, response: str):
+        ix = 0
+        while ix < len(response):
+            fragment_size = rng.randint(1, 8)
+            yield response[ix:ix + fragment_size]
+            ix += fragment_size
+
+
+def _reference_extract_first_source_code(response: str, code_delimiter: str = "```") -> str:
+    result = ''
+
+    starting_ix = response.find(code_delimiter)
+    if starting_ix >= 0:
+        starting_ix = response.find("\n", starting_ix)  # Move to the new line
+        ending_ix = response.find(code_delimiter, starting_ix)
+        if ending_ix > 0 and starting_ix > 0:
+            result = response[starting_ix:ending_ix]
+
+    if len(result) == 0:
+        result = response
+
+    return result.rstrip().lstrip()
+
+
+def _reference_extract_header_implementation(response: str, header_ext: str = '.h', implementation_ext='.cpp', code_delimiter: str = "```") -> Tuple[str, str]:
+    header = ''
+    is_in_header = False
+
+    implementation = ''
+    is_in_implementation = False
+
+    is_comment_based_delimiter = False
+
+    for line in response.splitlines():
+        if line.lstrip().startswith(code_delimiter):
+            if is_comment_based_delimiter:
+                continue
+
+            is_opening_delimiter = not is_in_header and not is_in_implementation
+            if is_opening_delimiter:
+                is_header_present = len(header) > 0
+                if is_header_present:
+                    is_in_implementation = True
+                    is_in_header = False
+                else:
+                    is_in_header = True
+                    is_in_implementation = False
+            else:  # Closing delimiter
+                if is_in_header:
+                    is_in_header = False
+                if is_in_implementation:
+                    is_in_implementation = False
+        elif line.lstrip().startswith("//") and line.rstrip().endswith(header_ext):
+            is_in_header = True
+            is_in_implementation = False
+            is_comment_based_delimiter = True
+        elif line.lstrip().startswith("//") and line.rstrip().endswith(implementation_ext):
+            is_in_header = False
+            is_in_implementation = True
+            is_comment_based_delimiter = True
+        else:
+            if is_in_header:
+                header += line + "\n"
+            elif is_in_implementation:
+                implementation += line + "\n"
+
+    if len(header) < 1 and len(implementation) < 1:
+        header = response
+        implementation = "SEE HEADER FOR FULL RESPONSE"
+
+    return header.rstrip().lstrip(), implementation.rstrip().lstrip()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,12 +3,15 @@
 # This code is licensed under MIT license (see LICENSE.txt for details)
 import os
 import re
+import threading
+import time
 import unittest
 from typing import Dict, TypeVar, Optional, List, Any
 
 import unifree
 from unifree import LLM, QueryHistoryItem
-from unifree.csharp_migration_strategies import CSharpCompilationUnitMigrationStrategy, CSharpCompilationUnitMigrationWithLLM, CSharpCompilationUnitToSingleFileWithLLM
+from unifree.csharp_migration_strategies import CSharpCompilationUnitMigrationStrategy, CSharpCompilationUnitMigrationWithLLM, CSharpCompilationUnitToSingleFileWithLLM, \
+    CSharpCompilationUnitsBatchToSingleFilesWithLLM
 from unifree.llms import TrivialLLM
 from unifree.utils import to_default_dict
 
@@ -110,6 +113,15 @@ class TestCSharpCompilationUnitMigrationStrategy(unittest.TestCase):
             norm_method_definition = _normalize_definition(method_definition)
             self.assertTrue(norm_method_definition in norm_reference_methods, f"Missing {method_definition}")
 
+    def test_chunk_complexity(self):
+        strategy = CSharpCompilationUnitMigrationStrategyProxy(_load_file_migration_spec('ShortClassWithNamespace.cs'), self.config)
+        methods = strategy.method_declarations
+
+        self.assertEqual(2, strategy.chunk_complexity(strategy.source_text, 'full'))
+        self.assertEqual(0, strategy.chunk_complexity(strategy.everything_except_method_declarations, 'class_only'))
+        self.assertEqual(1, strategy.chunk_complexity("\n\n".join(methods[:-1]), 'methods_only'))
+        self.assertEqual(0, strategy.chunk_complexity(methods[0], 'methods_only'))
+
     def test_method_definitions_from_malformed(self):
         reference_methods = [
             """
@@ -272,7 +284,7 @@ class TestCSharpCompilationUnitToSingleFileWithLLM(unittest.TestCase):
     def test_execute_large_file(self):
         expected_class = "TRANSLATED class_only 1"
 
-        for ix in range(2, 45):
+        for ix in range(2, 46):
             expected_class += f"\nTRANSLATED methods_only {ix}\n"
 
         strategy = CSharpCompilationUnitToSingleFileWithLLMProxy(_load_file_migration_spec('LongClassWithNamespace.cs'), self.config)
@@ -281,11 +293,180 @@ class TestCSharpCompilationUnitToSingleFileWithLLM(unittest.TestCase):
         self.assertEqual(_normalize_definition(expected_class), _normalize_definition(strategy.saved_content))
         self.assertEqual("na/resources/LongClassWithNamespace.gd", strategy.saved_path)
 
+    def test_known_translation_queries(self):
+        strategy = CSharpCompilationUnitToSingleFileWithLLMProxy(_load_file_migration_spec('LongClassWithNamespace.cs'), self.config)
+
+        self.assertEqual([strategy.source_text], strategy.known_translation_queries(False))
+
+        queries = strategy.known_translation_queries(True)
+        chunks = strategy.plan_chunks(self.config['prompts']['system'])
+        self.assertEqual([strategy.source_text] + [code for code, _ in chunks], queries)
+        self.assertEqual(['class_only'] + ['methods_only'] * 44, [prompt_type for _, prompt_type in chunks])
+        self.assertIs(chunks, strategy.plan_chunks(self.config['prompts']['system']))  # Planned once
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        _setup_test_config(cls)
+
+
+class CSharpCompilationUnitToSingleFileWithConcurrentLLMProxy(CSharpCompilationUnitToSingleFileWithLLMProxy):
+    in_flight_count: int = 0
+    max_in_flight_count: int = 0
+
+    def load_llm(self) -> LLM:
+        class LocalLLM(LLM):
+            _parent: Any
+            _lock: threading.Lock = threading.Lock()
+
+            def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+                with self._lock:
+                    self._parent.in_flight_count += 1
+                    self._parent.max_in_flight_count = max(self._parent.max_in_flight_count, self._parent.in_flight_count)
+
+                time.sleep(0.01)
+
+                with self._lock:
+                    self._parent.in_flight_count -= 1
+
+                return f"TRANSLATED {user} {hash(user)}"
+
+            def fits_in_one_prompt(self, token_count: int) -> bool:
+                return token_count < 1_000
+
+            def count_tokens(self, source_text: str) -> int:
+                return len(source_text)
+
+            def initialize(self) -> None:
+                pass
+
+        local_llm = LocalLLM(self.config)
+        local_llm._parent = self
+
+        return local_llm
+
+
+class TestCSharpCompilationUnitToSingleFileWithConcurrentLLM(unittest.TestCase):
+    config: Dict
+
+    def test_execute_large_file_concurrently(self):
+        sequential_strategy = CSharpCompilationUnitToSingleFileWithConcurrentLLMProxy(_load_file_migration_spec('LongClassWithNamespace.cs'), self.config)
+        sequential_strategy.execute()
+        self.assertEqual(1, sequential_strategy.max_in_flight_count)
+
+        concurrent_config = to_default_dict(dict(self.config))
+        concurrent_config["concurrency"] = {
+            "chunk_translation_workers": 8,
+            "chunk_translation_workers_per_file": 3,
+        }
+
+        concurrent_strategy = CSharpCompilationUnitToSingleFileWithConcurrentLLMProxy(_load_file_migration_spec('LongClassWithNamespace.cs'), concurrent_config)
+        concurrent_strategy.execute()
+
+        self.assertEqual(sequential_strategy.saved_content, concurrent_strategy.saved_content)
+        self.assertLessEqual(concurrent_strategy.max_in_flight_count, 3)
+        self.assertGreater(concurrent_strategy.max_in_flight_count, 1)
+
     @classmethod
     def setUpClass(cls) -> None:
         _setup_test_config(cls)
 
 
+class CSharpCompilationUnitToSingleFileWithBatchingLLMProxy(CSharpCompilationUnitToSingleFileWithLLMProxy):
+    is_response_malformed: bool = False
+    query_count: int = 0
+
+    def load_llm(self) -> LLM:
+        class LocalLLM(LLM):
+            _parent: Any
+
+            def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+                self._parent.query_count += 1
+
+                file_names = re.findall(r'### FILE: (.+)', user)
+                if len(file_names) == 0:
+                    return f"```\nTRANSLATED SINGLE FILE\n```"
+                elif self._parent.is_response_malformed:
+                    return f"```\nTRANSLATED {len(file_names)} FILES\n```"
+                else:
+                    return "\n".join(f"### FILE: {file_name}\n```\nTRANSLATED {file_name}\n```" for file_name in file_names)
+
+            def fits_in_one_prompt(self, token_count: int) -> bool:
+                return token_count < 5_000
+
+            def count_tokens(self, source_text: str) -> int:
+                return len(source_text)
+
+            def initialize(self) -> None:
+                pass
+
+        local_llm = LocalLLM(self.config)
+        local_llm._parent = self
+
+        return local_llm
+
+
+class TestCSharpCompilationUnitsBatchToSingleFilesWithLLM(unittest.TestCase):
+    config: Dict
+
+    def test_create_batches(self):
+        strategies = self._create_strategies()
+
+        batched_strategies = CSharpCompilationUnitsBatchToSingleFilesWithLLM.create_batches(strategies, self.config)
+
+        self.assertEqual(3, len(batched_strategies))
+        self.assertIs(strategies[2], batched_strategies[0])  # Too large to be batched
+        self.assertIsInstance(batched_strategies[1], CSharpCompilationUnitsBatchToSingleFilesWithLLM)
+        self.assertEqual(strategies[:2], batched_strategies[1].strategies)
+        self.assertIs(strategies[3], batched_strategies[2])  # Batch of one is not batched
+
+    def test_create_batches_disabled(self):
+        strategies = self._create_strategies()
+
+        config = to_default_dict(dict(self.config))
+        config["batching"] = None
+
+        self.assertEqual(strategies, CSharpCompilationUnitsBatchToSingleFilesWithLLM.create_batches(strategies, config))
+
+    def test_execute(self):
+        strategies = self._create_strategies()
+        batch = CSharpCompilationUnitsBatchToSingleFilesWithLLM(strategies[:2], self.config)
+        batch.execute()
+
+        self.assertEqual(1, strategies[0].query_count + strategies[1].query_count)
+        self.assertEqual("TRANSLATED resources/ShortClassNoNamespace.cs", strategies[0].saved_content)
+        self.assertEqual("na/resources/ShortClassNoNamespace.gd", strategies[0].saved_path)
+        self.assertEqual("TRANSLATED resources/MalformedShortClass.cs", strategies[1].saved_content)
+        self.assertEqual("na/resources/MalformedShortClass.gd", strategies[1].saved_path)
+
+    def test_execute_falls_back_to_single_files(self):
+        strategies = self._create_strategies()
+        for strategy in strategies:
+            strategy.is_response_malformed = True
+
+        batch = CSharpCompilationUnitsBatchToSingleFilesWithLLM(strategies[:2], self.config)
+        batch.execute()
+
+        self.assertEqual(3, strategies[0].query_count + strategies[1].query_count)
+        self.assertEqual("TRANSLATED SINGLE FILE", strategies[0].saved_content)
+        self.assertEqual("TRANSLATED SINGLE FILE", strategies[1].saved_content)
+
+    def _create_strategies(self) -> List[CSharpCompilationUnitToSingleFileWithBatchingLLMProxy]:
+        return [
+            CSharpCompilationUnitToSingleFileWithBatchingLLMProxy(_load_file_migration_spec(source_file_name), self.config)
+            for source_file_name in ['ShortClassNoNamespace.cs', 'MalformedShortClass.cs', 'LongClassWithNamespace.cs', 'ShortClassWithNamespace.cs']
+        ]
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        _setup_test_config(cls)
+
+        cls.config["prompts"]["batch"] = "batch ${CODE}"
+        cls.config["batching"] = {
+            "max_files_per_request": 2,
+            "max_file_tokens": 2_000,
+        }
+
+
 def _load_file_migration_spec(source_file_name: str) -> unifree.FileMigrationSpec:
     dir_path = os.path.dirname(os.path.abspath(__file__))
     file_path = os.path.join(dir_path, 'resources', source_file_name)
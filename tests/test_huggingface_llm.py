@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import threading
+import unittest
+from typing import List, Iterator, Dict, Any, Optional, Callable
+
+from unifree import QueryHistoryItem
+from unifree.llms import HuggingfaceLLM
+from unifree.llms.generation_batcher import GenerationBatcher
+from unifree.llms.code_extrators import FirstSourceCodeExtractor
+
+
+class StreamingModel:
+    fragments: List[str]
+    generated_count: int
+    generation_parameters: Dict[str, Any]
+
+    def __init__(self, fragments: List[str]) -> None:
+        self.fragments = fragments
+        self.generated_count = 0
+        self.generation_parameters = {}
+
+    def __call__(self, prompt: str, stream: bool = False, **kwargs) -> Iterator[str]:
+        self.generation_parameters = kwargs
+
+        for fragment in self.fragments:
+            self.generated_count += 1
+            yield fragment
+
+    def tokenize(self, text: str) -> List[str]:
+        return text.split()
+
+
+class BatchingModel:
+    batch_sizes: List[int]
+    generation_parameters: Dict[str, Any]
+
+    def __init__(self) -> None:
+        self.batch_sizes = []
+        self.generation_parameters = {}
+
+    def generate_batch(self, prompts: List[str], on_fragments: List[Optional[Callable[[str], bool]]], **kwargs) -> List[str]:
+        self.batch_sizes.append(len(prompts))
+        self.generation_parameters = kwargs
+
+        return [f"response to {prompt}" for prompt in prompts]
+
+    def tokenize(self, text: str) -> List[str]:
+        return text.split()
+
+
+class TestHuggingfaceLLM(unittest.TestCase):
+    def test_query(self):
+        llm, model = self._create_llm(["```\n", "code", "\n```", " explanation"])
+
+        self.assertEqual("```\ncode\n``` explanation", llm.query("user"))
+        self.assertEqual(4, model.generated_count)
+        self.assertEqual({"max_new_tokens": 100, "stop": ["[INST]"]}, model.generation_parameters)
+
+    def test_query_streaming_stops_early(self):
+        llm, model = self._create_llm(["```\n", "code", "\n```"] + [" explanation"] * 100)
+
+        extractor = FirstSourceCodeExtractor()
+        response = llm.query_streaming("user", "system", on_fragment=extractor.feed)
+
+        self.assertEqual("```\ncode\n```", response)
+        self.assertEqual(3, model.generated_count)
+
+    def test_concurrent_queries_are_batched(self):
+        llm, _ = self._create_llm([])
+        model = BatchingModel()
+        llm._model = model
+        llm._batcher = GenerationBatcher(llm._generate_batch, max_batch_size=4, max_wait_ms=500)
+
+        # Start all queries at once, so they land within one batching window
+        barrier = threading.Barrier(8)
+        responses = {}
+
+        def query(ix: int) -> None:
+            barrier.wait()
+            responses[ix] = llm.query(f"query {ix}")
+
+        threads = [threading.Thread(target=query, args=(ix,)) for ix in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for ix in range(8):
+            self.assertEqual(f"response to [INST]\nquery {ix}\n[/INST]", responses[ix])
+        self.assertEqual(8, sum(model.batch_sizes))
+        self.assertTrue(all(batch_size <= 4 for batch_size in model.batch_sizes))
+        self.assertLess(len(model.batch_sizes), 8)
+        self.assertEqual(100, model.generation_parameters["max_new_tokens"])
+        self.assertEqual(["[INST]"], model.generation_parameters["stop"])
+        self.assertTrue(all(prefix_length == 0 for prefix_length in model.generation_parameters["prefix_lengths"]))
+
+    def test_batching_without_batched_decoding(self):
+        llm, model = self._create_llm(["```\n", "code", "\n```", " explanation"])
+        llm._batcher = GenerationBatcher(llm._generate_batch, max_batch_size=4, max_wait_ms=1)
+
+        extractor = FirstSourceCodeExtractor()
+        self.assertEqual("```\ncode\n```", llm.query_streaming("user", on_fragment=extractor.feed))
+        self.assertEqual(3, model.generated_count)
+
+    def test_batcher_propagates_errors(self):
+        def failing_generate_batch(prompts, on_fragments):
+            raise RuntimeError("out of memory")
+
+        batcher = GenerationBatcher(failing_generate_batch)
+
+        with self.assertRaises(RuntimeError):
+            batcher.generate("prompt")
+
+    def test_prompt_prefix(self):
+        llm, _ = self._create_llm([])
+        llm.config["config"]["prefix_cache"] = {"max_memory_mb": 16}
+
+        first = llm.create_prompt("first", "system", self._history(["A", "B"]))
+        second = llm.create_prompt("second", "system", self._history(["C", "B", "A"]))
+
+        # Examples are kept in the order they were first seen, so both prompts share the prefix with 'A' and 'B'
+        self.assertTrue(second.text.startswith(first.text[:first.prefix_length]))
+        self.assertTrue(second.text[second.prefix_length:].startswith("[INST]\nsecond"))
+        self.assertLess(second.text.index("example C"), second.text.index("second"))
+        self.assertLess(second.text.index("example B"), second.text.index("example C"))
+
+    def test_sequential_batch_is_sorted(self):
+        llm, model = self._create_llm(["response"])
+
+        prompts = []
+        model_call = model.__call__
+
+        class RecordingModel:
+            def __call__(self, prompt, stream=False, **kwargs):
+                prompts.append(prompt)
+                return model_call(prompt, stream, **kwargs)
+
+        llm._model = RecordingModel()
+        responses = llm._generate_batch([llm.create_prompt(user) for user in ["b", "c", "a"]], [None] * 3)
+
+        self.assertEqual(["response"] * 3, responses)
+        self.assertEqual(sorted(prompts), prompts)
+
+    @staticmethod
+    def _history(examples: List[str]):
+        history = []
+        for example in examples:
+            history.append(QueryHistoryItem(role="user", content=f"example {example}"))
+            history.append(QueryHistoryItem(role="assistant", content="!OK!"))
+
+        return history
+
+    @staticmethod
+    def _create_llm(fragments: List[str]):
+        llm = HuggingfaceLLM({
+            "class": "HuggingfaceLLM",
+            "config": {
+                "checkpoint": "test",
+                "context_length": 100,
+                "prompt_template": "[INST]${PROMPT}[/INST]",
+                "max_response_tokens": 100,
+                "stop": ["[INST]"],
+            }
+        })
+
+        model = StreamingModel(fragments)
+        llm._model = model
+
+        return llm, model
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import re
+import subprocess
+import sys
+import unittest
+from typing import Dict
+
+import unifree
+
+_HEAVY_MODULES = ["torch", "transformers", "sentence_transformers", "chromadb", "openai", "tiktoken"]
+
+
+def _import_times(statement: str) -> Dict[str, int]:
+    """
+    :return: Cumulative import time (in microseconds) of every module imported by the statement, see `python -X importtime`
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=unifree.project_root, capture_output=True, text=True, check=True,
+    )
+
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            times[match.group(3)] = int(match.group(1))
+
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    def test_startup_does_not_import_heavy_modules(self):
+        times = _import_times("import unifree.free, unifree.project_migration_strategies, unifree.known_translations_db, unifree.llms")
+
+        for module in _HEAVY_MODULES:
+            self.assertNotIn(module, times, f"'{module}' is imported at startup")
+
+        startup_time = sum(times.get(module, 0) for module in ["unifree.free", "unifree.project_migration_strategies", "unifree.known_translations_db"])
+        self.assertLess(startup_time, 2_000_000)
+
+    def test_llms_are_imported_on_demand(self):
+        # Modules imported with importlib are not reported by -X importtime
+        result = subprocess.run(
+            [sys.executable, "-c", "import sys; from unifree.utils import load_class; load_class('TrivialLLM', 'llms'); print('\\n'.join(sys.modules))"],
+            cwd=unifree.project_root, capture_output=True, text=True, check=True,
+        )
+        modules = result.stdout.splitlines()
+
+        self.assertIn("unifree.llms.trivial_llm", modules)
+        self.assertNotIn("unifree.llms.chatgpt_llm", modules)
+        self.assertNotIn("unifree.llms.huggingface_llm", modules)
+
+    def test_lazy_attributes(self):
+        import unifree.llms
+        from unifree.llms.trivial_llm import TrivialLLM
+
+        self.assertIs(TrivialLLM, unifree.llms.TrivialLLM)
+        self.assertIn("PoolLLM", dir(unifree.llms))
+        with self.assertRaises(AttributeError):
+            getattr(unifree.llms, "UnknownLLM")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
+import os
+import tempfile
 import unittest
+from typing import Dict, List
+
+import numpy as np
 
 from unifree.known_translations_db import KnownTranslationsDb, KnownTranslation
-from unifree.utils import to_default_dict
+from unifree.utils import to_default_dict, get_statistics, migration_scope
 
 
 # Copyright (c) Unifree
@@ -59,8 +64,188 @@ class TestKnownTranslationsDb(unittest.TestCase):
             "known_translations": {
                 "language": "trivial",
                 "embedding_function": "all-MiniLM-L6-v2",
+                "index_cache_dir": False,
+                "result_count": 2,
+                "assistant_response": "!OK!",
+                "user_request": "'${SOURCE}' is '${TARGET}'",
+            }
+        }))
+
+
+class BagOfWordsEncoder:
+    """
+    Stands in for the sentence transformer: deterministic, offline and counting what it embeds
+    """
+    encoded_count: int = 0
+
+    def encode(self, texts):
+        is_single = isinstance(texts, str)
+        vectors = []
+        for text in [texts] if is_single else texts:
+            vector = np.zeros(64, dtype=np.float32)
+            for word in text.lower().split():
+                vector[sum(word.encode('utf-8')) % 64] += 1.0
+            vectors.append(vector / max(1e-6, float(np.linalg.norm(vector))))
+
+        BagOfWordsEncoder.encoded_count += len(vectors)
+        return vectors[0] if is_single else np.stack(vectors)
+
+
+class PersistentKnownTranslationsDb(KnownTranslationsDb):
+    translations_file_path: str
+
+    def _create_sentence_transformer(self, translations_config: Dict) -> BagOfWordsEncoder:
+        return BagOfWordsEncoder()
+
+    def _known_translations_file_path(self, target_engine: str) -> str:
+        return self.translations_file_path
+
+
+class TestPersistentKnownTranslationsIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.translations_file_path = os.path.join(self.temp_dir.name, "trivial.yaml")
+        self.index_config = {}
+        self.translations_config = {}
+        BagOfWordsEncoder.encoded_count = 0
+
+    def test_index_is_reused_and_updated_incrementally(self):
+        for index_type in ["chromadb", "exact", "ivf"]:
+            with self.subTest(index_type=index_type):
+                self.index_config = {"type": index_type}
+                BagOfWordsEncoder.encoded_count = 0
+
+                self._write_translations([("alpha beta", "A"), ("gamma delta", "G"), ("epsilon zeta", "E")])
+                self.assertEqual(3, len(self._open_db()._index))
+                self.assertEqual(3, BagOfWordsEncoder.encoded_count)
+
+                # Unchanged file: nothing is embedded, the sentence transformer is not even loaded
+                db = self._open_db()
+                self.assertIsNone(db._sentence_transformer)
+                self.assertEqual(3, BagOfWordsEncoder.encoded_count)
+                self.assertEqual("G", db.fetch_nearest_known_translations("gamma delta", count=1)[0].target)
+
+                # One entry changed, one removed: only the changed one is embedded
+                self._write_translations([("alpha beta", "A"), ("gamma delta", "G2")])
+                BagOfWordsEncoder.encoded_count = 0
+                db = self._open_db()
+                self.assertEqual(1, BagOfWordsEncoder.encoded_count)
+                self.assertEqual(2, len(db._index))
+                self.assertEqual("G2", db.fetch_nearest_known_translations("gamma delta", count=1)[0].target)
+
+    def test_fetch_nearest_batch(self):
+        self.index_config = {"type": "exact", "quantization": "int8"}
+        self._write_translations([("alpha beta", "A"), ("gamma delta", "G"), ("epsilon zeta", "E")])
+        db = self._open_db()
+
+        BagOfWordsEncoder.encoded_count = 0
+        result = db.fetch_nearest_known_translations_batch(["epsilon zeta", "alpha beta"], count=2)
+
+        self.assertEqual(2, BagOfWordsEncoder.encoded_count)
+        self.assertEqual([["E", 2], ["A", 2]], [[translations[0].target, len(translations)] for translations in result])
+
+    def test_prefetch(self):
+        self.index_config = {"type": "exact"}
+        self._write_translations([("alpha beta", "A"), ("gamma delta", "G"), ("epsilon zeta", "E")])
+        queries = ["alpha beta gamma", "epsilon", "alpha beta gamma"]
+
+        db = self._open_db()
+        BagOfWordsEncoder.encoded_count = 0
+        db.prefetch(queries)
+        self.assertEqual(2, BagOfWordsEncoder.encoded_count)  # Duplicate query is embedded once
+
+        self.assertEqual("A", db.fetch_nearest_known_translations("alpha beta gamma")[0].target)
+        self.assertEqual("E", db.fetch_nearest_known_translations("epsilon")[0].target)
+        self.assertEqual(2, BagOfWordsEncoder.encoded_count)
+
+        # Rerun reuses cached query embeddings
+        db = self._open_db()
+        db.prefetch(queries)
+        self.assertEqual(2, BagOfWordsEncoder.encoded_count)
+        self.assertIsNone(db._sentence_transformer)
+        self.assertEqual("E", db.fetch_nearest_known_translations("epsilon")[0].target)
+
+        # Lookups of a migration are released when it ends
+        with migration_scope():
+            db.prefetch(["gamma"])
+            self.assertEqual(1, len(db._prefetched))
+        self.assertEqual(2, len(db._prefetched))
+
+    def test_query_embeddings_of_concurrent_migrations_are_kept(self):
+        self.index_config = {"type": "exact"}
+        self._write_translations([("alpha beta", "A"), ("epsilon zeta", "E")])
+
+        db = self._open_db()
+        for queries in [["alpha beta gamma"], ["epsilon"]]:
+            with migration_scope():
+                db.prefetch(queries)
+
+        BagOfWordsEncoder.encoded_count = 0
+        self._open_db().prefetch(["alpha beta gamma", "epsilon"])
+        self.assertEqual(0, BagOfWordsEncoder.encoded_count)
+        self.assertEqual(1, len([name for name in os.listdir(os.path.join(self.temp_dir.name, "index")) if "query-embeddings" in name]))
+
+    def test_select_known_translations(self):
+        self.index_config = {"type": "exact"}
+        self._write_translations([("alpha beta", "A"), ("alpha beta gamma", "AB"), ("alpha delta", "AD"), ("omega", "O")])
+
+        def select(**translations_config) -> List[str]:
+            self.translations_config = {"result_count": 3, **translations_config}
+            return [translation.target for translation in self._open_db().select_known_translations("alpha beta", count_tokens=lambda text: len(text.split()))]
+
+        self.assertEqual(["A", "AB", "AD"], select())
+        self.assertEqual(["A", "AB"], select(min_similarity=0.6))
+        self.assertEqual(["A", "AD", "AB"], select(mmr_lambda=0.3))
+        self.assertEqual(["A", "AB", "AD"], select(mmr_lambda=1))
+        saved_tokens = get_statistics().get("Known translation history tokens saved", 0)
+        self.assertEqual(["A", "AB", "O"], select(candidate_count=4, max_history_tokens=15))  # 4 to 6 tokens per example
+        self.assertEqual(1, get_statistics()["Known translation history tokens saved"] - saved_tokens)  # O instead of AD
+
+        # Almost only diversity: unrelated candidate beyond 'result_count' goes second, threshold prevents that
+        self.assertEqual(["A", "O", "AD"], select(candidate_count=4, mmr_lambda=0.1))
+        self.assertEqual(["A", "AD", "AB"], select(candidate_count=4, mmr_lambda=0.1, min_similarity=0.1))
+
+        # Only the token budget limits the examples
+        self.assertEqual(["A", "AB"], select(result_count=None, candidate_count=4, max_history_tokens=11))
+
+        # Diversified examples longer than the nearest ones are not counted as saved
+        saved_tokens = get_statistics().get("Known translation history tokens saved", 0)
+        added_tokens = get_statistics().get("Known translation history tokens added", 0)
+        self.translations_config = {"result_count": 3, "candidate_count": 4, "mmr_lambda": 0.1}
+        selected = self._open_db().select_known_translations("alpha beta", count_tokens=lambda text: 10 if "omega" in text else 1)
+        self.assertEqual(["A", "O", "AD"], [translation.target for translation in selected])
+        self.assertEqual(saved_tokens, get_statistics().get("Known translation history tokens saved", 0))
+        self.assertLess(added_tokens, get_statistics()["Known translation history tokens added"])
+
+    def test_models_get_separate_indexes(self):
+        self._write_translations([("alpha beta", "A")])
+        self._open_db("first-model")
+        self._open_db("second-model")
+
+        self.assertEqual(2, BagOfWordsEncoder.encoded_count)
+
+    def _write_translations(self, translations: List) -> None:
+        with open(self.translations_file_path, 'w') as file:
+            file.write("translations:\n")
+            for source, target in translations:
+                file.write(f"  - source: '{source}'\n    target: '{target}'\n")
+
+    def _open_db(self, embedding_function: str = "bag-of-words") -> PersistentKnownTranslationsDb:
+        db = PersistentKnownTranslationsDb(to_default_dict({
+            "known_translations": {
+                "target_engine": "trivial",
+                "embedding_function": embedding_function,
+                "index_cache_dir": os.path.join(self.temp_dir.name, "index"),
+                "index": self.index_config,
                 "result_count": 2,
                 "assistant_response": "!OK!",
                 "user_request": "'${SOURCE}' is '${TARGET}'",
+                **self.translations_config,
             }
         }))
+        db.translations_file_path = self.translations_file_path
+        db.initialize()
+
+        return db
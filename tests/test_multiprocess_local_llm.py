@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 # Copyright (c) AppLovin. and its affiliates. All rights reserved.
+import os
+import time
 import unittest
 from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 
 from unifree.llms import MultiprocessLocalLLM
 
 
 class TestMultiprocessLocalLLM(unittest.TestCase):
+    def setUp(self) -> None:
+        MultiprocessLocalLLM.shutdown_shared_executor()
+
+    def tearDown(self) -> None:
+        MultiprocessLocalLLM.shutdown_shared_executor()
 
     def test_translate(self):
         config = {
@@ -46,3 +54,101 @@ class TestMultiprocessLocalLLM(unittest.TestCase):
             results_count += 1
 
         self.assertEqual(200, results_count)
+
+        health = mp_llm.health_stats()
+        self.assertEqual(5, len(health["workers"]))
+        self.assertEqual(200, sum(worker["completed"] for worker in health["workers"]))
+        self.assertEqual(0, health["timeouts"])
+
+    def test_tokenizer_only_parent(self):
+        mp_llm = MultiprocessLocalLLM(self._create_config(weights_mb=16, tokenizer_only_parent=True))
+        mp_llm.initialize()
+
+        self.assertIsNone(mp_llm._local_model.weights)
+        self.assertEqual(9, mp_llm.count_tokens("some text"))
+        self.assertEqual("QUERY", mp_llm.query("QUERY"))
+
+    def test_workers_failing_to_load_model(self):
+        mp_llm = MultiprocessLocalLLM(self._create_config(weights_mb="not a number", worker_count=1, tokenizer_only_parent=True, max_start_failures=2))
+        mp_llm.initialize()
+
+        with self.assertRaises(RuntimeError) as context:
+            mp_llm.query("QUERY")
+
+        self.assertIn("All workers failed to start", str(context.exception))
+        self.assertTrue(mp_llm.health_stats()["workers"][0]["failed"])
+
+    def test_fork_workers_start_with_model(self):
+        mp_llm = MultiprocessLocalLLM(self._create_config(weights_mb=1, model_sharing="fork"))
+        mp_llm.initialize()
+
+        self.assertEqual(2, len(mp_llm.health_stats()["workers"]))
+        self.assertEqual("QUERY", mp_llm.query("QUERY"))
+
+    def test_configurations_get_separate_workers(self):
+        llms = [MultiprocessLocalLLM(self._create_config(weights_mb=weights_mb, worker_count=1)) for weights_mb in [1, 2]]
+        for llm in llms:
+            llm.initialize()
+            self.assertEqual("QUERY", llm.query("QUERY"))
+
+        pids = [llm.health_stats()["workers"][0]["pid"] for llm in llms]
+        self.assertNotEqual(pids[0], pids[1])
+
+    @unittest.skipUnless(os.path.exists("/proc/self/smaps_rollup"), "Needs Linux /proc")
+    @unittest.skipUnless(os.environ.get("UNIFREE_BENCHMARKS"), "Benchmark, set UNIFREE_BENCHMARKS=1 to run it")
+    def test_memory_benchmark(self):
+        weights_mb = 64
+        worker_count = 3
+
+        private_mb_per_worker = {}
+        for model_sharing in ["none", "fork"]:
+            mp_llm = MultiprocessLocalLLM(self._create_config(weights_mb, worker_count=worker_count, model_sharing=model_sharing))
+            mp_llm.initialize()
+
+            private_mb = self._measure_worker_private_mb(mp_llm, weights_mb if model_sharing == "none" else 0)
+            private_mb_per_worker[model_sharing] = private_mb
+
+            MultiprocessLocalLLM.shutdown_shared_executor()
+
+        self.assertTrue(all(mb >= weights_mb for mb in private_mb_per_worker["none"]))
+        self.assertTrue(all(mb < weights_mb / 2 for mb in private_mb_per_worker["fork"]))
+
+    @staticmethod
+    def _measure_worker_private_mb(mp_llm: MultiprocessLocalLLM, expected_mb: int) -> List[float]:
+        for query_ix in range(20):
+            mp_llm.query(f"QUERY {query_ix}")
+
+        # Workers could still be running their initializers, wait until they settle
+        deadline = time.monotonic() + 10
+        while True:
+            private_mb = [_private_memory_mb(worker["pid"]) for worker in mp_llm.health_stats()["workers"]]
+            if all(mb >= expected_mb for mb in private_mb) or time.monotonic() > deadline:
+                return private_mb
+            time.sleep(0.1)
+
+    @staticmethod
+    def _create_config(weights_mb: int, worker_count: int = 2, **wrapper_config) -> Dict:
+        return {
+            "class": "MultiprocessLocalLLM",
+            "llm_config": {
+                "class": "TrivialLLM",
+                "config": {
+                    "weights_mb": weights_mb,
+                }
+            },
+            "wrapper_config": {
+                "num_workers": worker_count,
+                "query_timeout_sec": 10,
+                **wrapper_config,
+            }
+        }
+
+
+def _private_memory_mb(pid: int) -> float:
+    private_kb = 0
+    with open(f"/proc/{pid}/smaps_rollup") as smaps_file:
+        for line in smaps_file:
+            if line.startswith("Private_Clean:") or line.startswith("Private_Dirty:"):
+                private_kb += int(line.split()[1])
+
+    return private_kb / 1024
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import contextvars
+import os
+import tempfile
+import time
+import unittest
+from typing import Optional, List
+
+import numpy as np
+
+import unifree
+from unifree import LLM, QueryHistoryItem
+from unifree.csharp_migration_strategies import CSharpCompilationUnitToSingleFileWithLLM
+from unifree.known_translations_db import KnownTranslationsDb, _current_instance
+from unifree.llms.batch_job_llm import answer_requests
+from unifree.near_duplicates import NearDuplicateDetector, syntax_tokens, token_hashes
+from unifree.project_migration_strategies import CreateMigrations, ExecuteMigrations
+from unifree.source_code_parsers import CSharpCodeParser
+from unifree.utils import to_default_dict, migration_scope
+
+_ENEMY = """
+using UnityEngine;
+
+public class EnemyA : MonoBehaviour
+{
+    public float speed = 2.5f;
+    public int health = 100;
+    private Transform target;
+
+    void Start()
+    {
+        // Chase the player
+        target = GameObject.FindWithTag("Player").transform;
+    }
+
+    void Update()
+    {
+        if (health <= 0)
+        {
+            Destroy(gameObject);
+            return;
+        }
+
+        Vector3 direction = (target.position - transform.position).normalized;
+        transform.position += direction * speed * Time.deltaTime;
+        transform.LookAt(target);
+    }
+
+    public void TakeDamage(int damage)
+    {
+        health -= damage;
+        if (health < 20)
+        {
+            speed *= 1.5f;
+        }
+    }
+}
+"""
+
+_CONFIG = {
+    "source": {"csharp": {"convert_macros_to_comments": True}},
+    "target": {"extension": ".gd"},
+    "prompts": {"system": "System Prompt", "full": "Translate ${CODE}"},
+    "llm": {"class": "TrivialLLM"},
+    "concurrency": {"execute_strategy_workers": 2},
+}
+
+
+class TestNearDuplicates(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def test_groups_copy_paste_variants(self):
+        sources = [
+            _ENEMY,
+            _ENEMY.replace("EnemyA", "EnemyB").replace("2.5f", "4f").replace("100", "250").replace("// Chase the player", ""),
+            open(os.path.join(os.path.dirname(__file__), "resources", "ShortClassNoNamespace.cs")).read(),
+            _ENEMY.replace("speed", "velocity").replace("EnemyA", "EnemyC"),
+            "",
+        ]
+
+        file_hashes = [token_hashes(syntax_tokens(self._parse(source))) if source else token_hashes([]) for source in sources]
+
+        detector = NearDuplicateDetector({"threshold": 0.7})
+        groups = detector.group(detector.signatures(file_hashes))
+
+        self.assertEqual(1, len(groups))
+        self.assertEqual([0, 1, 3], groups[0].members)
+        self.assertIn(groups[0].reference, groups[0].members)
+
+    def test_short_files(self):
+        detector = NearDuplicateDetector({})
+        signatures = detector.signatures([token_hashes(["a", "b"]), token_hashes(["a", "b"]), token_hashes(["a"]), token_hashes([])])
+
+        self.assertEqual((4, 128), signatures.shape)
+        self.assertTrue((signatures[0] == signatures[1]).all())
+        self.assertEqual([[0, 1]], [group.members for group in detector.group(signatures)])
+
+    def test_near_duplicates_translated_with_reference(self):
+        strategies = []
+        for name, source in [("EnemyA.cs", _ENEMY), ("EnemyB.cs", _ENEMY.replace("EnemyA", "EnemyB"))]:
+            source_path = os.path.join(self.temp_dir.name, name)
+            with open(source_path, 'w') as source_file:
+                source_file.write(source)
+
+            strategies.append(_RecordingStrategy(unifree.FileMigrationSpec(source_path, self.temp_dir.name, self.temp_dir.name), to_default_dict(_CONFIG)))
+
+        reference, near_duplicate = strategies
+        near_duplicate.near_duplicate_reference = reference
+
+        ExecuteMigrations([near_duplicate, reference], to_default_dict(_CONFIG)).execute()
+
+        self.assertEqual([], reference.llm.histories[0])
+        self.assertEqual(["user", "assistant"], [item.role for item in near_duplicate.llm.histories[0]])
+        self.assertIn("class EnemyA", near_duplicate.llm.histories[0][0].content)
+        self.assertEqual("```\nTRANSLATED EnemyA.cs\n```", near_duplicate.llm.histories[0][1].content)
+
+    def test_near_duplicates_fit_after_prefetch(self):
+        config = to_default_dict({
+            **_CONFIG,
+            "prompts": {**_CONFIG["prompts"], "class_only": "Translate class ${CODE}", "methods_only": "Translate methods ${CODE}"},
+            "known_translations": {"target_engine": "godot"},
+        })
+        strategies = []
+        for name in ["EnemyA", "EnemyB"]:
+            source_path = os.path.join(self.temp_dir.name, f"{name}.cs")
+            with open(source_path, 'w') as source_file:
+                source_file.write(_ENEMY.replace("EnemyA", name))
+
+            strategies.append(_RecordingStrategy(unifree.FileMigrationSpec(source_path, self.temp_dir.name, self.temp_dir.name), config))
+
+        reference, near_duplicate = strategies
+        near_duplicate.near_duplicate_reference = reference
+
+        # The file fits into one prompt, not together with the source of its near-duplicate
+        context_length = int(1.5 * len(_ENEMY))
+        for strategy in strategies:
+            strategy.llm.context_length = context_length
+
+        known_translations_db = _EmptyKnownTranslationsDb(config)
+        contextvars.copy_context().run(self._execute_with_known_translations, known_translations_db, [near_duplicate, reference], config)
+
+        self.assertGreater(len(known_translations_db.prefetched_queries), 0)
+        self.assertEqual(1, len(reference.llm.request_token_counts))
+        self.assertGreater(len(near_duplicate.llm.request_token_counts), 1)
+        self.assertLessEqual(max(near_duplicate.llm.request_token_counts), context_length)
+
+    @staticmethod
+    def _execute_with_known_translations(known_translations_db: KnownTranslationsDb, strategies: List['_RecordingStrategy'], config) -> None:
+        _current_instance.set(known_translations_db)
+        ExecuteMigrations(strategies, config).execute()
+
+    def test_batch_job_phases(self):
+        source_path = os.path.join(self.temp_dir.name, "source")
+        destination_path = os.path.join(self.temp_dir.name, "destination")
+        os.makedirs(os.path.join(source_path, "ProjectSettings"))
+        os.makedirs(os.path.join(source_path, "Assets"))
+        for name in ["EnemyA", "EnemyB"]:
+            with open(os.path.join(source_path, "Assets", f"{name}.cs"), 'w') as source_file:
+                source_file.write(_ENEMY.replace("EnemyA", name))
+
+        requests_file = os.path.join(self.temp_dir.name, "requests.jsonl")
+        responses_file = os.path.join(self.temp_dir.name, "responses.jsonl")
+
+        def migrate(batch_job_config: dict) -> None:
+            config = to_default_dict({
+                **_CONFIG,
+                "llm": {"class": "BatchJobLLM", "batch_job_config": batch_job_config, "llm_config": {"class": "TrivialLLM", "config": {}}},
+                "near_duplicates": True,
+                "strategies": {".cs": "CSharpCompilationUnitToSingleFileWithLLM"},
+            })
+            with migration_scope():
+                create_migrations = CreateMigrations(source_path, destination_path, config)
+                create_migrations.execute()
+                ExecuteMigrations(create_migrations.migrations(), config).execute()
+
+        migrate({"requests_file": requests_file})
+        self.assertEqual(2, answer_requests(requests_file, responses_file, lambda messages: "```\nTRANSLATED\n```"))
+
+        migrate({"requests_file": requests_file, "responses_file": responses_file})
+        self.assertEqual(["EnemyA.gd", "EnemyB.gd"], sorted(os.listdir(os.path.join(destination_path, "Assets"))))
+
+    @unittest.skipUnless(os.environ.get("UNIFREE_BENCHMARKS"), "Benchmark, set UNIFREE_BENCHMARKS=1 to run it")
+    def test_benchmark(self):
+        """
+        Signatures and grouping of 100k files with 50-600 tokens, half of them copy-paste variants of the other half
+        """
+        rng = np.random.default_rng(0)
+        vocabulary = rng.integers(0, 2 ** 32, 5_000, dtype=np.uint64)
+
+        file_hashes = []
+        for _ in range(50_000):
+            original = vocabulary[rng.integers(0, len(vocabulary), rng.integers(50, 600))]
+            variant = original.copy()
+            changed = rng.integers(0, len(variant), max(1, len(variant) // 100))
+            variant[changed] = vocabulary[rng.integers(0, len(vocabulary), len(changed))]
+            file_hashes += [original, variant]
+
+        detector = NearDuplicateDetector({})
+
+        start_time = time.perf_counter()
+        groups = detector.group(detector.signatures(file_hashes))
+        elapsed_time = time.perf_counter() - start_time
+
+        found_pairs = sum(1 for group in groups if group.members[0] % 2 == 0 and group.members[1:] == [group.members[0] + 1])
+
+        self.assertGreater(found_pairs, 0.95 * len(file_hashes) / 2)
+        self.assertEqual(found_pairs, len(groups))
+        self.assertLess(elapsed_time, 60)
+
+    @staticmethod
+    def _parse(source: str):
+        with tempfile.NamedTemporaryFile('w', suffix=".cs", delete=False) as source_file:
+            source_file.write(source)
+
+        try:
+            return CSharpCodeParser(to_default_dict(_CONFIG)).parse(source_file.name)
+        finally:
+            os.remove(source_file.name)
+
+
+class _RecordingLLM(LLM):
+    histories: List[List[QueryHistoryItem]]
+    request_token_counts: List[int]
+    context_length: Optional[int]
+
+    def __init__(self, config) -> None:
+        super().__init__(config)
+        self.histories = []
+        self.request_token_counts = []
+        self.context_length = None
+
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        self.histories.append(history or [])
+        self.request_token_counts.append(sum(self.count_tokens(text) for text in [user, system or ""] + [item.content for item in history or []]))
+        class_name = "EnemyB" if "class EnemyB" in user else "EnemyA"
+        return f"```\nTRANSLATED {class_name}.cs\n```"
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        return self.context_length is None or token_count <= self.context_length
+
+    def count_tokens(self, source_text: str) -> int:
+        return len(source_text)
+
+    def initialize(self) -> None:
+        pass
+
+
+class _EmptyKnownTranslationsDb(KnownTranslationsDb):
+    prefetched_queries: List[str]
+
+    def __init__(self, config) -> None:
+        super().__init__(config)
+        self.prefetched_queries = []
+
+    def prefetch(self, queries: List[str]) -> None:
+        self.prefetched_queries += queries
+
+    def fetch_nearest_as_query_history(self, query: str, count: Optional[int] = None, count_tokens=None) -> List[QueryHistoryItem]:
+        return []
+
+
+class _RecordingStrategy(CSharpCompilationUnitToSingleFileWithLLM):
+    def load_llm(self) -> LLM:
+        return _RecordingLLM(self.config)
+
+    def save_content(self, content: str, target_file_path: str):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
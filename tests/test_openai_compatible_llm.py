@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import json
+import sys
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Dict, Set
+from unittest import mock
+
+import openai
+import requests
+
+from unifree import QueryHistoryItem
+from unifree.llms import OpenAiCompatibleLLM, ChatGptLLM
+from unifree.llms.code_extrators import FirstSourceCodeExtractor
+
+
+class ChatCompletionsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    requests: List[Dict] = []
+    client_ports: Set[int] = set()
+    lock: threading.Lock = threading.Lock()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        with self.lock:
+            self.requests.append({
+                "path": self.path,
+                "authorization": self.headers.get("Authorization"),
+                "body": body,
+            })
+            self.client_ports.add(self.client_address[1])
+
+        if body.get("stream"):
+            self._stream_response(body)
+            return
+
+        if body["messages"][-1]["content"] == "FAIL":
+            response, status = {"error": "failed"}, 500
+        else:
+            response, status = {"choices": [{"message": {"role": "assistant", "content": f"ECHO {body['messages'][-1]['content']}"}}]}, 200
+
+        response_bytes = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response_bytes)))
+        self.end_headers()
+        self.wfile.write(response_bytes)
+
+    def _stream_response(self, body: Dict):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        fragments = ["Here", " is the code:\n```\n", "code", "\n```", "\nExplanation"] + ["..."] * 200
+        try:
+            for fragment in fragments:
+                self._write_chunk(f"data: {json.dumps({'choices': [{'delta': {'content': fragment}}]})}\n\n")
+                with self.lock:
+                    self.requests.append({"body": body, "fragment": fragment})
+
+            self._write_chunk("data: [DONE]\n\n")
+            self._write_chunk("")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Client stopped reading
+
+    def _write_chunk(self, data: str):
+        data_bytes = data.encode("utf-8")
+        self.wfile.write(f"{len(data_bytes):x}\r\n".encode("utf-8") + data_bytes + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ChatCompletionsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Cancelled streams reset the connection while the handler waits for the next request on it
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+class TestOpenAiCompatibleLLM(unittest.TestCase):
+    _server: ThreadingHTTPServer
+    _server_thread: threading.Thread
+
+    def setUp(self) -> None:
+        ChatCompletionsHandler.requests = []
+        ChatCompletionsHandler.client_ports = set()
+
+    def test_query(self):
+        llm = self._create_llm()
+
+        response = llm.query("user query", "system query", [QueryHistoryItem(role="user", content="history")])
+
+        self.assertEqual("ECHO user query", response)
+        self.assertEqual(1, len(ChatCompletionsHandler.requests))
+
+        request = ChatCompletionsHandler.requests[0]
+        self.assertEqual("/v1/chat/completions", request["path"])
+        self.assertEqual("Bearer test-key", request["authorization"])
+        self.assertEqual("test-model", request["body"]["model"])
+        self.assertEqual([
+            {"role": "system", "content": "system query"},
+            {"role": "user", "content": "history"},
+            {"role": "user", "content": "user query"},
+        ], request["body"]["messages"])
+
+    def test_query_failure(self):
+        llm = self._create_llm()
+
+        with self.assertRaises(RuntimeError):
+            llm.query("FAIL")
+
+    def test_query_streaming(self):
+        llm = self._create_llm(stream=True)
+
+        self.assertEqual("Here is the code:\n```\ncode\n```\nExplanation" + "..." * 200, llm.query("user query"))
+
+        extractor = FirstSourceCodeExtractor()
+        response = llm.query_streaming("user query", on_fragment=extractor.feed)
+
+        self.assertEqual("Here is the code:\n```\ncode\n```", response)
+        self.assertEqual("code", extractor.result())
+
+    def test_chatgpt_streaming_response_is_closed(self):
+        llm = ChatGptLLM({
+            "class": "ChatGptLLM",
+            "config": {"secret_key": "test-key", "model": "test-model", "max_tokens": 1000, "stream": True},
+        })
+        llm.initialize()
+
+        close = requests.Response.close
+        with mock.patch.object(openai, "api_base", f"http://127.0.0.1:{self._server.server_address[1]}/v1"), \
+                mock.patch.object(requests.Response, "close", autospec=True, side_effect=close) as closed:
+            extractor = FirstSourceCodeExtractor()
+            response = llm.query_streaming("user query", on_fragment=extractor.feed)
+
+        self.assertEqual("Here is the code:\n```\ncode\n```", response)
+        self.assertEqual("Bearer test-key", ChatCompletionsHandler.requests[0]["authorization"])
+        self.assertEqual(1, closed.call_count)
+
+    def test_connections_are_reused(self):
+        def query(ix: int) -> str:
+            # New instance for every query, same as migration strategies do
+            return self._create_llm().query(f"query {ix}")
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(query, range(100)))
+
+        self.assertEqual([f"ECHO query {ix}" for ix in range(100)], responses)
+        self.assertLessEqual(len(ChatCompletionsHandler.client_ports), 4)
+
+    @classmethod
+    def _create_llm(cls, stream: bool = False) -> OpenAiCompatibleLLM:
+        llm = OpenAiCompatibleLLM({
+            "class": "OpenAiCompatibleLLM",
+            "config": {
+                "base_url": f"http://127.0.0.1:{cls._server.server_address[1]}/v1/",
+                "secret_key": "test-key",
+                "model": "test-model",
+                "max_tokens": 1000,
+                "connection_pool_size": 4,
+                "stream": stream,
+            }
+        })
+        llm.initialize()
+
+        return llm
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls._server = ChatCompletionsServer(("127.0.0.1", 0), ChatCompletionsHandler)
+        cls._server_thread = threading.Thread(target=cls._server.serve_forever, daemon=True)
+        cls._server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        # Close client connections first, so handlers are not left waiting for requests on them
+        cls._create_llm().session.close()
+        cls._server.shutdown()
+        cls._server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Callable
+
+from unifree import LLM, QueryHistoryItem
+from unifree.llms import PoolLLM, DeferredResponseError
+from unifree.utils import to_default_dict
+
+
+class FakeBackendLLM(LLM):
+    latency_sec: float
+    fails: bool
+    defers: bool
+    query_count: int
+
+    def __init__(self, latency_sec: float = 0.0, fails: bool = False, defers: bool = False) -> None:
+        super().__init__({})
+        self.latency_sec = latency_sec
+        self.fails = fails
+        self.defers = defers
+        self.query_count = 0
+        self._lock = threading.Lock()
+
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        return self.query_streaming(user, system, history)
+
+    def query_streaming(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None,
+                        on_fragment: Optional[Callable[[str], bool]] = None) -> str:
+        with self._lock:
+            self.query_count += 1
+
+        time.sleep(self.latency_sec)
+        if self.fails:
+            raise RuntimeError("Backend is down")
+        if self.defers:
+            raise DeferredResponseError("Exported to a batch job")
+
+        return user
+
+    def initialize(self) -> None:
+        pass
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        return True
+
+    def count_tokens(self, source_text: str) -> int:
+        return len(source_text.split())
+
+
+class TestPoolLLM(unittest.TestCase):
+    def test_throughput_scales_with_backends(self):
+        queries = [f"query {ix}" for ix in range(16)]
+
+        elapsed_by_backend_count = {}
+        for backend_count in [1, 4]:
+            llm, backends = self._create_llm(f"throughput-{backend_count}", [FakeBackendLLM(0.05) for _ in range(backend_count)], max_concurrency=1)
+
+            started_at = time.monotonic()
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                self.assertEqual(queries, list(executor.map(llm.query, queries)))
+            elapsed_by_backend_count[backend_count] = time.monotonic() - started_at
+
+            self.assertEqual(len(queries), sum(backend.query_count for backend in backends))
+            self.assertTrue(all(backend.query_count >= len(queries) / backend_count / 2 for backend in backends))
+
+        self.assertLess(elapsed_by_backend_count[4], elapsed_by_backend_count[1] / 2)
+
+    def test_unhealthy_backend_is_ejected(self):
+        llm, (failing, healthy) = self._create_llm("ejection", [FakeBackendLLM(fails=True), FakeBackendLLM()],
+                                                   health={"failure_threshold": 2, "ejection_sec": 60})
+
+        for ix in range(6):
+            self.assertEqual(f"query {ix}", llm.query(f"query {ix}"))
+
+        self.assertEqual(2, failing.query_count)
+        self.assertEqual(6, healthy.query_count)
+
+    def test_all_backends_failing(self):
+        llm, _ = self._create_llm("all-failing", [FakeBackendLLM(fails=True), FakeBackendLLM(fails=True)])
+
+        with self.assertRaises(RuntimeError):
+            llm.query("query")
+
+    def test_deferred_response_is_not_retried(self):
+        llm, (deferring, other) = self._create_llm("deferred", [FakeBackendLLM(defers=True), FakeBackendLLM(defers=True)],
+                                                   health={"failure_threshold": 1, "ejection_sec": 60})
+
+        for _ in range(4):
+            with self.assertRaises(DeferredResponseError):
+                llm.query("query")
+
+        self.assertEqual(4, deferring.query_count + other.query_count)
+        self.assertEqual([0.0, 0.0], [backend.ejected_until for backend in llm._pool.backends])
+
+    def test_rate_limit(self):
+        llm, (limited, unlimited) = self._create_llm("rate-limit", [FakeBackendLLM(), FakeBackendLLM()], requests_per_minute=[2, None])
+
+        for ix in range(5):
+            llm.query(f"query {ix}")
+
+        self.assertEqual(2, limited.query_count)
+        self.assertEqual(3, unlimited.query_count)
+
+    def test_backends_creating_global_instances(self):
+        # Nested pool creates its global instance while the outer one is created, like HuggingfaceLLM loading its model
+        llm = PoolLLM(to_default_dict({
+            "backends": [
+                {"name": "nested", "llm_config": {"class": "PoolLLM", "backends": [{"llm_config": {"class": "TrivialLLM", "config": {}}}]}},
+                {"name": "trivial", "llm_config": {"class": "TrivialLLM", "config": {}}},
+            ],
+        }))
+
+        initialize_thread = threading.Thread(target=llm.initialize, daemon=True)
+        initialize_thread.start()
+        initialize_thread.join(timeout=10)
+
+        self.assertFalse(initialize_thread.is_alive())
+        self.assertEqual("query", llm.query("query"))
+
+    def _create_llm(self, name: str, backends: List[FakeBackendLLM], max_concurrency: Optional[int] = None,
+                    requests_per_minute: Optional[List[Optional[int]]] = None, health: Optional[dict] = None):
+        llm = PoolLLM(to_default_dict({
+            "backends": [{
+                "name": f"{name}-{ix}",
+                "max_concurrency": max_concurrency,
+                "requests_per_minute": requests_per_minute[ix] if requests_per_minute else None,
+                "llm_config": {"class": "TrivialLLM", "config": {}},
+            } for ix in range(len(backends))],
+            "health": health,
+        }))
+        llm.initialize()
+
+        for pool_backend, backend in zip(llm._pool.backends, backends):
+            pool_backend.llm = backend
+
+        return llm, backends
+
+
+if __name__ == '__main__':
+    unittest.main()
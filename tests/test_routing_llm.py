@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import unittest
+from typing import Optional, List, Callable
+
+from unifree import LLM, QueryHistoryItem, QueryContext, query_context
+from unifree.llms import RoutingLLM, DeferredResponseError
+from unifree.llms.code_extrators import extract_first_source_code, is_extracted, FirstSourceCodeExtractor
+
+
+class ScriptedLLM(LLM):
+    responses: List[str]
+    queries: List[str]
+    fed_fragments: List[str]
+
+    def __init__(self, *responses: str) -> None:
+        super().__init__({})
+        self.responses = list(responses)
+        self.queries = []
+        self.fed_fragments = []
+
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        return self.query_streaming(user, system, history)
+
+    def query_streaming(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None,
+                        on_fragment: Optional[Callable[[str], bool]] = None) -> str:
+        self.queries.append(user)
+
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        if on_fragment:
+            on_fragment(response)
+            self.fed_fragments.append(response)
+
+        return response
+
+    def initialize(self) -> None:
+        pass
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        return token_count < 1000
+
+    def count_tokens(self, source_text: str) -> int:
+        return len(source_text.split())
+
+
+class TestRoutingLLM(unittest.TestCase):
+    def test_route_by_chunk_kind_and_complexity(self):
+        llm, fast, strong = self._create_llm()
+
+        self._query(llm, "small method", QueryContext(chunk_kind="methods_only", complexity=3))
+        self._query(llm, "whole file", QueryContext(chunk_kind="full", complexity=3))
+        self._query(llm, "complex method", QueryContext(chunk_kind="methods_only", complexity=30))
+        self._query(llm, "no context", None)
+
+        self.assertEqual(["small method"], fast.queries)
+        self.assertEqual(["whole file", "complex method", "no context"], strong.queries)
+
+    def test_route_by_token_count(self):
+        llm, fast, strong = self._create_llm()
+
+        self._query(llm, "word " * 10, QueryContext(chunk_kind="methods_only"))
+        self._query(llm, "word " * 100, QueryContext(chunk_kind="methods_only"))
+
+        self.assertEqual(1, len(fast.queries))
+        self.assertEqual(1, len(strong.queries))
+
+    def test_escalation_on_invalid_response(self):
+        llm, fast, strong = self._create_llm(fast_responses=["I can't translate this"])
+
+        fresh_extractors = []
+
+        def create_on_fragment():
+            fresh_extractors.append(FirstSourceCodeExtractor())
+            return fresh_extractors[-1].feed
+
+        context = QueryContext(
+            chunk_kind="class_only",
+            is_valid_response=lambda response: is_extracted(extract_first_source_code, response),
+            create_on_fragment=create_on_fragment,
+        )
+        with query_context(context):
+            response = llm.query_streaming("code", on_fragment=lambda fragment: False)
+
+        self.assertEqual("```\nstrong\n```", response)
+        self.assertEqual(["code"], fast.queries)
+        self.assertEqual(["code"], strong.queries)
+        self.assertEqual(1, len(fresh_extractors))
+        self.assertTrue(fresh_extractors[0].is_complete)
+
+    def test_escalation_on_error(self):
+        llm, fast, strong = self._create_llm(fast_responses=[RuntimeError("Service unavailable")])
+
+        self.assertEqual("```\nstrong\n```", self._query(llm, "code", QueryContext(chunk_kind="methods_only")))
+
+    def test_no_escalation_of_deferred_response(self):
+        llm, fast, strong = self._create_llm(fast_responses=[DeferredResponseError("Exported to a batch job")])
+
+        with self.assertRaises(DeferredResponseError):
+            self._query(llm, "code", QueryContext(chunk_kind="methods_only"))
+        self.assertEqual([], strong.queries)
+
+    def test_no_escalation_from_last_route(self):
+        llm, fast, strong = self._create_llm(strong_responses=[RuntimeError("Service unavailable")])
+
+        with self.assertRaises(RuntimeError):
+            self._query(llm, "code", QueryContext(chunk_kind="full"))
+
+    @staticmethod
+    def _query(llm: RoutingLLM, user: str, context: Optional[QueryContext]) -> str:
+        if context is None:
+            return llm.query(user)
+
+        with query_context(context):
+            return llm.query(user)
+
+    @staticmethod
+    def _create_llm(fast_responses=None, strong_responses=None):
+        llm = RoutingLLM({
+            "class": "RoutingLLM",
+            "routes": [{
+                "name": "fast",
+                "max_tokens": 50,
+                "chunk_kinds": ["class_only", "methods_only"],
+                "max_complexity": 10,
+                "llm_config": {"class": "TrivialLLM", "config": {}},
+            }, {
+                "name": "strong",
+                "llm_config": {"class": "TrivialLLM", "config": {}},
+            }],
+        })
+        llm.initialize()
+
+        fast = ScriptedLLM(*(fast_responses or ["```\nfast\n```"] * 10))
+        strong = ScriptedLLM(*(strong_responses or ["```\nstrong\n```"] * 10))
+        llm._routes[0].llm = fast
+        llm._routes[1].llm = strong
+
+        return llm, fast, strong
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import os
+import tempfile
+import threading
+import unittest
+
+import yaml
+
+from unifree.server import MigrationJob, MigrationServer, MigrationServerClient, submit_migration
+
+_CONFIG = {
+    "source": {"csharp": {"convert_macros_to_comments": True}},
+    "target": {"extension": ".gd"},
+    "prompts": {"system": "System Prompt", "full": "```\n${CODE}\n```"},
+    "llm": {"class": "TrivialLLM"},
+    "concurrency": {"create_strategy_workers": 2, "execute_strategy_workers": 2},
+    "strategies": {".cs": "CSharpCompilationUnitToSingleFileWithLLM"},
+}
+
+
+class TestMigrationServer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        # Configs are loaded by name from the configs folder, an absolute path without the extension works too
+        self.config_name = os.path.join(self.temp_dir.name, "test")
+        with open(self.config_name + ".yaml", 'w') as config_file:
+            yaml.safe_dump(_CONFIG, config_file)
+
+        self.source = os.path.join(self.temp_dir.name, "unity")
+        os.makedirs(os.path.join(self.source, "Assets"))
+        os.makedirs(os.path.join(self.source, "ProjectSettings"))
+        for name in ["Player", "Enemy"]:
+            with open(os.path.join(self.source, "Assets", f"{name}.cs"), 'w') as source_file:
+                source_file.write(f"public class {name}\n{{\n    float speed;\n}}\n")
+
+    def _start_server(self, address: str, **kwargs) -> MigrationServer:
+        server = MigrationServer(address, max_concurrent_jobs=2, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+
+        return server
+
+    def test_concurrent_jobs(self):
+        server = self._start_server(f"unix:{os.path.join(self.temp_dir.name, 'unifree.sock')}")
+        client = MigrationServerClient(server.address)
+
+        destinations = [os.path.join(self.temp_dir.name, f"godot{ix}") for ix in range(3)]
+        jobs = [client.submit(self.config_name, self.source, destination) for destination in destinations]
+        events = {job["id"]: list(client.events(job["id"])) for job in jobs}
+
+        for job, destination in zip(jobs, destinations):
+            job_events = events[job["id"]]
+
+            self.assertEqual("succeeded", client.job(job["id"])["status"])
+            self.assertEqual({"type": "status", "status": "succeeded", "exit_code": 0},
+                             {key: job_events[-1][key] for key in ["type", "status", "exit_code"]})
+            self.assertIn({"type": "progress", "unit": "file", "done": 2, "total": 2},
+                          [{key: event.get(key) for key in ["type", "unit", "done", "total"]} for event in job_events])
+            self.assertIn("Migration completed successfully", [event.get("message") for event in job_events])
+
+            with open(os.path.join(destination, "Assets", "Player.gd")) as translated_file:
+                self.assertIn("public class Player", translated_file.read())
+
+    def test_failed_job(self):
+        server = self._start_server("127.0.0.1:0")
+        client = MigrationServerClient(server.address)
+
+        job = client.submit(os.path.join(self.temp_dir.name, "missing"), self.source, os.path.join(self.temp_dir.name, "godot"))
+        events = list(client.events(job["id"]))
+
+        self.assertEqual("failed", events[-1]["status"])
+        self.assertEqual(78, events[-1]["exit_code"])
+        self.assertTrue(any(event["type"] == "log" and event["level"] == "error" for event in events))
+
+        with self.assertRaises(RuntimeError):
+            client.job("0123456789ab")
+
+    def test_finished_jobs_are_evicted(self):
+        server = self._start_server("127.0.0.1:0", max_finished_jobs=1)
+
+        jobs = []
+        for ix in range(3):
+            jobs.append(server.submit(self.config_name, self.source, os.path.join(self.temp_dir.name, f"godot{ix}")))
+            list(jobs[-1].events())
+
+        self.assertEqual([jobs[-1].id], [job.id for job in server.jobs()])
+        self.assertIsNone(server.job(jobs[0].id))
+
+    def test_events_are_capped(self):
+        job = MigrationJob(self.config_name, self.source, os.path.join(self.temp_dir.name, "godot"), max_events=3)
+        events = job.events()
+
+        job.add_event({"type": "log", "level": "info", "message": "first"})
+        self.assertEqual("first", next(events)["message"])
+
+        for message in ["second", "third", "fourth", "fifth"]:
+            job.add_event({"type": "log", "level": "info", "message": message})
+        job._set_status("succeeded")
+
+        self.assertEqual(["fourth", "fifth", None], [event.get("message") for event in events])
+        self.assertEqual(3, len(list(job.events())))
+
+    def test_submit_migration(self):
+        server = self._start_server("127.0.0.1:0")
+
+        self.assertEqual(0, submit_migration(server.address, self.config_name, self.source, os.path.join(self.temp_dir.name, "godot")))
+        self.assertTrue(os.path.isfile(os.path.join(self.temp_dir.name, "godot", "Assets", "Enemy.gd")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import wait
+
+from unifree.llms.supervised_worker_pool import SupervisedWorkerPool, WorkerTimeoutError, WorkerCrashedError
+
+
+def _init_worker() -> None:
+    pass
+
+
+def _init_worker_unless_broken(broken_flag_path: str) -> None:
+    if os.path.exists(broken_flag_path):
+        os._exit(1)  # i.e. out of memory while loading a model
+
+
+def _handle(payload: str):
+    if payload.startswith("sleep:"):
+        time.sleep(float(payload[len("sleep:"):]))
+        return os.getpid()
+    if payload == "crash":
+        os._exit(1)
+    if payload == "fail":
+        raise ValueError("failed")
+    if payload == "pid":
+        return os.getpid()
+    if payload.startswith("break:"):
+        open(payload[len("break:"):], 'w').close()
+        os._exit(1)
+
+    return payload
+
+
+class TestSupervisedWorkerPool(unittest.TestCase):
+    def setUp(self) -> None:
+        self.pool = SupervisedWorkerPool(
+            worker_count=2,
+            initializer=_init_worker,
+            initargs=(),
+            handler=_handle,
+            task_timeout_sec=1,
+        )
+
+    def tearDown(self) -> None:
+        self.pool.shutdown()
+
+    def test_submit(self):
+        futures = [self.pool.submit(f"task {ix}") for ix in range(50)]
+
+        self.assertEqual([f"task {ix}" for ix in range(50)], [future.result(timeout=10) for future in futures])
+
+        health = self.pool.health()
+        self.assertEqual(50, sum(worker["completed"] for worker in health["workers"]))
+        self.assertTrue(all(worker["alive"] and worker["ready"] for worker in health["workers"]))
+        self.assertTrue(all(worker["queue_depth"] == 0 for worker in health["workers"]))
+
+    def test_handler_exception(self):
+        with self.assertRaises(ValueError):
+            self.pool.submit("fail").result(timeout=10)
+
+        self.assertEqual("ok", self.pool.submit("ok").result(timeout=10))
+
+    def test_least_loaded_dispatch(self):
+        busy_future = self.pool.submit("sleep:0.5")
+
+        # The busy worker has a longer queue, so both tasks go to the other worker
+        first_pid = self.pool.submit("pid").result(timeout=10)
+        second_pid = self.pool.submit("pid").result(timeout=10)
+
+        self.assertEqual(first_pid, second_pid)
+        self.assertNotEqual(first_pid, busy_future.result(timeout=10))
+
+    def test_timed_out_worker_is_restarted(self):
+        stuck_future = self.pool.submit("sleep:60")
+        queued_futures = [self.pool.submit(f"task {ix}") for ix in range(6)]
+
+        start_time = time.monotonic()
+        with self.assertRaises(WorkerTimeoutError):
+            stuck_future.result(timeout=10)
+        self.assertLess(time.monotonic() - start_time, 5)
+
+        # Tasks queued behind the stuck one are run by the replacement worker
+        self.assertEqual([f"task {ix}" for ix in range(6)], [future.result(timeout=10) for future in queued_futures])
+
+        health = self.pool.health()
+        self.assertEqual(1, health["timeouts"])
+        self.assertEqual(1, sum(worker["restarts"] for worker in health["workers"]))
+        self.assertTrue(all(worker["alive"] for worker in health["workers"]))
+
+    def test_crashed_worker_is_restarted(self):
+        crash_future = self.pool.submit("crash")
+        queued_futures = [self.pool.submit(f"task {ix}") for ix in range(6)]
+
+        with self.assertRaises(WorkerCrashedError):
+            crash_future.result(timeout=10)
+
+        done, not_done = wait(queued_futures, timeout=10)
+        self.assertEqual(0, len(not_done))
+        self.assertEqual([f"task {ix}" for ix in range(6)], [future.result() for future in queued_futures])
+
+        health = self.pool.health()
+        self.assertEqual(1, health["crashes"])
+        self.assertEqual(0, health["timeouts"])
+
+    def test_workers_not_restarted(self):
+        pool = SupervisedWorkerPool(worker_count=2, initializer=_init_worker, initargs=(), handler=_handle, restart_workers=False)
+        self.addCleanup(pool.shutdown)
+
+        # Both workers have to be ready, so the crash is not taken for a start failure
+        deadline = time.monotonic() + 10
+        while not all(worker["ready"] for worker in pool.health()["workers"]) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        with self.assertRaises(WorkerCrashedError):
+            pool.submit("crash").result(timeout=10)
+        self.assertEqual(["task 0", "task 1"], [pool.submit(f"task {ix}").result(timeout=10) for ix in range(2)])
+
+        with self.assertRaises(WorkerCrashedError):
+            pool.submit("crash").result(timeout=10)
+        with self.assertRaises(WorkerCrashedError) as context:
+            pool.submit("task").result(timeout=10)
+
+        self.assertIn("not restarted", str(context.exception))
+        health = pool.health()
+        self.assertEqual([True, True], [worker["failed"] for worker in health["workers"]])
+        self.assertEqual(0, sum(worker["restarts"] for worker in health["workers"]))
+
+
+class TestSupervisedWorkerPoolStartFailures(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.broken_flag_path = os.path.join(self.temp_dir.name, "broken")
+
+    def _create_pool(self, worker_count: int) -> SupervisedWorkerPool:
+        pool = SupervisedWorkerPool(
+            worker_count=worker_count,
+            initializer=_init_worker_unless_broken,
+            initargs=(self.broken_flag_path,),
+            handler=_handle,
+            task_timeout_sec=5,
+            max_start_failures=3,
+            restart_backoff_sec=0.05,
+        )
+        self.addCleanup(pool.shutdown)
+
+        return pool
+
+    def test_tasks_move_to_healthy_worker(self):
+        pool = self._create_pool(2)
+        self.assertEqual("ready", pool.submit("ready").result(timeout=10))
+
+        # Both workers have to start before replacements fail
+        deadline = time.monotonic() + 10
+        while not all(worker["ready"] for worker in pool.health()["workers"]) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        # The worker that gets the task exits, every replacement fails to start
+        break_future = pool.submit(f"break:{self.broken_flag_path}")
+        queued_futures = [pool.submit(f"task {ix}") for ix in range(6)]
+
+        with self.assertRaises(WorkerCrashedError):
+            break_future.result(timeout=10)
+        self.assertEqual([f"task {ix}" for ix in range(6)], [future.result(timeout=10) for future in queued_futures])
+
+        deadline = time.monotonic() + 10
+        while not any(worker["failed"] for worker in pool.health()["workers"]) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        health = pool.health()
+        self.assertEqual([False, True], sorted(worker["failed"] for worker in health["workers"]))
+        self.assertEqual("after", pool.submit("after").result(timeout=10))
+
+    def test_queued_tasks_fail_when_no_worker_starts(self):
+        open(self.broken_flag_path, 'w').close()
+        pool = self._create_pool(1)
+
+        start_time = time.monotonic()
+        with self.assertRaises(WorkerCrashedError):
+            pool.submit("task").result(timeout=10)
+        self.assertLess(time.monotonic() - start_time, 5)
+
+        self.assertTrue(pool.health()["workers"][0]["failed"])
+        with self.assertRaises(WorkerCrashedError):
+            pool.submit("task").result(timeout=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
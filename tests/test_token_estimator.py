@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import unittest
+from typing import Optional, List
+
+from unifree import LLM, QueryHistoryItem
+from unifree.token_estimator import TokenEstimator
+
+
+class FourBytesPerTokenLLM(LLM):
+    exact_count_calls: int = 0
+
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        return user
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        return token_count <= 1_000
+
+    def count_tokens(self, source_text: str) -> int:
+        self.exact_count_calls += 1
+        return len(source_text) // 4
+
+    def initialize(self) -> None:
+        pass
+
+
+class TestTokenEstimator(unittest.TestCase):
+    def test_estimate_with_default_ratio(self):
+        estimator = TokenEstimator(default_bytes_per_token=2.0)
+
+        self.assertTrue(estimator.needs_calibration)
+        self.assertEqual(5, estimator.estimate("a" * 10))
+
+    def test_calibration(self):
+        estimator = TokenEstimator(default_bytes_per_token=2.0, calibration_sample_count=2)
+        estimator.add_sample("a" * 100, 20)
+        estimator.add_sample("b" * 300, 60)
+
+        self.assertFalse(estimator.needs_calibration)
+        self.assertAlmostEqual(5.0, estimator.bytes_per_token)
+        self.assertEqual(10, estimator.estimate("c" * 50))
+
+    def test_estimate_counts_utf8_bytes(self):
+        estimator = TokenEstimator(default_bytes_per_token=1.0)
+        self.assertEqual(4, estimator.estimate("abé"))
+
+
+class TestLLMTokenEstimates(unittest.TestCase):
+    def test_estimate_tokens_calibrates_backend(self):
+        llm = FourBytesPerTokenLLM({"config": {"model": "calibrated"}})
+
+        for _ in range(16):
+            self.assertEqual(10, llm.estimate_tokens("a" * 40))
+        self.assertEqual(16, llm.exact_count_calls)
+
+        self.assertEqual(25, llm.estimate_tokens("a" * 100))
+        self.assertEqual(16, llm.exact_count_calls)
+
+    def test_text_fits_in_one_prompt_counts_exactly_near_limit(self):
+        llm = FourBytesPerTokenLLM({"config": {"model": "near-limit", "token_estimate_margin": 0.1}})
+        llm.estimate_tokens_batch(["a" * 400] * 16)
+        llm.exact_count_calls = 0
+
+        self.assertTrue(llm.text_fits_in_one_prompt("a" * 400))
+        self.assertFalse(llm.text_fits_in_one_prompt("a" * 8_000))
+        self.assertEqual(0, llm.exact_count_calls)
+
+        self.assertTrue(llm.text_fits_in_one_prompt("a" * 3_600, extra_token_count=100))
+        self.assertFalse(llm.text_fits_in_one_prompt("a" * 3_600, extra_token_count=101))
+        self.assertEqual(2, llm.exact_count_calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import unittest
+
+from unifree.llms.transformers_model import TransformersModel
+
+
+class TestTransformersModel(unittest.TestCase):
+    def setUp(self) -> None:
+        try:
+            import torch
+            from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+            from transformers import PreTrainedTokenizerFast, GPT2Config, GPT2LMHeadModel
+        except ImportError:
+            self.skipTest("transformers is not installed")
+
+        words = ["[PAD]", "[UNK]", "[EOS]"] + [f"w{ix}" for ix in range(50)]
+
+        tokenizer = Tokenizer(models.WordLevel({word: ix for ix, word in enumerate(words)}, unk_token="[UNK]"))
+        tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        tokenizer.decoder = decoders.WordPiece()
+
+        # Tiny randomly initialized model, it only has to produce deterministic tokens
+        torch.manual_seed(0)
+        model = GPT2LMHeadModel(GPT2Config(
+            vocab_size=len(words), n_positions=64, n_embd=16, n_layer=1, n_head=2,
+            bos_token_id=2, eos_token_id=2, pad_token_id=0,
+        ))
+        model.eval()
+
+        self.model = TransformersModel(model, PreTrainedTokenizerFast(
+            tokenizer_object=tokenizer, unk_token="[UNK]", pad_token="[PAD]", eos_token="[EOS]",
+        ))
+        self.cached_model = TransformersModel(model, self.model._tokenizer, prefix_cache_mb=1)
+
+    def test_batch_matches_single_generation(self):
+        prompts = ["w1 w2 w3 w4", "w5", "w6 w7"]
+
+        batched = self.model.generate_batch(prompts, [None] * len(prompts), max_new_tokens=6)
+        single = [self.model.generate_batch([prompt], [None], max_new_tokens=6)[0] for prompt in prompts]
+
+        self.assertEqual(single, batched)
+        self.assertTrue(all(len(response.split()) <= 6 for response in batched))
+
+    def test_fragment_callback_stops_one_sequence(self):
+        fragments = []
+
+        def stop_after_first(fragment: str) -> bool:
+            fragments.append(fragment)
+            return True
+
+        responses = self.model.generate_batch(["w1 w2", "w3"], [stop_after_first, None], max_new_tokens=8)
+
+        self.assertEqual(1, len(fragments))
+        self.assertEqual(fragments[0], responses[0])
+        self.assertEqual(1, len(responses[0].split()))
+
+    def test_prefix_cache(self):
+        prefix = "w1 w2 w3 w4 w5 w6 "
+        prompts = [prefix + "w7 w8", prefix + "w9", "w10 " + prefix]
+        prefix_lengths = [len(prefix), len(prefix), 0]
+
+        expected = self.model.generate_batch(prompts, [None] * len(prompts), max_new_tokens=6)
+
+        for _ in range(2):
+            responses = self.cached_model.generate_batch(prompts, [None] * len(prompts), prefix_lengths, max_new_tokens=6)
+            self.assertEqual(expected, responses)
+
+        self.assertEqual(1, len(self.cached_model._prefix_cache))
+
+    def test_prefix_cache_memory_limit(self):
+        # 1 layer * (keys + values) * 16 floats = 128 bytes per token, so ~80 tokens fit into the cache
+        cached_model = TransformersModel(self.model._model, self.model._tokenizer, prefix_cache_mb=0.01)
+
+        prefixes = [f"w{ix} w{ix + 1} w{ix + 2} " * 10 for ix in range(0, 40, 4)]
+        for prefix in prefixes:
+            cached_model.generate_batch([prefix + "w1"], [None], [len(prefix)], max_new_tokens=1)
+
+        self.assertEqual(2, len(cached_model._prefix_cache))
+        self.assertLessEqual(cached_model._prefix_cache.total_size, 0.01 * 1024 * 1024)
+
+    def test_tokenize(self):
+        self.assertEqual([4, 5], self.model.tokenize("w1 w2"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import os
+import tempfile
+import unittest
+from typing import Optional, List
+
+import unifree
+from unifree import LLM, QueryHistoryItem
+from unifree.csharp_migration_strategies import CSharpCompilationUnitToSingleFileWithLLM
+from unifree.translation_memory import TranslationMemory, NormalizedCode
+from unifree.utils import to_default_dict
+
+_START = """
+void Start()
+{
+    // Initial speed
+    moveSpeed = 5f;
+}
+"""
+
+_START_TRANSLATION = "```\nfunc _ready():\n\tmove_speed = 5.0\n```"
+
+
+class TestTranslationMemory(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.path = os.path.join(self.temp_dir.name, "memory.sqlite")
+        self.memory = TranslationMemory(self.path)
+
+    def test_normalized_code(self):
+        self.assertEqual(NormalizedCode("int a = b + 1;").text, NormalizedCode("int  x=y+1; // Comment").text)
+        self.assertEqual(["x", "y"], NormalizedCode("int  x=y+1; // Comment").identifiers)
+
+        self.assertNotEqual(NormalizedCode("int a = b + 1;").text, NormalizedCode("int a = b + 2;").text)
+        self.assertNotEqual(NormalizedCode("int a = b + 1;").text, NormalizedCode("float a = b + 1;").text)
+        self.assertNotEqual(NormalizedCode("int a = a + 1;").text, NormalizedCode("int a = b + 1;").text)
+
+    def test_exact_and_renamed_matches(self):
+        self.memory.record("scope", _START, _START_TRANSLATION)
+
+        self.assertEqual(_START_TRANSLATION, self.memory.lookup("scope", _START))
+        self.assertEqual(_START_TRANSLATION, self.memory.lookup("scope", "void Start() { moveSpeed = 5f; }"))
+        self.assertEqual("```\nfunc _ready():\n\twalk_speed = 5.0\n```", self.memory.lookup("scope", _START.replace("moveSpeed", "walkSpeed")))
+
+        self.assertIsNone(self.memory.lookup("other scope", _START))
+        self.assertIsNone(self.memory.lookup("scope", _START.replace("5f", "6f")))
+
+        # 'Start' is not in the translation, so the translation does not carry over to 'Awake'
+        self.assertIsNone(self.memory.lookup("scope", _START.replace("Start", "Awake")))
+
+    def test_persistence(self):
+        self.memory.record("scope", _START, _START_TRANSLATION)
+
+        self.assertEqual(_START_TRANSLATION, TranslationMemory(self.path).lookup("scope", _START))
+
+    def test_strategy_skips_llm(self):
+        config = to_default_dict({
+            "source": {"csharp": {"convert_macros_to_comments": True}},
+            "target": {"extension": ".gd"},
+            "prompts": {"system": "System Prompt", "full": "Translate ${CODE}"},
+            "llm": {"class": "TrivialLLM"},
+            "translation_memory": {"path": self.path},
+        })
+
+        source_path = os.path.join(self.temp_dir.name, "Player.cs")
+        with open(source_path, 'w') as source_file:
+            source_file.write("public class Player\n{\n    float moveSpeed;\n}\n")
+
+        strategy = _FencingLLMStrategy(unifree.FileMigrationSpec(source_path, self.temp_dir.name, self.temp_dir.name), config)
+        strategy.execute()
+        self.assertEqual(1, strategy.llm.query_count)
+
+        strategy = _FencingLLMStrategy(unifree.FileMigrationSpec(source_path, self.temp_dir.name, self.temp_dir.name), config)
+        strategy.execute()
+        self.assertEqual(0, strategy.llm.query_count)
+        self.assertEqual("class_name Player\nvar moveSpeed", strategy.saved_content)
+
+
+class _FencingLLM(LLM):
+    query_count: int = 0
+
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        self.query_count += 1
+        return "```\nclass_name Player\nvar moveSpeed\n```"
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        return True
+
+    def count_tokens(self, source_text: str) -> int:
+        return len(source_text)
+
+    def initialize(self) -> None:
+        pass
+
+
+class _FencingLLMStrategy(CSharpCompilationUnitToSingleFileWithLLM):
+    saved_content: str
+
+    def load_llm(self) -> LLM:
+        return _FencingLLM(self.config)
+
+    def save_content(self, content: str, target_file_path: str):
+        self.saved_content = content
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+from unifree import FileMigrationSpec
+from unifree.unity_scene_migration_strategies import UnityYamlToGodotScene
+from unifree.unity_yaml import read_unity_documents, parse_unity_yaml_block
+from unifree.utils import to_default_dict, migration_scope
+
+_CONFIG = {"target": {"extension": ".gd"}}
+
+_ENEMY_PREFAB = """%YAML 1.1
+%TAG !u! tag:unity3d.com,2011:
+--- !u!1 &1000
+GameObject:
+  m_Component:
+  - component: {fileID: 4000}
+  - component: {fileID: 13600}
+  m_Name: Enemy
+  m_IsActive: 1
+--- !u!4 &4000
+Transform:
+  m_GameObject: {fileID: 1000}
+  m_LocalRotation: {x: 0, y: 0, z: 0, w: 1}
+  m_LocalPosition: {x: 0, y: 0, z: 0}
+  m_LocalScale: {x: 1, y: 1, z: 1}
+  m_Children:
+  - {fileID: 4002}
+  m_Father: {fileID: 0}
+--- !u!136 &13600
+CapsuleCollider:
+  m_GameObject: {fileID: 1000}
+  m_Radius: 0.5
+  m_Height: 2
+  m_Direction: 1
+  m_Center: {x: 0, y: 1, z: 0}
+--- !u!1 &1002
+GameObject:
+  m_Component:
+  - component: {fileID: 4002}
+  - component: {fileID: 21200}
+  m_Name: Body
+  m_IsActive: 1
+--- !u!4 &4002
+Transform:
+  m_GameObject: {fileID: 1002}
+  m_LocalRotation: {x: 0, y: 0, z: 0, w: 1}
+  m_LocalPosition: {x: 0, y: 1, z: 0.5}
+  m_LocalScale: {x: 1, y: 1, z: 1}
+  m_Children: []
+  m_Father: {fileID: 4000}
+--- !u!212 &21200
+SpriteRenderer:
+  m_GameObject: {fileID: 1002}
+  m_Color: {r: 1, g: 1, b: 1, a: 0.5}
+  m_FlipX: 1
+  m_FlipY: 0
+"""
+
+_BULKY_OBJECT = """--- !u!1 &{id}
+GameObject:
+  m_Component:
+  - component: {{fileID: {transform_id}}}
+  - component: {{fileID: {renderer_id}}}
+  - component: {{fileID: {script_id}}}
+  m_Name: Tree ({ix})
+  m_IsActive: 1
+--- !u!4 &{transform_id}
+Transform:
+  m_GameObject: {{fileID: {id}}}
+  m_LocalRotation: {{x: 0, y: 0.38268343, z: 0, w: 0.9238795}}
+  m_LocalPosition: {{x: {ix}, y: 0, z: -{ix}.5}}
+  m_LocalScale: {{x: 1, y: 1, z: 1}}
+  m_Children: []
+  m_Father: {{fileID: {father_id}}}
+  m_RootOrder: {ix}
+--- !u!23 &{renderer_id}
+MeshRenderer:
+  m_GameObject: {{fileID: {id}}}
+  m_Enabled: 1
+  m_Materials:
+  - {{fileID: 2100000, guid: 31321ba15b8f8eb4c954353edc038b1d, type: 2}}
+  m_LightmapParameters: {{fileID: 0}}
+--- !u!114 &{script_id}
+MonoBehaviour:
+  m_GameObject: {{fileID: {id}}}
+  m_Enabled: 1
+  m_Script: {{fileID: 11500000, guid: 0123456789abcdef0123456789abcdef, type: 3}}
+  description: 'A tree that sways in the wind, it''s one of many trees of the forest'
+  waypoints:
+{waypoints}"""
+
+
+class TestUnityYaml(unittest.TestCase):
+    def test_parse_block(self):
+        lines = [
+            "m_Name: 'It''s a: name'",
+            "m_Text: a text that",
+            "  continues here",
+            "m_Empty: ",
+            "m_Children:",
+            "- {fileID: 12}",
+            "- {fileID: 13}",
+            "m_Modifications:",
+            "- target: {fileID: 4000, guid: abc, type: 3}",
+            "  propertyPath: m_LocalPosition.x",
+            "  value: 3",
+            "m_Shadows:",
+            "  m_Type: 2",
+            "  m_Values: [1, 2, {a: b}]",
+            "m_Items:",
+            "  - 1",
+            "  - \"quoted \\\"value\\\"\"",
+            "  - \"C:\\\\new\\nline\"",
+        ]
+
+        self.assertEqual({
+            "m_Name": "It's a: name",
+            "m_Text": "a text that continues here",
+            "m_Empty": None,
+            "m_Children": [{"fileID": "12"}, {"fileID": "13"}],
+            "m_Modifications": [{"target": {"fileID": "4000", "guid": "abc", "type": "3"}, "propertyPath": "m_LocalPosition.x", "value": "3"}],
+            "m_Shadows": {"m_Type": "2", "m_Values": ["1", "2", {"a": "b"}]},
+            "m_Items": ["1", 'quoted "value"', "C:\\new\nline"],
+        }, parse_unity_yaml_block(lines))
+
+    def test_read_documents(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            prefab_path = os.path.join(temp_dir, "Enemy.prefab")
+            with open(prefab_path, 'w') as prefab_file:
+                prefab_file.write(_ENEMY_PREFAB)
+
+            documents = list(read_unity_documents(prefab_path))
+            self.assertEqual(["GameObject", "Transform", "CapsuleCollider", "GameObject", "Transform", "SpriteRenderer"],
+                             [document.type_name for document in documents])
+            self.assertEqual((136, 13600, False), (documents[2].class_id, documents[2].file_id, documents[2].stripped))
+            self.assertEqual({"x": "0", "y": "1", "z": "0.5"}, documents[4].properties["m_LocalPosition"])
+
+            filtered = list(read_unity_documents(prefab_path, {"GameObject": {"m_Name"}, "SpriteRenderer": None}))
+            self.assertEqual([{"m_Name": "Enemy"}, {"m_Name": "Body"}], [document.properties for document in filtered[:2]])
+            self.assertEqual("SpriteRenderer", filtered[2].type_name)
+            self.assertEqual({"r": "1", "g": "1", "b": "1", "a": "0.5"}, filtered[2].properties["m_Color"])
+
+
+class TestUnityYamlToGodotScene(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.source = os.path.join(self.temp_dir.name, "unity")
+        self.destination = os.path.join(self.temp_dir.name, "godot")
+        for folder in ["Scenes", "Scripts", "Prefabs"]:
+            os.makedirs(os.path.join(self.source, "Assets", folder))
+
+        shutil.copy(os.path.join(os.path.dirname(__file__), "resources", "Level.unity"), os.path.join(self.source, "Assets", "Scenes"))
+        with open(os.path.join(self.source, "Assets", "Prefabs", "Enemy.prefab"), 'w') as prefab_file:
+            prefab_file.write(_ENEMY_PREFAB)
+
+        for asset_path, guid in [("Scripts/CrateController.cs", "0123456789abcdef0123456789abcdef"), ("Prefabs/Enemy.prefab", "fedcba9876543210fedcba9876543210")]:
+            with open(os.path.join(self.source, "Assets", asset_path + ".meta"), 'w') as meta_file:
+                meta_file.write(f"fileFormatVersion: 2\nguid: {guid}\n")
+
+    def _migrate(self, relative_path: str, config=None) -> str:
+        strategy = UnityYamlToGodotScene(
+            FileMigrationSpec(os.path.join(self.source, relative_path), self.source, self.destination),
+            to_default_dict(config or _CONFIG),
+        )
+        strategy.execute()
+
+        with open(strategy.destination_file_path) as scene_file:
+            return scene_file.read()
+
+    def test_scene(self):
+        self.assertEqual("""[gd_scene load_steps=4 format=3]
+
+[ext_resource type="Script" path="res://Assets/Scripts/CrateController.gd" id="1"]
+[ext_resource type="PackedScene" path="res://Assets/Prefabs/Enemy.tscn" id="2"]
+
+[sub_resource type="BoxShape3D" id="BoxShape3D_1"]
+size = Vector3(1, 1, 1)
+
+[node name="Level" type="Node3D"]
+
+[node name="Main Camera" type="Camera3D" parent="."]
+transform = Transform3D(1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 1, 10)
+fov = 60
+near = 0.3
+far = 1000
+
+[node name="Crate" type="RigidBody3D" parent="."]
+transform = Transform3D(0, 0, -2, 0, 2, 0, 2, 0, 0, 2, 0.5, -3)
+mass = 5
+script = ExtResource("1")
+
+[node name="MeshInstance3D" type="MeshInstance3D" parent="Crate"]
+
+[node name="CollisionShape3D" type="CollisionShape3D" parent="Crate"]
+shape = SubResource("BoxShape3D_1")
+
+[node name="Light_Bulb" type="OmniLight3D" parent="Crate"]
+transform = Transform3D(1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 1, 0)
+light_color = Color(1, 0.5, 0, 1)
+light_energy = 2
+shadow_enabled = true
+omni_range = 8
+visible = false
+
+[node name="Enemy (1)" parent="." instance=ExtResource("2")]
+transform = Transform3D(1, 0, 0, 0, 1, 0, 0, 0, 1, 3, 0, 0)
+
+[node name="Enemy (1)" type="Node3D" parent="Enemy (1)"]
+transform = Transform3D(1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 2, 0)
+
+""", self._migrate(os.path.join("Assets", "Scenes", "Level.unity")))
+
+    def test_prefab(self):
+        config = {"target": {"extension": ".gd", "lower_folder_names": True}}
+        self.assertEqual("""[gd_scene load_steps=2 format=3]
+
+[sub_resource type="CapsuleShape3D" id="CapsuleShape3D_1"]
+radius = 0.5
+height = 2
+
+[node name="Enemy" type="StaticBody3D"]
+
+[node name="CollisionShape3D" type="CollisionShape3D" parent="."]
+transform = Transform3D(1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 1, 0)
+shape = SubResource("CapsuleShape3D_1")
+
+[node name="Body" type="Sprite3D" parent="."]
+transform = Transform3D(1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 1, -0.5)
+modulate = Color(1, 1, 1, 0.5)
+flip_h = true
+
+""", self._migrate(os.path.join("Assets", "Prefabs", "Enemy.prefab"), config))
+        self.assertTrue(os.path.isfile(os.path.join(self.destination, "assets", "prefabs", "Enemy.tscn")))
+
+    def test_asset_guids_are_read_per_migration(self):
+        strategy = UnityYamlToGodotScene(
+            FileMigrationSpec(os.path.join(self.source, "Assets", "Scenes", "Level.unity"), self.source, self.destination),
+            to_default_dict(_CONFIG),
+        )
+        with migration_scope():
+            self.assertNotIn("0123456789abcdef", strategy._asset_paths_by_guid())
+
+        with open(os.path.join(self.source, "Assets", "Added.cs.meta"), 'w') as meta_file:
+            meta_file.write("fileFormatVersion: 2\nguid: 0123456789abcdef\n")
+
+        with migration_scope():
+            self.assertEqual(os.path.join("Assets", "Added.cs"), strategy._asset_paths_by_guid()["0123456789abcdef"])
+
+    @unittest.skipUnless(os.environ.get("UNIFREE_BENCHMARKS"), "Benchmark, set UNIFREE_BENCHMARKS=1 to run it")
+    def test_benchmark(self):
+        """
+        Throughput and memory of a large scene, most of its size is script data that is not part of the Godot scene
+        """
+        scene_path = os.path.join(self.source, "Assets", "Scenes", "Forest.unity")
+        with open(scene_path, 'w') as scene_file:
+            scene_file.write("%YAML 1.1\n%TAG !u! tag:unity3d.com,2011:\n")
+            waypoints = "".join(f"  - {{x: {ix}.25, y: 0, z: {ix}.75}}\n" for ix in range(200))
+            for ix in range(5_000):
+                object_id = 10 * (ix + 1)
+                scene_file.write(_BULKY_OBJECT.format(id=object_id, transform_id=object_id + 1, renderer_id=object_id + 2, script_id=object_id + 3,
+                                                      father_id=11 if ix > 0 and ix % 100 else 0, ix=ix, waypoints=waypoints))
+
+        file_size = os.path.getsize(scene_path)
+
+        start_time = time.perf_counter()
+        tscn = self._migrate(os.path.join("Assets", "Scenes", "Forest.unity"))
+        migration_time = time.perf_counter() - start_time
+
+        tracemalloc.start()
+        try:
+            self._migrate(os.path.join("Assets", "Scenes", "Forest.unity"))
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        throughput = file_size / migration_time / 1024 / 1024
+
+        self.assertEqual(5_000, tscn.count('type="MeshInstance3D"'))
+        self.assertEqual(5_000, tscn.count('script = ExtResource("1")'))
+        self.assertIn('[node name="Tree (1)" type="MeshInstance3D" parent="Tree (0)"]', tscn)
+        self.assertGreater(throughput, 5)
+        # Only the object graph is held in memory, not the documents
+        self.assertLess(peak_memory, file_size / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import unittest
+
+from unifree import log
+from unifree.project_migration_strategies import ConcurrentMigrationStrategy
+from unifree.utils import LruCache, increment_statistic, get_statistics, statistics_scope, to_default_dict
+
+
+class TestLruCache(unittest.TestCase):
+    def test_max_size(self):
+        cache = LruCache[str](max_size=2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        self.assertEqual("A", cache.get("a"))
+
+        cache.put("c", "C")  # Evicts 'b', 'a' was used more recently
+
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual("A", cache.get("a"))
+        self.assertEqual("C", cache.get("c"))
+
+    def test_size_of(self):
+        cache = LruCache[str](max_size=10, size_of=len)
+        cache.put("a", "aaaa")
+        cache.put("b", "bbbb")
+        cache.put("a", "aaaaa")
+        self.assertEqual(9, cache.total_size)
+
+        cache.put("c", "cc")  # Evicts 'b'
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(7, cache.total_size)
+
+        cache.put("d", "d" * 11)  # Too large to be cached at all
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(2, len(cache))
+
+
+class TestStatisticsScope(unittest.TestCase):
+    def test_scopes_propagate_to_workers(self):
+        class Mapper(ConcurrentMigrationStrategy):
+            def execute(self) -> None:
+                pass
+
+        def work(value: int) -> int:
+            increment_statistic("Scoped statistic", value)
+            log.info(f"Worked on {value}")
+            return value
+
+        events = []
+        with statistics_scope() as first_statistics, log.event_listener(events.append):
+            results = list(Mapper(to_default_dict({})).map_concurrently(work, [1, 2, 3], max_workers=3, unit='value', disable=True))
+
+            with statistics_scope() as second_statistics:
+                increment_statistic("Scoped statistic", 10)
+
+        self.assertEqual([1, 2, 3], results)
+        self.assertEqual({"Scoped statistic": 6}, first_statistics)
+        self.assertEqual({"Scoped statistic": 10}, second_statistics)
+        self.assertGreaterEqual(get_statistics().get("Scoped statistic"), 16)
+
+        self.assertEqual({"Worked on 1", "Worked on 2", "Worked on 3"}, {event["message"] for event in events if event["type"] == "log"})
+        self.assertEqual([1, 2, 3], sorted(event["done"] for event in events if event["type"] == "progress"))
+
+
+    def test_log_level_scope(self):
+        self.assertFalse(log.is_debug())
+        with log.log_level_scope('debug'):
+            self.assertTrue(log.is_debug())
+        self.assertFalse(log.is_debug())
+
+
+if __name__ == '__main__':
+    unittest.main()
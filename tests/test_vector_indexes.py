@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from unifree.vector_indexes import ExactVectorIndex, IvfVectorIndex, open_vector_index
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def _clustered_corpus(rng: np.random.Generator, size: int, dimensions: int, cluster_count: int) -> np.ndarray:
+    centers = rng.standard_normal((cluster_count, dimensions))
+    return _normalized(centers[rng.integers(0, cluster_count, size)] + 0.6 * rng.standard_normal((size, dimensions)))
+
+
+class TestVectorIndexes(unittest.TestCase):
+    def test_exact_search(self):
+        for quantization in [None, "float16", "int8"]:
+            with self.subTest(quantization=quantization):
+                index = ExactVectorIndex(quantization=quantization)
+                index.add(["x", "y", "xy"], _normalized(np.array([[1, 0], [0, 1], [1, 1]], dtype=np.float32)),
+                          [{"name": "x"}, {"name": "y"}, {"name": "xy"}])
+
+                hits = index.search(_normalized(np.array([[1, 0.1], [0.1, 1]], dtype=np.float32)), 2)
+
+                self.assertEqual([["x", "xy"], ["y", "xy"]], [[hit.id for hit in query_hits] for query_hits in hits])
+                self.assertEqual({"name": "x"}, hits[0][0].payload)
+                self.assertAlmostEqual(0.995, hits[0][0].similarity, places=2)
+
+                index.remove(["x"])
+                self.assertEqual(["y", "xy"], index.ids())
+                self.assertEqual("xy", index.search(_normalized(np.array([[1, 0.1]], dtype=np.float32)), 1)[0][0].id)
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            vectors = _clustered_corpus(np.random.default_rng(0), 300, 16, 8)
+            ids = [str(ix) for ix in range(len(vectors))]
+
+            index = open_vector_index({"type": "ivf", "quantization": "int8"}, temp_dir, "test")
+            index._min_train_size = 100
+            index.add(ids, vectors, [{"ix": vector_id} for vector_id in ids])
+            index.metadata["source_hash"] = "hash"
+            expected = [[hit.id for hit in hits] for hits in index.search(vectors[:5], 3)]
+            index.flush()
+
+            self.assertTrue(os.path.isfile(os.path.join(temp_dir, "test-ivf-int8.npz")))
+
+            reopened = open_vector_index({"type": "ivf", "quantization": "int8"}, temp_dir, "test")
+            self.assertEqual({"source_hash": "hash"}, reopened.metadata)
+            self.assertEqual(ids, reopened.ids())
+            self.assertIsNotNone(reopened._centroids)
+            self.assertEqual(expected, [[hit.id for hit in hits] for hits in reopened.search(vectors[:5], 3)])
+
+            # Different quantization does not reuse the vectors
+            self.assertEqual(0, len(open_vector_index({"type": "exact"}, temp_dir, "test")))
+
+    def test_ivf_below_training_size_is_exact(self):
+        vectors = _clustered_corpus(np.random.default_rng(1), 200, 16, 4)
+        ids = [str(ix) for ix in range(len(vectors))]
+
+        exact, ivf = ExactVectorIndex(), IvfVectorIndex(n_probe=1)
+        for index in [exact, ivf]:
+            index.add(ids, vectors, [{}] * len(ids))
+
+        self.assertEqual([[hit.id for hit in hits] for hits in exact.search(vectors[:10], 5)],
+                         [[hit.id for hit in hits] for hits in ivf.search(vectors[:10], 5)])
+        self.assertIsNone(ivf._centroids)
+
+    def test_ivf_concurrent_searches_train_once(self):
+        vectors = _clustered_corpus(np.random.default_rng(3), 400, 16, 8)
+        ids = [str(ix) for ix in range(len(vectors))]
+
+        index = IvfVectorIndex(n_probe=2, min_train_size=100)
+        index.add(ids, vectors, [{}] * len(ids))
+
+        train_count = 0
+        train_if_needed = index._train_if_needed
+
+        def counting_train_if_needed() -> None:
+            nonlocal train_count
+            trained_size = index._trained_size
+            train_if_needed()
+            train_count += index._trained_size != trained_size
+
+        index._train_if_needed = counting_train_if_needed
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda row: [hit.id for hit in index.search(vectors[row:row + 1], 3)[0]], range(32)))
+
+        self.assertEqual(1, train_count)
+        self.assertEqual([[hit.id for hit in hits] for hits in index.search(vectors[:32], 3)], results)
+
+    @unittest.skipUnless(os.environ.get("UNIFREE_BENCHMARKS"), "Benchmark, set UNIFREE_BENCHMARKS=1 to run it")
+    def test_benchmark(self):
+        """
+        Recall@10 against exact float32 search, query latency and memory on a synthetic clustered corpus of the size of
+        sentence transformer embeddings
+        """
+        rng = np.random.default_rng(2)
+        corpus = _clustered_corpus(rng, 20_000, 384, 200)
+        queries = _normalized(corpus[rng.integers(0, len(corpus), 200)] + 0.02 * rng.standard_normal((200, 384)))
+        ids = [str(ix) for ix in range(len(corpus))]
+        count = 10
+
+        reference = ExactVectorIndex()
+        reference.add(ids, corpus, [{}] * len(ids))
+        expected = [{hit.id for hit in hits} for hits in reference.search(queries, count)]
+
+        results = {}
+        for name, index in [("exact", reference),
+                            ("exact-int8", ExactVectorIndex(quantization="int8")),
+                            ("ivf-float16", IvfVectorIndex(quantization="float16", n_probe=8)),
+                            ("ivf-int8", IvfVectorIndex(quantization="int8", n_probe=8))]:
+            if index is not reference:
+                index.add(ids, corpus, [{}] * len(ids))
+            index.search(queries[:1], count)  # Train the inverted file
+
+            hits = index.search(queries, count)
+
+            start_time = time.perf_counter()
+            for query in queries[:20]:
+                index.search(query[np.newaxis, :], count)
+            single_ms = (time.perf_counter() - start_time) * 1000 / 20
+
+            recall = np.mean([len(expected_ids & {hit.id for hit in query_hits}) / count for expected_ids, query_hits in zip(expected, hits)])
+            results[name] = (recall, single_ms, index._vectors.nbytes)
+
+        self.assertGreater(results["exact-int8"][0], 0.95)
+        self.assertGreater(results["ivf-float16"][0], 0.8)
+        self.assertGreater(results["ivf-int8"][0], 0.8)
+
+        self.assertLess(results["ivf-int8"][1], results["exact"][1])
+        self.assertEqual(results["exact"][2] / 4, results["ivf-int8"][2])
+        self.assertEqual(results["exact"][2] / 2, results["ivf-float16"][2])
+
+
+if __name__ == '__main__':
+    unittest.main()
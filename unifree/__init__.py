@@ -3,9 +3,14 @@ import pathlib
 # Copyright (c) Unifree
 # This code is licensed under MIT license (see LICENSE.txt for details)
 
+import threading
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Callable, Iterator
+
+from unifree.token_estimator import TokenEstimator
 
 # =====================
 # Overall Configuration
@@ -53,9 +58,53 @@ class QueryHistoryItem:
     content: str
 
 
+@dataclass
+class QueryContext:
+    """
+    Describes the code translated by the LLM queries made within `query_context`. LLMs that pick a backend per query
+    (i.e. RoutingLLM) and LLMs that identify queries across runs (i.e. BatchJobLLM) use it, other LLMs ignore it.
+    """
+    chunk_kind: Optional[str] = None
+    """Prompt type of the query: 'full', 'class_only', 'methods_only' or 'batch'"""
+
+    complexity: int = 0
+    """Number of decision points (branches, loops, catch clauses, etc.) in the translated code"""
+
+    is_valid_response: Optional[Callable[[str], bool]] = None
+    """Checks that the result can be extracted from the response"""
+
+    create_on_fragment: Optional[Callable[[], Optional[Callable[[str], bool]]]] = None
+    """Creates a new fragment callback, for when the query has to be repeated"""
+
+    source_file_path: Optional[str] = None
+    """Path of the translated file, relative to the source project"""
+
+
+_query_context: ContextVar[Optional[QueryContext]] = ContextVar("query_context", default=None)
+
+
+@contextmanager
+def query_context(context: QueryContext) -> Iterator[QueryContext]:
+    """
+    Set the context of LLM queries made by the current thread within the `with` block
+    """
+    token = _query_context.set(context)
+    try:
+        yield context
+    finally:
+        _query_context.reset(token)
+
+
+def current_query_context() -> Optional[QueryContext]:
+    return _query_context.get()
+
+
 class LLM(ABC):
     _config: Dict
 
+    _token_estimators: Dict[str, TokenEstimator] = {}
+    _token_estimators_lock: threading.Lock = threading.Lock()
+
     def __init__(self, config: Dict) -> None:
         self._config = config
 
@@ -72,12 +121,44 @@ class LLM(ABC):
         """
         raise NotImplementedError
 
+    def query_streaming(
+            self,
+            user: str,
+            system: Optional[str] = None,
+            history: Optional[List[QueryHistoryItem]] = None,
+            on_fragment: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        """
+        Query LLM and pass fragments of the response to `on_fragment` as soon as they are generated. Generation is
+        stopped once `on_fragment` returns True.
+
+        This default implementation does not stream: it passes the whole response to `on_fragment` at once.
+
+        :param user:        The actual query.
+        :param system:      "System" query.
+        :param history:     User conversation history.
+        :param on_fragment: Callback receiving response fragments. Returns True when the rest of the response is not needed
+        :return: Response from the LLM generated up to the point it was stopped
+        """
+        response = self.query(user, system, history)
+        if on_fragment:
+            on_fragment(response)
+
+        return response
+
     def initialize(self) -> None:
         """
         Initialize the LLM
         """
         raise NotImplementedError
 
+    def initialize_tokenizer(self) -> None:
+        """
+        Initialize only what is needed to count tokens (`count_tokens`, `fits_in_one_prompt`), without loading the
+        model itself. Used by processes that never query the LLM. Default implementation initializes the whole LLM
+        """
+        self.initialize()
+
     def fits_in_one_prompt(self, token_count: int) -> bool:
         """
         Check if the given token count fits into one prompt
@@ -94,6 +175,81 @@ class LLM(ABC):
         """
         raise NotImplementedError
 
+    def count_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        """
+        Count number of tokens for each of the given source texts. Implementations could override it to count tokens
+        more efficiently than one by one
+        :param source_texts: Texts to count tokens in
+        :return: Number of tokens for each text
+        """
+        return [self.count_tokens(source_text) for source_text in source_texts]
+
+    def estimate_tokens(self, source_text: str) -> int:
+        """
+        Quickly estimate number of tokens for the given source text. The first texts are counted exactly to calibrate
+        the estimate for this backend
+        :param source_text: Text to estimate tokens in
+        :return: Estimated number of tokens
+        """
+        return self.estimate_tokens_batch([source_text])[0]
+
+    def estimate_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        """
+        Quickly estimate number of tokens for each of the given source texts
+        :param source_texts: Texts to estimate tokens in
+        :return: Estimated number of tokens for each text
+        """
+        token_estimator = self.token_estimator
+        if not token_estimator.needs_calibration:
+            return [token_estimator.estimate(source_text) for source_text in source_texts]
+
+        result = self.count_tokens_batch(source_texts)
+        for source_text, token_count in zip(source_texts, result):
+            token_estimator.add_sample(source_text, token_count)
+
+        return result
+
+    def text_fits_in_one_prompt(self, source_text: str, extra_token_count: int = 0) -> bool:
+        """
+        Check if the given text fits into one prompt. Tokens are counted exactly only when the estimate is within
+        'token_estimate_margin' (fraction of the estimate, default 0.15) of the limit
+        :param source_text:         Text to check
+        :param extra_token_count:   Tokens that will be sent in addition to the text (system prompt, history, etc.)
+        :return: True if the text fits into one prompt
+        """
+        estimated_token_count = self.estimate_tokens(source_text)
+        margin = int(estimated_token_count * self._llm_config_value("token_estimate_margin", 0.15)) + 1
+
+        if self.fits_in_one_prompt(extra_token_count + estimated_token_count + margin):
+            return True
+        if not self.fits_in_one_prompt(extra_token_count + max(0, estimated_token_count - margin)):
+            return False
+
+        token_count = self.count_tokens(source_text)
+        self.token_estimator.add_sample(source_text, token_count)
+
+        return self.fits_in_one_prompt(extra_token_count + token_count)
+
+    @property
+    def token_estimator(self) -> TokenEstimator:
+        llm_config = self.config.get("config") or {}
+        estimator_key = f"{type(self).__name__}:{llm_config.get('model') or llm_config.get('checkpoint')}"
+
+        if estimator_key not in LLM._token_estimators:
+            with LLM._token_estimators_lock:
+                if estimator_key not in LLM._token_estimators:
+                    LLM._token_estimators[estimator_key] = TokenEstimator(
+                        default_bytes_per_token=self._llm_config_value("estimate_bytes_per_token", 3.5)
+                    )
+
+        return LLM._token_estimators[estimator_key]
+
+    def _llm_config_value(self, key: str, default_value):
+        llm_config = self.config.get("config") or {}
+        value = llm_config.get(key)
+
+        return value if value is not None else default_value
+
     @property
     def config(self) -> Dict:
         return self._config
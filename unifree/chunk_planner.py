@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+from typing import List
+
+from unifree import LLM
+
+
+class ChunkPlanner:
+    """
+    Plans how source code is split into LLM requests. Each request carries a fixed overhead (system prompt, prompt
+    template, known translations history and the room reserved for the response), so the planner only gives the
+    remainder of the context window to the code itself.
+    """
+    _llm: LLM
+    _overhead_token_count: int
+    _separator: str
+
+    def __init__(self, llm: LLM, overhead_token_count: int, separator: str = "\n\n") -> None:
+        self._llm = llm
+        self._overhead_token_count = overhead_token_count
+        self._separator = separator
+
+    @property
+    def overhead_token_count(self) -> int:
+        return self._overhead_token_count
+
+    def fits(self, code_token_count: int) -> bool:
+        """
+        Check if the request with the given amount of code tokens fits into one prompt
+        :param code_token_count: Number of tokens in the code
+        :return: True if the code together with the request overhead fits into one prompt
+        """
+        return self._llm.fits_in_one_prompt(self._overhead_token_count + code_token_count)
+
+    def fits_text(self, code: str) -> bool:
+        return self._llm.text_fits_in_one_prompt(code, self._overhead_token_count)
+
+    def pack(self, items: List[str]) -> List[str]:
+        """
+        Pack consecutive items into as few requests as possible. Each batch takes as many of the following items as fit,
+        so translated batches put back together keep the source order. Items that do not fit into one request even on
+        their own get a batch of their own. Packing works with token estimates, exact token counts are only used to
+        verify batches close to the limit.
+
+        :param items: Items to pack (i.e. method declarations)
+        :return: Batches of consecutive items joined with the separator, in the source order
+        """
+        if len(items) == 0:
+            return []
+
+        item_token_counts = self._llm.estimate_tokens_batch(items)
+        separator_token_count = self._llm.estimate_tokens(self._separator)
+
+        bins: List[List[int]] = [[0]]
+        bin_token_count = item_token_counts[0]
+
+        for item_ix in range(1, len(items)):
+            item_token_count = item_token_counts[item_ix]
+
+            if self.fits(bin_token_count + separator_token_count + item_token_count):
+                bins[-1].append(item_ix)
+                bin_token_count += separator_token_count + item_token_count
+            else:
+                bins.append([item_ix])
+                bin_token_count = item_token_count
+
+        # Estimates are not exact and token counts are not strictly additive, so double check every batch and split the
+        # ones that overflow
+        result_bins = []
+        for item_ixs in bins:
+            result_bins.extend(self._split_overflowing(item_ixs, items))
+
+        return [self._separator.join(items[ix] for ix in item_ixs) for item_ixs in result_bins]
+
+    def _split_overflowing(self, item_ixs: List[int], items: List[str]) -> List[List[int]]:
+        if len(item_ixs) < 2 or self.fits_text(self._separator.join(items[ix] for ix in item_ixs)):
+            return [item_ixs]
+
+        middle = len(item_ixs) // 2
+        return self._split_overflowing(item_ixs[:middle], items) + self._split_overflowing(item_ixs[middle:], items)
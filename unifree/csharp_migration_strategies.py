@@ -3,16 +3,23 @@
 # Copyright (c) Unifree
 # This code is licensed under MIT license (see LICENSE.txt for details)
 
+import contextvars
 import os
+import threading
 from abc import ABC
-from typing import Dict, Optional, Callable, TypeVar, List
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Optional, Callable, TypeVar, List, Tuple
 
 import tree_sitter
 
-from unifree import log, MigrationStrategy, FileMigrationSpec, utils, LLM, QueryHistoryItem
-from unifree.llms.code_extrators import extract_first_source_code, extract_header_implementation
+from unifree import log, MigrationStrategy, FileMigrationSpec, utils, LLM, QueryHistoryItem, QueryContext, query_context
+from unifree.chunk_planner import ChunkPlanner
+from unifree.llms.code_extrators import extract_first_source_code, extract_header_implementation, extract_delimited_files, create_incremental_extractor, \
+    is_extracted
+from unifree.llms.batch_job_llm import DeferredResponseError
 from unifree.source_code_parsers import CSharpCodeParser
-from unifree.utils import load_llm
+from unifree.translation_memory import TranslationMemory
+from unifree.utils import load_llm, get_or_create_global_instance
 
 
 class CSharpCompilationUnitMigrationStrategy(MigrationStrategy, ABC):
@@ -21,12 +28,14 @@ class CSharpCompilationUnitMigrationStrategy(MigrationStrategy, ABC):
     """
 
     _tree: Optional[tree_sitter.Tree]
+    _decision_points: Optional[Tuple[int, List[Tuple[str, int]]]]
     _file_migration_spec: FileMigrationSpec
 
     def __init__(self, file_migration_spec: FileMigrationSpec, config: Dict) -> None:
         super().__init__(config)
         self._file_migration_spec = file_migration_spec
         self._tree = None
+        self._decision_points = None
 
     @property
     def source_file_path(self) -> str:
@@ -40,6 +49,10 @@ class CSharpCompilationUnitMigrationStrategy(MigrationStrategy, ABC):
     def destination_project_path(self) -> str:
         return self._file_migration_spec.destination_project_path
 
+    @property
+    def relative_source_file_path(self) -> str:
+        return os.path.relpath(self.source_file_path, self.source_project_path)
+
     @property
     def tree(self) -> tree_sitter.Tree:
         if self._tree is None:
@@ -95,28 +108,62 @@ class CSharpCompilationUnitMigrationStrategy(MigrationStrategy, ABC):
 
         return result
 
-    def create_destination_file_path(self, extension: str) -> str:
-        relative_path = os.path.relpath(self.source_file_path, self.source_project_path)
-        relative_folder_path = os.path.dirname(relative_path)
+    _DECISION_POINT_TYPES = {"if_statement", "for_statement", "foreach_statement", "while_statement", "do_statement", "switch_section",
+                             "switch_expression_arm", "catch_clause", "conditional_expression"}
+    _SHORT_CIRCUIT_OPERATORS = {"&&", "||", "??"}
+
+    def chunk_complexity(self, code: str, prompt_type: str) -> int:
+        """
+        Estimate complexity of a translated chunk as the number of decision points (branches, loops, catch clauses and
+        short-circuit operators) in its syntax tree
+
+        :param code:        Code of the chunk
+        :param prompt_type: Type of the prompt (i.e. 'full', 'methods_only')
+
+        :return: Number of decision points
+        """
+        if self._decision_points is None:
+            self._decision_points = self._count_decision_points()
+
+        total_count, method_counts = self._decision_points
+        if prompt_type == 'methods_only':
+            return sum(count for method, count in method_counts if method in code)
+        elif prompt_type == 'class_only':
+            return total_count - sum(count for _, count in method_counts)
+
+        return total_count
+
+    def _count_decision_points(self) -> Tuple[int, List[Tuple[str, int]]]:
+        method_counts = []
+
+        def count_decision_points(node, in_method: bool) -> int:
+            result = 0
+            if node.type in self._DECISION_POINT_TYPES:
+                result += 1
+            elif node.type == "binary_expression":
+                operator = node.child_by_field_name("operator")
+                if operator and operator.type in self._SHORT_CIRCUIT_OPERATORS:
+                    result += 1
+
+            is_method = node.type == "method_declaration"
+            for child in node.children:
+                result += count_decision_points(child, in_method or is_method)
 
-        if self.config["target"]["lower_folder_names"]:
-            relative_folder_path = relative_folder_path.lower()
+            if is_method and not in_method:
+                method_counts.append((node.text.decode('utf-8'), result))
 
-        target_folder = os.path.join(self.destination_project_path, relative_folder_path)
+            return result
+
+        return count_decision_points(self.tree.root_node, False), method_counts
+
+    def create_destination_file_path(self, extension: str) -> str:
+        result = os.path.join(self.destination_project_path, utils.create_destination_relative_path(self.relative_source_file_path, extension, self.config))
         try:
-            os.makedirs(target_folder, exist_ok=True)
+            os.makedirs(os.path.dirname(result), exist_ok=True)
         except Exception:
             pass  # Ignore
 
-        source_filename = os.path.basename(relative_path)
-        file_name, file_extension = os.path.splitext(os.path.basename(source_filename))
-
-        if self.config["target"]["convert_filename_to_camelcase"]:
-            file_name = utils.snake_to_camel(file_name)
-        elif self.config["target"]["convert_filename_to_snake_case"]:
-            file_name = utils.camel_to_snake(file_name)
-
-        return os.path.join(target_folder, file_name + extension)
+        return result
 
     def maybe_convert_tabs_and_spaces(self, source: str) -> str:
         result = source
@@ -147,6 +194,7 @@ class CSharpCompilationUnitMigrationStrategy(MigrationStrategy, ABC):
 
 class CSharpCompilationUnitMigrationWithLLM(CSharpCompilationUnitMigrationStrategy, ABC):
     _llm: LLM
+    _planned_chunks: Optional[List[Tuple[str, str]]]
 
     def __init__(self, file_migration_spec: FileMigrationSpec, config: Dict) -> None:
         super().__init__(file_migration_spec, config)
@@ -156,19 +204,187 @@ class CSharpCompilationUnitMigrationWithLLM(CSharpCompilationUnitMigrationStrate
 
         self._llm = self.load_llm()
         self._llm.initialize()
+        self._planned_chunks = None
 
     @property
     def llm(self) -> LLM:
         return self._llm
 
+    def plan_chunks(self, system: str) -> List[Tuple[str, str]]:
+        """
+        Split the source into chunks translated with one request each: the whole source if it fits into one 'full'
+        prompt, otherwise everything except method declarations ('class_only') followed by batches of methods
+        ('methods_only'). The plan is computed once.
+
+        :param system: System prompt that is sent with every request
+
+        :return: List of (code, prompt type) tuples
+        """
+        if self._planned_chunks is None:
+            if self.fits_in_one_prompt(self.source_text, 'full', system):
+                self._planned_chunks = [(self.source_text, 'full')]
+            else:
+                self._planned_chunks = [(self.everything_except_method_declarations, 'class_only')]
+                self._planned_chunks += [(method_batch, 'methods_only') for method_batch in self.plan_method_batches(system)]
+
+        return self._planned_chunks
+
+    def known_translation_queries(self, include_chunks: bool) -> List[str]:
+        """
+        Code this strategy looks up known translations for, so they can be retrieved for all strategies at once before
+        migrating.
+
+        :param include_chunks: Include the planned chunks. Planning looks up known translations of the whole source, so
+                               those should be retrieved first
+
+        :return: List of code to look up
+        """
+        queries = [self.source_text]
+        if include_chunks:
+            queries += [code for code, _ in self.plan_chunks(self.config['prompts']['system'])]
+
+        return queries
+
+    def plan_method_batches(self, system: str) -> List[str]:
+        """
+        Pack method declarations into as few batches as possible, each of them fitting into one 'methods_only' prompt.
+
+        :param system: System prompt that is sent with every request
+
+        :return: List of batches of method declarations in the source order
+        """
+        return self.create_chunk_planner('methods_only', system).pack(self.method_declarations)
+
+    def fits_in_one_prompt(self, code: str, prompt_type: str, system: str) -> bool:
+        return self.create_chunk_planner(prompt_type, system).fits_text(code)
+
+    def create_chunk_planner(self, prompt_type: str, system: str) -> ChunkPlanner:
+        return ChunkPlanner(self.llm, self.request_overhead_token_count(prompt_type, system))
+
+    def request_overhead_token_count(self, prompt_type: str, system: str) -> int:
+        """
+        Compute number of tokens every request of the given type carries in addition to the code: system prompt,
+        prompt template, known translations history and tokens reserved for the response (configured in
+        'chunking/response_token_reserve').
+
+        History is selected per chunk, after chunking. With 'known_translations/max_history_tokens' the whole budget is
+        reserved, so every chunk is guaranteed to fit. Otherwise, the history of the whole source is only an estimate
+        of the history of each chunk.
+
+        :param prompt_type: Type of the prompt (i.e. 'full', 'methods_only')
+        :param system:      System prompt
+
+        :return: Number of overhead tokens
+        """
+        result = self.llm.count_tokens(system) if system else 0
+        result += self.llm.count_tokens(self.create_code_prompt(prompt_type, ''))
+
+        from unifree.known_translations_db import KnownTranslationsDb
+        max_history_tokens = (self.config["known_translations"] or {}).get("max_history_tokens") if KnownTranslationsDb.is_instance_initialized() else None
+        history_token_count = sum(self.llm.count_tokens(history_item.content) for history_item in self.load_translation_history(self.source_text))
+        result += max(history_token_count, max_history_tokens or 0)
+
+        chunking_config = self.config["chunking"] or {}
+        result += chunking_config.get("response_token_reserve") or 0
+
+        return result
+
     ResultType = TypeVar('ResultType')
 
-    def translate_code(self, code: str, prompt_type: str, system: str, extractor_fn: Callable[[str], ResultType]) -> ResultType:
+    def translate_code(
+            self,
+            code: str,
+            prompt_type: str,
+            system: str,
+            extractor_fn: Callable[[str], ResultType],
+            complexity: Optional[int] = None,
+    ) -> ResultType:
         user = self.create_code_prompt(prompt_type, code)
+
+        translation_memory = TranslationMemory.instance(self.config)
+        if translation_memory:
+            response = translation_memory.lookup(self.translation_memory_scope(prompt_type, system), code)
+            if response is not None and is_extracted(extractor_fn, response):
+                return extractor_fn(response)
+
         history = self.load_translation_history(code)
-        response = self.llm.query(user, system, history)
+
+        def create_on_fragment() -> Optional[Callable[[str], bool]]:
+            # Stop generation as soon as the extractor has everything it needs
+            incremental_extractor = create_incremental_extractor(extractor_fn)
+            return incremental_extractor.feed if incremental_extractor else None
+
+        context = QueryContext(
+            chunk_kind=prompt_type,
+            complexity=complexity if complexity is not None else self.chunk_complexity(code, prompt_type),
+            is_valid_response=lambda response: is_extracted(extractor_fn, response),
+            create_on_fragment=create_on_fragment,
+            source_file_path=self.relative_source_file_path,
+        )
+        with query_context(context):
+            response = self.llm.query_streaming(user, system, history, create_on_fragment())
+
+        if translation_memory and is_extracted(extractor_fn, response):
+            translation_memory.record(self.translation_memory_scope(prompt_type, system), code, response)
+
         return extractor_fn(response)
 
+    def translation_memory_scope(self, prompt_type: str, system: str) -> str:
+        """
+        Translations in the translation memory are only reused with the same prompts and for the same target
+        """
+        target_config = self.config["target"] or {}
+        return TranslationMemory.create_scope(
+            prompt_type, system, self.config['prompts'][prompt_type], target_config.get("extension"), target_config.get("header_extension"),
+        )
+
+    def translate_chunks(self, chunks: List[Tuple[str, str]], system: str, extractor_fn: Callable[[str], ResultType]) -> List[ResultType]:
+        """
+        Translate multiple chunks of the same file. If 'concurrency/chunk_translation_workers' is configured, chunks are
+        translated concurrently on a shared executor, with at most 'concurrency/chunk_translation_workers_per_file'
+        chunks of this file in flight at the same time.
+
+        :param chunks:          List of (code, prompt type) tuples to translate
+        :param system:          System prompt
+        :param extractor_fn:    Function to extract the result from the LLM response
+
+        :return: Translated chunks in the same order as the input
+        """
+        concurrency_config = self.config["concurrency"] or {}
+        shared_workers = concurrency_config.get("chunk_translation_workers")
+        per_file_workers = concurrency_config.get("chunk_translation_workers_per_file") or shared_workers
+
+        if not shared_workers or shared_workers <= 1 or per_file_workers <= 1 or len(chunks) <= 1:
+            results = []
+            deferred_error = None
+            for code, prompt_type in chunks:
+                try:
+                    results.append(self.translate_code(code, prompt_type, system, extractor_fn))
+                except DeferredResponseError as e:
+                    # Export queries for the remaining chunks too, the file is translated in the next run
+                    deferred_error = deferred_error or e
+
+            if deferred_error:
+                raise deferred_error
+
+            return results
+
+        executor = get_or_create_global_instance("chunk_translation_executor", lambda: ThreadPoolExecutor(
+            max_workers=shared_workers,
+            thread_name_prefix="chunk_translation"
+        ))
+
+        in_flight = threading.BoundedSemaphore(per_file_workers)
+        futures: List[Future] = []
+
+        for code, prompt_type in chunks:
+            in_flight.acquire()
+            future = executor.submit(contextvars.copy_context().run, self.translate_code, code, prompt_type, system, extractor_fn)
+            future.add_done_callback(lambda _: in_flight.release())
+            futures.append(future)
+
+        return [future.result() for future in futures]
+
     def create_code_prompt(self, prompt_type: str, code: str) -> str:
         return self.create_prompt(prompt_type, {"CODE": code})
 
@@ -194,7 +410,8 @@ class CSharpCompilationUnitMigrationWithLLM(CSharpCompilationUnitMigrationStrate
         from unifree.known_translations_db import KnownTranslationsDb
         if KnownTranslationsDb.is_instance_initialized():
             return KnownTranslationsDb.instance().fetch_nearest_as_query_history(
-                query=code
+                query=code,
+                count_tokens=self.llm.count_tokens,
             )
         else:
             return []
@@ -211,44 +428,78 @@ class CSharpCompilationUnitMigrationWithLLM(CSharpCompilationUnitMigrationStrate
 
 
 class CSharpCompilationUnitToSingleFileWithLLM(CSharpCompilationUnitMigrationWithLLM):
+    near_duplicate_reference: Optional['CSharpCompilationUnitToSingleFileWithLLM']
+    """Near-duplicate file translated before this one, its translation is the example for translating this file"""
+    translation: Optional[str]
+    _planned_with_near_duplicate: bool
+
     def __init__(self, file_migration_spec: FileMigrationSpec, destination: Dict) -> None:
         super().__init__(file_migration_spec, destination)
 
+        self.near_duplicate_reference = None
+        self.translation = None
+        self._planned_with_near_duplicate = False
+
+    def plan_chunks(self, system: str) -> List[Tuple[str, str]]:
+        # Prefetching known translations plans chunks before the near-duplicate reference is translated, its
+        # translation replaces the history of the 'full' prompt afterwards
+        has_near_duplicate = len(self.near_duplicate_history()) > 0
+        if has_near_duplicate != self._planned_with_near_duplicate:
+            self._planned_chunks = None
+            self._planned_with_near_duplicate = has_near_duplicate
+
+        return super().plan_chunks(system)
+
     def execute(self) -> None:
         system = self.config['prompts']['system']
 
         # LLMs is sometimes not very good at handling large input source code. So if a code is
         # beyond a certain threshold, translate each method individually
-        token_count = self.llm.count_tokens(self.source_text)
-        if self.llm.fits_in_one_prompt(token_count):
+        chunks = self.plan_chunks(system)
+        if chunks[0][1] == 'full':
+            if len(self.near_duplicate_history()) > 0:
+                utils.increment_statistic("Files translated with a near-duplicate example")
+
             response = self.translate_code(self.source_text, 'full', system, extract_first_source_code)
         else:
-            translated_class_only = self.translate_code(self.everything_except_method_declarations, 'class_only', system, extract_first_source_code)
-
-            current_methods = ''
-            translated_methods = ''
-            for method_declaration in self.method_declarations:
-                updated_current_methods = current_methods + "\n\n" + method_declaration
-
-                token_count = self.llm.count_tokens(updated_current_methods)
-                if self.llm.fits_in_one_prompt(token_count):
-                    current_methods = updated_current_methods
-                else:
-                    translated_methods += "\n\n" + self.translate_code(current_methods, 'methods_only', system, extract_first_source_code)
-                    current_methods = method_declaration
-
-            if len(current_methods) > 0:
-                translated_methods += "\n\n" + self.translate_code(current_methods, 'methods_only', system, extract_first_source_code)
+            translated_class_only, *translated_method_batches = self.translate_chunks(chunks, system, extract_first_source_code)
+            translated_methods = ''.join("\n\n" + translated_method_batch for translated_method_batch in translated_method_batches)
 
             if "${METHODS}" in translated_class_only:
                 response = translated_class_only.replace("${METHODS}", translated_methods)
             else:
                 response = translated_class_only + translated_methods
 
-        response = self.maybe_convert_tabs_and_spaces(response)
+        self.save_translation(response)
+
+    def load_translation_history(self, code: str) -> List[QueryHistoryItem]:
+        if code == self.source_text:
+            near_duplicate_history = self.near_duplicate_history()
+            if len(near_duplicate_history) > 0:
+                return near_duplicate_history
+
+        return super().load_translation_history(code)
+
+    def near_duplicate_history(self) -> List[QueryHistoryItem]:
+        """
+        :return: Translation of the near-duplicate reference as the only history item, empty if there is no reference or
+                 it failed to translate
+        """
+        reference = self.near_duplicate_reference
+        if reference is None or reference.translation is None:
+            return []
+
+        return [
+            QueryHistoryItem(role="user", content=self.create_code_prompt('full', reference.source_text)),
+            QueryHistoryItem(role="assistant", content=f"```\n{reference.translation}\n```"),
+        ]
+
+    def save_translation(self, translation: str) -> None:
+        self.translation = translation
+        translation = self.maybe_convert_tabs_and_spaces(translation)
 
         output_file_name = self.create_destination_file_path(self.config["target"]["extension"])
-        self.save_content(content=response, target_file_path=output_file_name)
+        self.save_content(content=translation, target_file_path=output_file_name)
 
     def __str__(self) -> str:
         output_file_name = self.create_destination_file_path(self.config["target"]["extension"])
@@ -261,34 +512,17 @@ class CSharpCompilationUnitToInterfaceImplementationWithLLM(CSharpCompilationUni
 
         # Chat GPT is sometimes not very good at handling large input source code. So if a code is
         # beyond a certain threshold, translate each method individually
-        token_count = self.llm.count_tokens(self.source_text)
-        if self.llm.fits_in_one_prompt(token_count):
+        chunks = self.plan_chunks(system)
+        if chunks[0][1] == 'full':
             header, implementation = self.translate_code(self.source_text, 'full', system, extract_header_implementation)
         else:
-            class_header, class_implementation = self.translate_code(self.everything_except_method_declarations, 'class_only', system, extract_header_implementation)
+            (class_header, class_implementation), *translated_method_batches = self.translate_chunks(chunks, system, extract_header_implementation)
 
-            current_methods = ''
             method_headers, method_implementations = '', ''
-
-            def translate_current_methods_and_append():
-                nonlocal current_methods, method_headers, method_implementations
-                translated_header, translated_implementation = self.translate_code(current_methods, 'methods_only', system, extract_header_implementation)
+            for translated_header, translated_implementation in translated_method_batches:
                 method_headers += "\n\n" + translated_header
                 method_implementations += "\n\n" + translated_implementation
 
-            for method_declaration in self.method_declarations:
-                updated_current_methods = current_methods + "\n\n" + method_declaration
-
-                token_count = self.llm.count_tokens(updated_current_methods)
-                if self.llm.fits_in_one_prompt(token_count):
-                    current_methods = updated_current_methods
-                else:
-                    translate_current_methods_and_append()
-                    current_methods = method_declaration
-
-            if len(current_methods) > 0:
-                translate_current_methods_and_append()
-
             if "${METHODS}" in class_header:
                 header = class_header.replace("${METHODS}", method_headers)
             else:
@@ -306,3 +540,130 @@ class CSharpCompilationUnitToInterfaceImplementationWithLLM(CSharpCompilationUni
         output_file_name = self.create_destination_file_path(self.config["target"]["header_extension"])
         implementation_ext = self.config["target"]["implementation_extension"]
         return f"[Migrate '{self.source_file_path}' to '{output_file_name}/{implementation_ext}']"
+
+
+class CSharpCompilationUnitsBatchToSingleFilesWithLLM(MigrationStrategy):
+    """
+    Strategy to migrate several small compilation units with a single LLM request, so they share the system prompt and
+    known translations history. Files in the request and in the response are separated with '### FILE: <name>' lines.
+    If the response cannot be unambiguously split back into files, each file is migrated with its own request.
+
+    Batching is configured with:
+
+    ```
+    batching:
+      max_files_per_request: 8
+      max_file_tokens: 600
+    ```
+
+    and requires the 'batch' prompt.
+    """
+    _strategies: List[CSharpCompilationUnitToSingleFileWithLLM]
+
+    def __init__(self, strategies: List[CSharpCompilationUnitToSingleFileWithLLM], config: Dict) -> None:
+        super().__init__(config)
+
+        self._strategies = strategies
+
+    @property
+    def strategies(self) -> List[CSharpCompilationUnitToSingleFileWithLLM]:
+        return self._strategies
+
+    @property
+    def file_names(self) -> List[str]:
+        return [strategy.relative_source_file_path for strategy in self._strategies]
+
+    @property
+    def batch_source_text(self) -> str:
+        return self.create_batch_source_text(self._strategies)
+
+    def execute(self) -> None:
+        system = self.config['prompts']['system']
+        file_names = self.file_names
+
+        translations = self._strategies[0].translate_code(
+            self.batch_source_text, 'batch', system,
+            lambda response: extract_delimited_files(response, file_names),
+            complexity=sum(strategy.chunk_complexity(strategy.source_text, 'full') for strategy in self._strategies),
+        )
+
+        if translations is None:
+            log.debug(f"Unable to split batch response for {self}, migrating files one by one...")
+            for strategy in self._strategies:
+                strategy.execute()
+        else:
+            for strategy, file_name in zip(self._strategies, file_names):
+                strategy.save_translation(translations[file_name])
+
+    def known_translation_queries(self, include_chunks: bool) -> List[str]:
+        """
+        Code this strategy looks up known translations for, see `CSharpCompilationUnitMigrationWithLLM`. Chunks of the
+        batched files are only planned if the batch response cannot be split, they are not included.
+        """
+        queries = [strategy.source_text for strategy in self._strategies]
+        if include_chunks:
+            queries.append(self.batch_source_text)
+
+        return queries
+
+    @staticmethod
+    def create_batch_source_text(strategies: List[CSharpCompilationUnitToSingleFileWithLLM]) -> str:
+        return "\n\n".join(f"### FILE: {strategy.relative_source_file_path}\n```\n{strategy.source_text}\n```" for strategy in strategies)
+
+    @classmethod
+    def create_batches(cls, strategies: List[MigrationStrategy], config: Dict) -> List[MigrationStrategy]:
+        """
+        Group small single file strategies into batches. Files are small if they have at most 'batching/max_file_tokens'
+        tokens. A batch contains at most 'batching/max_files_per_request' files and always fits into one prompt.
+
+        :param strategies:  Strategies to group
+        :param config:      Tool configuration
+
+        :return: Strategies where small single file strategies are replaced with batches
+        """
+        batching_config = config["batching"] or {}
+        max_files_per_request = batching_config.get("max_files_per_request") or 1
+        max_file_tokens = batching_config.get("max_file_tokens") or 0
+
+        if max_files_per_request < 2 or not config["prompts"]["batch"]:
+            return strategies
+
+        system = config['prompts']['system']
+        result: List[MigrationStrategy] = []
+        current_batch: List[CSharpCompilationUnitToSingleFileWithLLM] = []
+
+        def close_current_batch():
+            nonlocal current_batch
+            if len(current_batch) > 1:
+                result.append(cls(current_batch, config))
+            else:
+                result.extend(current_batch)
+
+            current_batch = []
+
+        for strategy in strategies:
+            try:
+                is_small = isinstance(strategy, CSharpCompilationUnitToSingleFileWithLLM) and \
+                           strategy.llm.count_tokens(strategy.source_text) <= max_file_tokens
+            except Exception as e:
+                log.debug(f"Not batching {strategy}: {e}")
+                is_small = False
+
+            if not is_small:
+                result.append(strategy)
+                continue
+
+            updated_batch = current_batch + [strategy]
+            if len(updated_batch) > max_files_per_request or \
+                    not updated_batch[0].fits_in_one_prompt(cls.create_batch_source_text(updated_batch), 'batch', system):
+                close_current_batch()
+                updated_batch = [strategy]
+
+            current_batch = updated_batch
+
+        close_current_batch()
+
+        return result
+
+    def __str__(self) -> str:
+        return f"[Migrate {len(self._strategies)} files in one request: " + ", ".join(f"'{file_name}'" for file_name in self.file_names) + "]"
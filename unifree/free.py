@@ -4,12 +4,12 @@
 # This code is licensed under MIT license (see LICENSE.txt for details)
 
 import argparse
+import contextlib
 import os.path
 import platform
 import sys
 from typing import Optional
 
-import unifree
 from unifree import utils, log
 
 
@@ -20,9 +20,12 @@ def run_migration(
         llm_secret_key: Optional[str] = None,
         verbose: bool = False,
 ):
-    if verbose:
-        unifree.log_level = 'debug'
+    # Only for this migration, a MigrationServer runs migrations of verbose and quiet jobs at the same time
+    with log.log_level_scope('debug') if verbose else contextlib.nullcontext():
+        return _run_migration(config, source, destination, llm_secret_key, verbose)
 
+
+def _run_migration(config: str, source: str, destination: str, llm_secret_key: Optional[str], verbose: bool) -> int:
     try:
         config = utils.load_config(config)
         config["verbose"] = verbose
@@ -56,11 +59,12 @@ def run_migration(
     from unifree.project_migration_strategies import CreateMigrations, ExecuteMigrations
 
     try:
-        create_migrations = CreateMigrations(source, destination, config)
-        create_migrations.execute()
+        with utils.migration_scope():
+            create_migrations = CreateMigrations(source, destination, config)
+            create_migrations.execute()
 
-        execute_migrations = ExecuteMigrations(create_migrations.migrations(), config)
-        execute_migrations.execute()
+            execute_migrations = ExecuteMigrations(create_migrations.migrations(), config)
+            execute_migrations.execute()
 
         log.info("Migration completed successfully")
 
@@ -108,6 +112,12 @@ def migrate():
         default=False,
         action='store_true',
         help=f"Print verbose information about the migration process")
+    args_parser.add_argument(
+        '--server',
+        required=False,
+        type=str,
+        help=f"Address of a migration server (see unifree/server.py) to run the migration on, instead of this process (optional)",
+    )
 
     try:
         args, _ = args_parser.parse_known_args()
@@ -116,10 +126,15 @@ def migrate():
         sys.exit(78) # os.EX_CONFIG
 
     args = vars(args)
+    server = args.pop("server")
 
-    status_code = run_migration(
-        **args
-    )
+    if server:
+        from unifree.server import submit_migration
+        status_code = submit_migration(server, **args)
+    else:
+        status_code = run_migration(
+            **args
+        )
     sys.exit(status_code)
 
 
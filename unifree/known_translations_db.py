@@ -5,22 +5,32 @@
 
 from __future__ import annotations
 
+import hashlib
+import json
 import os
-from typing import Dict, Optional, List, Iterable
+import tempfile
+import threading
+import uuid
+from contextvars import ContextVar
+from typing import Dict, Optional, List, Iterable, Callable, TYPE_CHECKING
 
-import chromadb
+import numpy as np
 import yaml
 from attr import dataclass
-from sentence_transformers import SentenceTransformer
 
 import unifree
-from unifree import log
+from unifree import log, utils
+from unifree.vector_indexes import VectorIndex, open_vector_index
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 
 @dataclass
 class KnownTranslation:
     source: str
     target: str
+    similarity: Optional[float] = None
 
     @classmethod
     def from_dict(cls, input_dict: Dict) -> KnownTranslation:
@@ -29,72 +39,271 @@ class KnownTranslation:
             target=input_dict['target'],
         )
 
+    @property
+    def id(self) -> str:
+        return hashlib.sha256(f"{self.source}\0{self.target}".encode('utf-8')).hexdigest()[:32]
+
 
 class KnownTranslationsDb:
+    """
+    Nearest known translations of the code being translated, used as few-shot examples. Embeddings of the known
+    translations are kept in an index persisted under 'known_translations/index_cache_dir' (defaults to
+    '.cache/known_translations' in the project root, `false` keeps the index in memory), one index per target engine and
+    embedding model. At startup, the index is reused as is if the translations file did not change, otherwise only
+    added or changed translations are embedded.
+
+    The index is a chromadb collection by default. Large corpora can use an in-process NumPy index instead, exact or
+    approximate (inverted file), with vectors optionally quantized to float16 or int8:
+
+    ```
+    known_translations:
+      index:
+        type: ivf             # 'chromadb' (default), 'exact' or 'ivf'
+        quantization: int8    # Optional, 'float16' or 'int8', for 'exact' and 'ivf'
+        n_lists: 256          # Optional, number of clusters for 'ivf', defaults to the square root of the corpus size
+        n_probe: 8            # Optional, number of clusters searched per query for 'ivf'
+    ```
+
+    The sentence transformer is only loaded when something has to be embedded, i.e. on the first query.
+
+    Before migrating, known translations of all the code that will be translated are retrieved at once with `prefetch`
+    (in batches of 'known_translations/prefetch_batch_size'). Embeddings of that code are cached next to the index,
+    keyed by a hash of the code, so a rerun of the same migration does not embed anything. The cache keeps the
+    embeddings of the most recent 'known_translations/max_cached_query_embeddings' (default 200,000) lookups.
+
+    Few-shot history is selected from the 'candidate_count' nearest translations (defaults to 'result_count'): those
+    less similar than 'min_similarity' are dropped, the rest are diversified with maximal marginal relevance (each next
+    example is the one most similar to the code and least similar to the examples already selected, weighted by
+    'mmr_lambda') and at most 'result_count' of them are taken, as long as they fit into 'max_history_tokens':
+
+    ```
+    known_translations:
+      result_count: 3
+      candidate_count: 10       # Optional
+      min_similarity: 0.4       # Optional, cosine similarity
+      mmr_lambda: 0.7           # Optional, 1 selects by similarity only
+      max_history_tokens: 1500  # Optional
+    ```
+    """
     _class_instance: Optional[KnownTranslationsDb] = None
 
     _config: Dict
 
-    _chroma_client: Optional[chromadb.Client]
-    _collection: Optional[chromadb.Collection]
+    _index: Optional[VectorIndex]
     _sentence_transformer: Optional[SentenceTransformer]
+    _sentence_transformer_lock: threading.Lock
+    _initialize_lock: threading.Lock
     _default_n_results: Optional[int]
+    _candidate_count: Optional[int]
+
+    _migration_cache_key: str
+    _stored_query_embeddings: Dict[str, np.ndarray]
+    _stored_query_embeddings_lock: threading.Lock
+    _query_embeddings_file_path: Optional[str]
 
     def __init__(self, config: Dict) -> None:
         self._config = config
-        self._collection = None
+        self._index = None
         self._sentence_transformer = None
+        self._sentence_transformer_lock = threading.Lock()
+        self._initialize_lock = threading.Lock()
         self._default_n_results = None
+        self._candidate_count = None
+
+        self._migration_cache_key = uuid.uuid4().hex
+        self._stored_query_embeddings = {}
+        self._stored_query_embeddings_lock = threading.Lock()
+        self._query_embeddings_file_path = None
+
+    @property
+    def _prefetched(self) -> Dict[str, List[KnownTranslation]]:
+        # Lookups and embeddings of the current migration only, the instance is shared by every job of a MigrationServer
+        return utils.get_or_create_migration_instance(f"known_translations_prefetched:{self._migration_cache_key}", dict)
+
+    @property
+    def _query_embeddings(self) -> Dict[str, np.ndarray]:
+        return utils.get_or_create_migration_instance(f"known_translations_query_embeddings:{self._migration_cache_key}", dict)
+
+    def fetch_nearest_as_query_history(
+            self,
+            query: str,
+            count: Optional[int] = None,
+            count_tokens: Optional[Callable[[str], int]] = None,
+    ) -> List[unifree.QueryHistoryItem]:
+        """
+        Select known translations relevant to the query and format them as few-shot history
+        :param query: Code that will be translated
+        :param count: Maximum number of known translations, defaults to 'known_translations/result_count'
+        :param count_tokens: Counts tokens of the target LLM, required to apply 'known_translations/max_history_tokens'
+        :return: History, a user request and an assistant response per known translation
+        """
+        return [history_item for known_translation in self.select_known_translations(query, count, count_tokens)
+                for history_item in self._create_history_items(known_translation)]
+
+    def select_known_translations(
+            self,
+            query: str,
+            count: Optional[int] = None,
+            count_tokens: Optional[Callable[[str], int]] = None,
+    ) -> List[KnownTranslation]:
+        """
+        Select few-shot examples from the nearest known translations, see the class description
+        """
+        translations_config = self._config["known_translations"] or {}
+        count = count or self._default_n_results
+        nearest = self.fetch_nearest_known_translations(query, max(count or 0, self._candidate_count or 0) or None)
+
+        candidates = nearest
+        min_similarity = translations_config.get("min_similarity")
+        if min_similarity is not None:
+            candidates = [candidate for candidate in candidates if candidate.similarity is None or candidate.similarity >= min_similarity]
+
+        mmr_lambda = translations_config.get("mmr_lambda")
+        if mmr_lambda is not None and mmr_lambda < 1 and len(candidates) > 1:
+            candidates = self._diversify(candidates, mmr_lambda)
+
+        max_history_tokens = translations_config.get("max_history_tokens")
+        if not max_history_tokens or not count_tokens:
+            selected = candidates[:count]
+        else:
+            selected = []
+            remaining_tokens = max_history_tokens
+            max_count = count if count is not None else len(candidates)
+            for candidate in candidates:
+                if len(selected) >= max_count:
+                    break
+
+                token_count = self._count_history_tokens(candidate, count_tokens)
+                if token_count <= remaining_tokens:  # Smaller examples further down may still fit
+                    selected.append(candidate)
+                    remaining_tokens -= token_count
+
+        if count_tokens and selected != nearest[:count]:
+            # Without the selection, the nearest 'count' translations would be sent
+            saved_tokens = sum(self._count_history_tokens(translation, count_tokens) for translation in nearest[:count]) - \
+                           sum(self._count_history_tokens(translation, count_tokens) for translation in selected)
+            if saved_tokens >= 0:
+                utils.increment_statistic("Known translation history tokens saved", saved_tokens)
+            else:
+                # Diversified examples can be longer than the nearest ones
+                utils.increment_statistic("Known translation history tokens added", -saved_tokens)
+
+        utils.increment_statistic("Known translation examples selected", len(selected))
+
+        return selected
+
+    def _diversify(self, candidates: List[KnownTranslation], mmr_lambda: float) -> List[KnownTranslation]:
+        """
+        Order candidates by maximal marginal relevance
+        """
+        vectors = self._index.get_vectors([candidate.id for candidate in candidates])
+        pairwise_similarities = vectors @ vectors.T
+        relevance = np.array([candidate.similarity or 0.0 for candidate in candidates], dtype=np.float32)
+
+        selected_ixs = [int(np.argmax(relevance))]
+        remaining_ixs = [ix for ix in range(len(candidates)) if ix != selected_ixs[0]]
+        while len(remaining_ixs) > 0:
+            redundancy = pairwise_similarities[np.ix_(remaining_ixs, selected_ixs)].max(axis=1)
+            scores = mmr_lambda * relevance[remaining_ixs] - (1 - mmr_lambda) * redundancy
+
+            next_ix = remaining_ixs[int(np.argmax(scores))]
+            selected_ixs.append(next_ix)
+            remaining_ixs.remove(next_ix)
+
+        return [candidates[ix] for ix in selected_ixs]
+
+    def _count_history_tokens(self, known_translation: KnownTranslation, count_tokens: Callable[[str], int]) -> int:
+        return sum(count_tokens(history_item.content) for history_item in self._create_history_items(known_translation))
+
+    def _create_history_items(self, known_translation: KnownTranslation) -> List[unifree.QueryHistoryItem]:
+        translations_config = self._config["known_translations"]
+        assistant_response = translations_config["assistant_response"]
+        user_request_template = translations_config["user_request"]
+
+        user_request = user_request_template \
+            .replace("${SOURCE}", known_translation.source) \
+            .replace("${TARGET}", known_translation.target)
+
+        return [
+            unifree.QueryHistoryItem(
+                role="user",
+                content=user_request
+            ),
+            unifree.QueryHistoryItem(
+                role="assistant",
+                content=assistant_response
+            ),
+        ]
 
-    def fetch_nearest_as_query_history(self, query: str, count: Optional[int] = None) -> List[unifree.QueryHistoryItem]:
-        result = []
-        known_translations = self.fetch_nearest_known_translations(query, count)
-        if len(known_translations) > 0:
-            translations_config = self._config["known_translations"]
-            assistant_response = translations_config["assistant_response"]
-            user_request_template = translations_config["user_request"]
+    def fetch_nearest_known_translations(self, query: str, count: Optional[int] = None) -> List[KnownTranslation]:
+        count = count or self._default_n_results
+        if count and count <= (self._candidate_count or 0):
+            prefetched = self._prefetched.get(_text_hash(query))
+            if prefetched is not None:
+                return prefetched[:count]
+
+        return self.fetch_nearest_known_translations_batch([query], count)[0]
+
+    def prefetch(self, queries: List[str]) -> None:
+        """
+        Find nearest known translations of all queries in batches. Later `fetch_nearest_known_translations` of the same
+        code returns them without embedding or searching anything
+        :param queries: Code to find known translations for
+        """
+        if self._index is None:
+            return
 
-            for known_translation in known_translations:
-                user_request = user_request_template \
-                    .replace("${SOURCE}", known_translation.source) \
-                    .replace("${TARGET}", known_translation.target)
+        missing_queries = {}
+        for query in queries:
+            query_hash = _text_hash(query)
+            if query_hash not in self._prefetched:
+                missing_queries[query_hash] = query
 
-                result.append(unifree.QueryHistoryItem(
-                    role="user",
-                    content=user_request
-                ))
-                result.append(unifree.QueryHistoryItem(
-                    role="assistant",
-                    content=assistant_response
-                ))
+        if len(missing_queries) < 1:
+            return
 
-        return result
+        log.debug(f"Retrieving known translations for {len(missing_queries):,} chunks of code...")
 
-    def fetch_nearest_known_translations(self, query: str, count: Optional[int] = None) -> List[KnownTranslation]:
-        if self._collection:
-            if not count:
-                count = self._default_n_results
+        query_hashes = list(missing_queries.keys())
+        batch_size = self._config["known_translations"]["prefetch_batch_size"] or 256
+        for batch_start in range(0, len(query_hashes), batch_size):
+            batch_hashes = query_hashes[batch_start:batch_start + batch_size]
+            batch_results = self.fetch_nearest_known_translations_batch([missing_queries[query_hash] for query_hash in batch_hashes], self._candidate_count)
 
-            results = self._collection.query(
-                query_embeddings=[self._sentence_transformer.encode(query).tolist()],
-                n_results=count,
-            )
+            for query_hash, result in zip(batch_hashes, batch_results):
+                self._prefetched[query_hash] = result
+
+        utils.increment_statistic("Prefetched known translation lookups", len(query_hashes))
+
+        self._save_query_embeddings()
+
+    def fetch_nearest_known_translations_batch(self, queries: List[str], count: Optional[int] = None) -> List[List[KnownTranslation]]:
+        """
+        Embed all queries at once and find the nearest known translations of each
+        :param queries: Code to find known translations for
+        :param count: Number of translations per query, defaults to 'known_translations/result_count'
+        :return: Known translations per query, from the nearest
+        """
+        if self._index is None:
+            log.debug("Known translations DB was not initialized, not returning anything")
+            return [[] for _ in queries]
 
-            documents = results['documents']
-            metadatas = results['metadatas']
+        if not count:
+            count = self._default_n_results
 
-            if len(metadatas) > 0 and len(documents) > 0:
-                return [KnownTranslation(
-                    source=document,
-                    target=metadata['target'],
+        if len(queries) < 1 or len(self._index) < 1:
+            return [[] for _ in queries]
 
-                ) for document, metadata in zip(documents[0], metadatas[0])]
+        hits = self._index.search(self._embed_queries(queries), count)
 
-        log.debug("Known translations DB was not initialized, not returning anything")
-        return []
+        return [[KnownTranslation(
+            source=hit.payload['source'],
+            target=hit.payload['target'],
+            similarity=hit.similarity,
+        ) for hit in query_hits] for query_hits in hits]
 
     def initialize(self) -> None:
-        if self._collection is not None:
+        if self._index is not None:
             return  # Already initialized
 
         if self._config["known_translations"]:
@@ -102,74 +311,197 @@ class KnownTranslationsDb:
             target_engine = translations_config["target_engine"]
 
             self._default_n_results = translations_config["result_count"]
+            self._candidate_count = max(self._default_n_results or 0, translations_config["candidate_count"] or 0) or None
 
-            log.debug("Loading sentence transformer...")
             os.environ["TOKENIZERS_PARALLELISM"] = "false"
-            self._sentence_transformer = self._create_sentence_transformer(translations_config)
 
-            log.debug("Creating and filling up sentence DB...")
-            self._chroma_client = chromadb.Client()
-            self._collection = self._chroma_client.create_collection(
-                name=f"{target_engine}-known-translations",
-                embedding_function=self._sentence_transformer
-            )
+            log.debug("Opening known translations index...")
+            self._index = self._open_index(translations_config)
             self._upsert_translations_from_yaml(target_engine)
 
+    @property
+    def sentence_transformer(self) -> SentenceTransformer:
+        if self._sentence_transformer is None:
+            with self._sentence_transformer_lock:
+                if self._sentence_transformer is None:
+                    log.debug("Loading sentence transformer...")
+                    self._sentence_transformer = self._create_sentence_transformer(self._config["known_translations"])
+
+        return self._sentence_transformer
+
     def _create_sentence_transformer(self, translations_config: Dict) -> SentenceTransformer:
         embedding_function_name = translations_config["embedding_function"]
 
+        from sentence_transformers import SentenceTransformer  # Imports torch, which takes seconds
         return SentenceTransformer(embedding_function_name)
 
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        embeddings = np.asarray(self.sentence_transformer.encode(texts), dtype=np.float32)
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    def _embed_queries(self, queries: List[str]) -> np.ndarray:
+        query_hashes = [_text_hash(query) for query in queries]
+
+        missing_ixs = []
+        for ix, query_hash in enumerate(query_hashes):
+            if query_hash not in self._query_embeddings:
+                stored_embedding = self._stored_query_embeddings.get(query_hash)
+                if stored_embedding is not None:
+                    self._query_embeddings[query_hash] = stored_embedding
+                else:
+                    missing_ixs.append(ix)
+
+        if len(missing_ixs) > 0:
+            for ix, embedding in zip(missing_ixs, self._embed([queries[ix] for ix in missing_ixs])):
+                self._query_embeddings[query_hashes[ix]] = embedding
+
+        utils.increment_statistic("Cached query embeddings", len(queries) - len(missing_ixs))
+
+        return np.stack([self._query_embeddings[query_hash] for query_hash in query_hashes])
+
+    def _load_query_embeddings(self) -> None:
+        if not self._query_embeddings_file_path or not os.path.isfile(self._query_embeddings_file_path):
+            return
+
+        try:
+            with np.load(self._query_embeddings_file_path, allow_pickle=False) as stored:
+                self._stored_query_embeddings = dict(zip((str(query_hash) for query_hash in stored["hashes"]), stored["embeddings"]))
+        except Exception as e:
+            log.warn(f"Unable to load cached query embeddings from '{self._query_embeddings_file_path}': {e}")
+
+    def _save_query_embeddings(self) -> None:
+        """
+        Add embeddings used in this migration to the stored ones. Concurrent migrations (see `MigrationServer`) share
+        the instance, so the most recently used 'max_cached_query_embeddings' of all of them are kept
+        """
+        query_embeddings = self._query_embeddings
+        if not self._query_embeddings_file_path or len(query_embeddings) < 1:
+            return
+
+        max_cached = self._config["known_translations"]["max_cached_query_embeddings"] or 200_000
+
+        with self._stored_query_embeddings_lock:
+            stored = {query_hash: embedding for query_hash, embedding in self._stored_query_embeddings.items() if query_hash not in query_embeddings}
+            stored.update(query_embeddings)
+            self._stored_query_embeddings = dict(list(stored.items())[-max_cached:])
+
+            query_hashes = list(self._stored_query_embeddings.keys())
+            embeddings = np.stack([self._stored_query_embeddings[query_hash] for query_hash in query_hashes])
+
+            os.makedirs(os.path.dirname(self._query_embeddings_file_path), exist_ok=True)
+            file_descriptor, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(self._query_embeddings_file_path), suffix=".tmp")
+            try:
+                with os.fdopen(file_descriptor, 'wb') as file:
+                    np.savez(file, hashes=np.array(query_hashes, dtype=np.str_), embeddings=embeddings)
+                os.replace(temp_file_path, self._query_embeddings_file_path)
+            except BaseException:
+                os.remove(temp_file_path)
+                raise
+
+    def _open_index(self, translations_config: Dict) -> VectorIndex:
+        embedding_function_name = translations_config["embedding_function"]
+        index_cache_dir = translations_config["index_cache_dir"]
+
+        if index_cache_dir is not False:
+            index_cache_dir = os.path.expanduser(index_cache_dir or os.path.join(unifree.project_root, ".cache", "known_translations"))
+
+        # Embeddings of different models are not comparable, each model gets its own index
+        embedding_function_hash = hashlib.sha256(str(embedding_function_name).encode('utf-8')).hexdigest()[:16]
+
+        index_name = f"{translations_config['target_engine']}-known-translations-{embedding_function_hash}"
+        if index_cache_dir:
+            self._query_embeddings_file_path = os.path.join(index_cache_dir, f"{index_name}-query-embeddings.npz")
+            self._load_query_embeddings()
+
+        return open_vector_index(translations_config["index"] or {}, index_cache_dir or None, index_name)
+
+    def _known_translations_file_path(self, target_engine: str) -> str:
+        return os.path.join(unifree.project_root, "known_translations", f"{target_engine}.yaml")
+
     def _upsert_translations_from_yaml(self, target_engine: str) -> None:
-        known_translations_file_path = os.path.join(unifree.project_root, "known_translations", f"{target_engine}.yaml")
+        known_translations_file_path = self._known_translations_file_path(target_engine)
         if not os.path.exists(known_translations_file_path) or not os.path.isfile(known_translations_file_path):
             log.warn(f"No requested known translations found at '{known_translations_file_path}'")
             return
 
-        with open(known_translations_file_path, 'r') as known_translations_file:
-            known_translations = yaml.safe_load(known_translations_file)
+        with open(known_translations_file_path, 'rb') as known_translations_file:
+            known_translations_bytes = known_translations_file.read()
+
+        source_hash = hashlib.sha256(known_translations_bytes).hexdigest()
+        if self._index.metadata.get("source_hash") == source_hash:
+            log.debug(f"Known translations did not change, reusing index of {len(self._index):,} translations")
+            return
+
+        known_translations = yaml.safe_load(known_translations_bytes)
 
         if "translations" in known_translations:
             translations = map(KnownTranslation.from_dict, known_translations['translations'])
-            self._upsert_translations(translations)
+            self._upsert_translations(translations, source_hash)
 
         else:
             log.warn(f"'{known_translations_file_path}' is malformed: no root node called 'translations' found")
 
-    def _upsert_translations(self, translations: Iterable[KnownTranslation]) -> None:
-        documents = []
-        metadatas = []
-        ids = []
-
-        for translation in translations:
-            documents.append(translation.source)
-            metadatas.append({
-                'target': translation.target,
-            })
-            ids.append(str(len(ids) + 1))
-
-        embeddings = self._sentence_transformer.encode(documents).tolist()
-
-        self._collection.upsert(
-            documents=documents,
-            embeddings=embeddings,
-            metadatas=metadatas,
-            ids=ids,
-        )
-        log.debug(f"Inserted {len(ids):,} known translations")
+    def _upsert_translations(self, translations: Iterable[KnownTranslation], source_hash: Optional[str] = None) -> None:
+        """
+        Make the index contain exactly the given translations, embedding only the ones it does not have yet
+        :param translations: All known translations
+        :param source_hash: Hash of the translations file, to skip the update next time the file is the same
+        """
+        translations_by_id = {translation.id: translation for translation in translations}
+
+        indexed_ids = set(self._index.ids())
+        removed_ids = [translation_id for translation_id in indexed_ids if translation_id not in translations_by_id]
+        added_ids = [translation_id for translation_id in translations_by_id if translation_id not in indexed_ids]
+
+        self._index.remove(removed_ids)
+
+        batch_size = self._index.max_batch_size or max(1, len(added_ids))
+        for batch_start in range(0, len(added_ids), batch_size):
+            batch_ids = added_ids[batch_start:batch_start + batch_size]
+            batch_translations = [translations_by_id[translation_id] for translation_id in batch_ids]
+
+            self._index.add(
+                batch_ids,
+                self._embed([translation.source for translation in batch_translations]),
+                [{'source': translation.source, 'target': translation.target} for translation in batch_translations],
+            )
+
+        if source_hash:
+            self._index.metadata["source_hash"] = source_hash
+        self._index.flush()
+
+        log.debug(f"Inserted {len(added_ids):,} and removed {len(removed_ids):,} known translations, "
+                  f"{len(translations_by_id) - len(added_ids):,} were already indexed")
 
     @classmethod
     def instance(cls) -> KnownTranslationsDb:
         if not cls.is_instance_initialized():
             raise RuntimeError(f"Known translations DB is not initialized")
 
-        return cls._class_instance
+        return _current_instance.get() or cls._class_instance
 
     @classmethod
     def is_instance_initialized(cls) -> bool:
-        return cls._class_instance is not None
+        return (_current_instance.get() or cls._class_instance) is not None
 
     @classmethod
     def initialize_instance(cls, config: Dict) -> None:
-        cls._class_instance = KnownTranslationsDb(config)
-        cls._class_instance.initialize()
+        """
+        Initialize the instance used by the current migration (in this thread and the threads it starts with
+        `ConcurrentMigrationStrategy.map_concurrently`). Migrations with the same 'known_translations' configuration share
+        one instance, so a long-running process (see `MigrationServer`) loads the index and the sentence transformer once
+        """
+        instance_key = json.dumps(config["known_translations"], sort_keys=True, default=str)
+        instance = utils.get_or_create_global_instance(f"known_translations_db:{instance_key}", lambda: KnownTranslationsDb(config))
+        with instance._initialize_lock:
+            instance.initialize()
+
+        cls._class_instance = instance
+        _current_instance.set(instance)
+
+
+_current_instance: ContextVar[Optional[KnownTranslationsDb]] = ContextVar("known_translations_db", default=None)
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
@@ -3,9 +3,49 @@
 # Copyright (c) Unifree
 # This code is licensed under MIT license (see LICENSE.txt for details)
 
+import importlib
+from typing import TYPE_CHECKING, Any, List
 
-from .chatgpt_llm import ChatGptLLM
-from .huggingface_llm import HuggingfaceLLM
+# LLMs are imported on first access (i.e. by `utils.load_llm`), so only the backend that is configured pays for its
+# dependencies (openai, tiktoken, transformers)
+_LAZY_ATTRIBUTES = {
+    "ChatGptLLM": "chatgpt_llm",
+    "OpenAiCompatibleLLM": "openai_compatible_llm",
+    "HuggingfaceLLM": "huggingface_llm",
+    "TrivialLLM": "trivial_llm",
+    "MultiprocessLocalLLM": "multiprocess_local_llm",
+    "CoalescingLLM": "coalescing_llm",
+    "RoutingLLM": "routing_llm",
+    "BatchJobLLM": "batch_job_llm",
+    "DeferredResponseError": "batch_job_llm",
+    "PoolLLM": "pool_llm",
+}
 
-from .trivial_llm import TrivialLLM
-from .multiprocess_local_llm import MultiprocessLocalLLM
+__all__ = list(_LAZY_ATTRIBUTES.keys())
+
+if TYPE_CHECKING:
+    from .chatgpt_llm import ChatGptLLM
+    from .openai_compatible_llm import OpenAiCompatibleLLM
+    from .huggingface_llm import HuggingfaceLLM
+
+    from .trivial_llm import TrivialLLM
+    from .multiprocess_local_llm import MultiprocessLocalLLM
+    from .coalescing_llm import CoalescingLLM
+    from .routing_llm import RoutingLLM
+    from .batch_job_llm import BatchJobLLM, DeferredResponseError
+    from .pool_llm import PoolLLM
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+    value = getattr(importlib.import_module(f".{module_name}", __name__), name)
+    globals()[name] = value  # Next access does not go through __getattr__
+
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(list(globals().keys()) + __all__)
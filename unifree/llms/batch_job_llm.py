@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import hashlib
+import json
+import os
+import threading
+from typing import Optional, List, Dict, Callable, Any, Set
+
+from unifree import LLM, QueryHistoryItem, log, current_query_context
+from unifree.utils import load_llm, get_or_create_migration_instance, increment_statistic
+
+
+class DeferredResponseError(RuntimeError):
+    """
+    Raised instead of returning a response when the query was exported to a batch job
+    """
+    pass
+
+
+class BatchJobLLM(LLM):
+    """
+    This class runs a migration in two phases, to use offline (batch) completion interfaces of LLM providers:
+      1. Without 'responses_file', every query is appended to 'requests_file' (JSONL in the format of OpenAI batch
+         API) and fails with `DeferredResponseError`. Migrations are planned as usual, nothing is written.
+      2. With 'responses_file', queries are answered from it (JSONL in the format of OpenAI batch API output) and
+         migrations are written as usual.
+
+    Both phases have to run on the same sources and configuration: request ids are derived from the source file, the
+    chunk kind and a hash of the request, so phase two finds responses to the same requests phase one exported. Every
+    migration starts the requests file over.
+
+    Phase two can make queries phase one did not (i.e. the per-file fallback of a batch whose translation could not be
+    split), and some requests fail in the batch job. Such queries are written to 'followup_requests_file' and fail with
+    `DeferredResponseError`, so their files are not written. Run the follow-up batch job and repeat phase two with the
+    outputs of both batch jobs in 'responses_file'.
+
+    The configuration would look like:
+
+    ```
+    llm:
+      class: BatchJobLLM
+      batch_job_config:
+        requests_file: /tmp/requests.jsonl
+        responses_file: /tmp/responses.jsonl  # Phase two only, can be a list of files
+        followup_requests_file: /tmp/requests.followup.jsonl  # Phase two only, optional
+      llm_config:
+          class: <wrapped LLM class, used to count tokens and as the source of the model and completion parameters>
+          config: <wrapped LLM config>
+    ```
+    """
+    _requests_lock: threading.Lock = threading.Lock()
+
+    _wrapped_llm: Optional[LLM]
+    _responses: Optional[Dict[str, str]]
+    _requests_file: Optional[str]
+    _exported_ids: Optional[Set[str]]
+
+    def __init__(self, config: Dict) -> None:
+        super().__init__(config)
+
+        self._wrapped_llm = None
+        self._responses = None
+        self._requests_file = None
+        self._exported_ids = None
+
+    def initialize(self) -> None:
+        self._wrapped_llm = load_llm(self.config["llm_config"])
+        self._wrapped_llm.initialize_tokenizer()
+
+        requests_file = self._batch_job_config["requests_file"]
+        responses_files = self._batch_job_config.get("responses_file") or []
+        if isinstance(responses_files, str):
+            responses_files = [responses_files]
+
+        if responses_files:
+            self._responses = get_or_create_migration_instance(
+                f"batch_job_responses:{','.join(os.path.abspath(file) for file in responses_files)}",
+                lambda: _load_all_responses(responses_files),
+            )
+            self._requests_file = self._batch_job_config.get("followup_requests_file") or _followup_requests_file(requests_file)
+        else:
+            self._requests_file = requests_file
+
+        self._exported_ids = get_or_create_migration_instance(
+            f"batch_job_request_ids:{os.path.abspath(self._requests_file)}",
+            lambda: _start_requests_file(self._requests_file),
+        )
+
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        return self.query_streaming(user, system, history)
+
+    def query_streaming(
+            self,
+            user: str,
+            system: Optional[str] = None,
+            history: Optional[List[QueryHistoryItem]] = None,
+            on_fragment: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        request = self.create_request(user, system, history)
+
+        if self._responses is None:
+            self._export_request(request)
+            raise DeferredResponseError(f"Request {request['custom_id']} is exported to a batch job")
+
+        response = self._responses.get(request["custom_id"])
+        if response is None:
+            self._export_request(request)
+            raise DeferredResponseError(f"No response to request {request['custom_id']} in the batch job output, it is exported to a follow-up batch job")
+
+        if on_fragment:
+            on_fragment(response)
+
+        return response
+
+    def create_request(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> Dict[str, Any]:
+        """
+        Create batch job request line for the query
+        :return: Request in the format of OpenAI batch API
+        """
+        messages = []
+        if system:
+            messages.append({"role": "system", "content": system})
+        for history_item in history or []:
+            messages.append({"role": history_item.role, "content": history_item.content})
+        messages.append({"role": "user", "content": user})
+
+        if hasattr(self._wrapped_llm, "completion_parameters"):
+            body = self._wrapped_llm.completion_parameters()
+        else:
+            body = {"model": (self.config["llm_config"].get("config") or {}).get("model")}
+        body["messages"] = messages
+
+        context = current_query_context()
+        source_file_path = context.source_file_path if context and context.source_file_path else "unknown"
+        chunk_kind = context.chunk_kind if context and context.chunk_kind else "query"
+        request_hash = hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+        return {
+            "custom_id": f"{source_file_path}:{chunk_kind}:{request_hash}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body,
+        }
+
+    def _export_request(self, request: Dict[str, Any]) -> None:
+        with self._requests_lock:
+            if request["custom_id"] in self._exported_ids:
+                return  # Identical request from another chunk or file
+
+            self._exported_ids.add(request["custom_id"])
+            with open(self._requests_file, 'a') as file:
+                file.write(json.dumps(request) + "\n")
+
+        increment_statistic("Exported LLM requests")
+
+    @property
+    def _batch_job_config(self) -> Dict:
+        return self.config["batch_job_config"] or {}
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        return self._wrapped_llm.fits_in_one_prompt(token_count)
+
+    def count_tokens(self, source_text: str) -> int:
+        return self._wrapped_llm.count_tokens(source_text)
+
+    def count_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        return self._wrapped_llm.count_tokens_batch(source_texts)
+
+    def estimate_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        return self._wrapped_llm.estimate_tokens_batch(source_texts)
+
+    def text_fits_in_one_prompt(self, source_text: str, extra_token_count: int = 0) -> bool:
+        return self._wrapped_llm.text_fits_in_one_prompt(source_text, extra_token_count)
+
+
+def load_responses(responses_file: str) -> Dict[str, str]:
+    """
+    Load batch job output
+    :param responses_file: JSONL file in the format of OpenAI batch API output
+    :return: Response content by request id. Failed requests are skipped
+    """
+    result = {}
+    with open(responses_file, 'r') as file:
+        for line in file:
+            if not line.strip():
+                continue
+
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            choices = (response.get("body") or {}).get("choices") or []
+
+            if entry.get("error") or response.get("status_code", 200) != 200 or len(choices) < 1:
+                log.warn(f"Batch job request {entry.get('custom_id')} failed: {entry.get('error') or response}")
+                continue
+
+            result[entry["custom_id"]] = choices[0]["message"]["content"]
+
+    log.debug(f"Loaded {len(result):,} batch job responses from '{responses_file}'")
+
+    return result
+
+
+def _load_all_responses(responses_files: List[str]) -> Dict[str, str]:
+    result = {}
+    for responses_file in responses_files:
+        result.update(load_responses(responses_file))
+
+    return result
+
+
+def _followup_requests_file(requests_file: str) -> str:
+    root, extension = os.path.splitext(requests_file)
+    return f"{root}.followup{extension or '.jsonl'}"
+
+
+def _start_requests_file(requests_file: str) -> Set[str]:
+    with open(requests_file, 'w'):
+        pass  # Requests of previous migrations are not sent again
+
+    return set()
+
+
+def answer_requests(requests_file: str, responses_file: str, answer: Callable[[List[Dict[str, str]]], str]) -> int:
+    """
+    Local stand-in for a batch job: answer every request in the requests file and write the output in the format of
+    OpenAI batch API
+    :param requests_file: Requests exported by `BatchJobLLM`
+    :param responses_file: Where to write the responses
+    :param answer: Produces response content for the request messages
+    :return: Number of answered requests
+    """
+    count = 0
+    with open(requests_file, 'r') as requests, open(responses_file, 'w') as responses:
+        for line in requests:
+            if not line.strip():
+                continue
+
+            request = json.loads(line)
+            responses.write(json.dumps({
+                "id": f"batch_req_{count}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {
+                        "choices": [{
+                            "index": 0,
+                            "message": {"role": "assistant", "content": answer(request["body"]["messages"])},
+                        }],
+                    },
+                },
+                "error": None,
+            }) + "\n")
+            count += 1
+
+    return count
@@ -3,12 +3,16 @@
 # Copyright (c) Unifree
 # This code is licensed under MIT license (see LICENSE.txt for details)
 
-from typing import Dict, Optional, List
+import functools
+import hashlib
+import json
+from typing import Dict, Optional, List, Callable, Any
 
 import openai
 import tiktoken
 
 from unifree import LLM, log, QueryHistoryItem
+from unifree.utils import LruCache
 
 
 class ChatGptLLM(LLM):
@@ -24,6 +28,9 @@ class ChatGptLLM(LLM):
           secret_key: <INSERTED DYNAMICALLY BY free.py>
           model: gpt-4
           max_tokens: 4000
+          stream: true                # Optional, stream responses and stop reading once the needed code is generated
+          max_response_tokens: 2000   # Optional, limit on the number of generated tokens
+          stop: ["<|end|>"]           # Optional, stop sequences
     ```
 
     """
@@ -35,43 +42,28 @@ class ChatGptLLM(LLM):
         pass
 
     def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
-        openai.api_key = self.config["config"]['secret_key']
-
+        return self.query_streaming(user, system, history)
+
+    def query_streaming(
+            self,
+            user: str,
+            system: Optional[str] = None,
+            history: Optional[List[QueryHistoryItem]] = None,
+            on_fragment: Optional[Callable[[str], bool]] = None,
+    ) -> str:
         if log.is_debug():
             short_user_query = user[:50].replace("\n", " ")
             token_count = self.count_tokens(user)
             log.debug(f"Requesting running a query for {token_count:,} tokens ('{short_user_query}...')...")
 
         try:
-            messages = []
-
-            if system:
-                messages.append({
-                    "role": "system",
-                    "content": system
-                })
-
-            if history:
-                for history_item in history:
-                    messages.append({
-                        "role": history_item.role,
-                        "content": history_item.content
-                    })
-
-            messages.append({
-                "role": "user",
-                "content": user
-            })
-
-            completion = openai.ChatCompletion.create(
-                model=self.config["config"]["model"],
-                messages=messages
-            )
-
-            if len(completion.choices) < 1 or len(completion.choices[0].message.content) < 1:
-                raise RuntimeError(f"ChatGPT returned malformed response: {completion}")
-
-            response = completion.choices[0].message.content
+            messages = self.create_messages(user, system, history)
+            if self.config["config"].get("stream"):
+                response = self.request_streaming_completion(messages, on_fragment)
+            else:
+                response = self.request_completion(messages)
+                if on_fragment:
+                    on_fragment(response)
 
             if log.is_debug():
                 messages_str = [f"> {m['role']}: {m['content']}" for m in messages]
@@ -83,11 +75,119 @@ class ChatGptLLM(LLM):
         except Exception as e:
             raise RuntimeError(f"ChatGPT query failed: {e}")
 
+    def create_messages(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> List[Dict[str, str]]:
+        messages = []
+
+        if system:
+            messages.append({
+                "role": "system",
+                "content": system
+            })
+
+        if history:
+            for history_item in history:
+                messages.append({
+                    "role": history_item.role,
+                    "content": history_item.content
+                })
+
+        messages.append({
+            "role": "user",
+            "content": user
+        })
+
+        return messages
+
+    def request_completion(self, messages: List[Dict[str, str]]) -> str:
+        # API key is passed with every request, setting global 'openai.api_key' is not thread safe
+        completion = openai.ChatCompletion.create(
+            api_key=self.config["config"]['secret_key'],
+            messages=messages,
+            **self.completion_parameters()
+        )
+
+        if len(completion.choices) < 1 or len(completion.choices[0].message.content) < 1:
+            raise RuntimeError(f"ChatGPT returned malformed response: {completion}")
+
+        return completion.choices[0].message.content
+
+    def request_streaming_completion(self, messages: List[Dict[str, str]], on_fragment: Optional[Callable[[str], bool]]) -> str:
+        # `ChatCompletion.create` does not expose the HTTP response of a stream, only closing it stops generation
+        requestor = openai.api_requestor.APIRequestor(key=self.config["config"]['secret_key'])
+        http_response = requestor.request_raw(
+            "post",
+            "/chat/completions",
+            params={"messages": messages, "stream": True, **self.completion_parameters()},
+            stream=True,
+        )
+
+        fragments = []
+        with http_response:
+            if http_response.status_code != 200:
+                raise RuntimeError(f"ChatGPT returned HTTP {http_response.status_code}: {http_response.text}")
+
+            for data in openai.api_requestor.parse_stream(http_response.iter_lines()):
+                choices = json.loads(data).get("choices") or []
+                fragment = choices[0].get("delta", {}).get("content") if len(choices) > 0 else None
+                if fragment:
+                    fragments.append(fragment)
+                    if on_fragment and on_fragment(fragment):
+                        break  # Closing the response before it is fully read drops the connection and stops generation
+
+        if len(fragments) < 1:
+            raise RuntimeError(f"ChatGPT returned empty response")
+
+        return ''.join(fragments)
+
+    def completion_parameters(self) -> Dict[str, Any]:
+        llm_config = self.config["config"]
+
+        result = {"model": llm_config["model"]}
+        if llm_config.get("max_response_tokens"):
+            result["max_tokens"] = llm_config["max_response_tokens"]
+        if llm_config.get("stop"):
+            result["stop"] = llm_config["stop"]
+
+        return result
+
     def fits_in_one_prompt(self, token_count: int) -> bool:
         return token_count < self.config["config"]["max_tokens"]
 
     def count_tokens(self, source_text: str) -> int:
-        encoding = tiktoken.encoding_for_model(self.config["config"]["model"])
-        num_tokens = len(encoding.encode(source_text))
+        return self.count_tokens_batch([source_text])[0]
+
+    def count_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        model = self.config["config"]["model"]
+
+        result = []
+        missing_texts = {}
+        for ix, source_text in enumerate(source_texts):
+            cache_key = (model, hashlib.blake2b(source_text.encode('utf-8'), digest_size=16).digest())
+            token_count = _token_counts.get(cache_key)
+            if token_count is None:
+                missing_texts[cache_key] = source_text
+
+            result.append((cache_key, token_count))
+
+        if len(missing_texts) > 0:
+            for cache_key, tokens in zip(missing_texts.keys(), self.encoding.encode_ordinary_batch(list(missing_texts.values()))):
+                missing_texts[cache_key] = len(tokens)
+                _token_counts.put(cache_key, len(tokens))
+
+        return [token_count if token_count is not None else missing_texts[cache_key] for cache_key, token_count in result]
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        return _encoding_for_model(self.config["config"]["model"])
+
+
+_token_counts: LruCache[int] = LruCache(max_size=100_000)
+
 
-        return num_tokens
+@functools.lru_cache(maxsize=None)
+def _encoding_for_model(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        log.debug(f"No tokenizer is known for '{model}', using 'cl100k_base'")
+        return tiktoken.get_encoding("cl100k_base")
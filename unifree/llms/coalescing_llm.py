@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from typing import Optional, List, Dict, Callable
+
+from unifree import LLM, QueryHistoryItem, log
+from unifree.utils import load_llm, increment_statistic
+
+
+class CoalescingLLM(LLM):
+    """
+    This class wraps an LLM implementation and coalesces identical concurrent queries: if the same query (system,
+    history, user and wrapped LLM configuration) is already in flight, the caller waits for its response instead of
+    issuing another request.
+
+    The configuration would look like:
+
+    ```
+    llm:
+      class: CoalescingLLM
+      llm_config:
+          class: <wrapped LLM class>
+          config: <wrapped LLM config>
+    ```
+    """
+    _in_flight_queries: Dict[str, Future] = {}
+    _in_flight_queries_lock: threading.Lock = threading.Lock()
+
+    _wrapped_llm: Optional[LLM]
+
+    def __init__(self, config: Dict) -> None:
+        super().__init__(config)
+
+        self._wrapped_llm = None
+
+    def initialize(self) -> None:
+        self._wrapped_llm = load_llm(self.config["llm_config"])
+        self._wrapped_llm.initialize()
+
+    def initialize_tokenizer(self) -> None:
+        self._wrapped_llm = load_llm(self.config["llm_config"])
+        self._wrapped_llm.initialize_tokenizer()
+
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        return self.query_streaming(user, system, history)
+
+    def query_streaming(
+            self,
+            user: str,
+            system: Optional[str] = None,
+            history: Optional[List[QueryHistoryItem]] = None,
+            on_fragment: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        assert self._wrapped_llm is not None
+
+        query_key = self._query_key(user, system, history)
+
+        with self._in_flight_queries_lock:
+            in_flight_query = self._in_flight_queries.get(query_key)
+            is_first_query = in_flight_query is None
+            if is_first_query:
+                in_flight_query = Future()
+                self._in_flight_queries[query_key] = in_flight_query
+
+        if not is_first_query:
+            log.debug(f"Waiting for identical query in flight ('{user[:50]}...')")
+            increment_statistic("Coalesced LLM queries")
+
+            response = in_flight_query.result()
+            if on_fragment:
+                on_fragment(response)
+
+            return response
+
+        try:
+            response = self._wrapped_llm.query_streaming(user, system, history, on_fragment)
+            in_flight_query.set_result(response)
+
+            return response
+        except BaseException as e:
+            in_flight_query.set_exception(e)
+            raise
+        finally:
+            with self._in_flight_queries_lock:
+                del self._in_flight_queries[query_key]
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        assert self._wrapped_llm is not None
+        return self._wrapped_llm.fits_in_one_prompt(token_count)
+
+    def count_tokens(self, source_text: str) -> int:
+        assert self._wrapped_llm is not None
+        return self._wrapped_llm.count_tokens(source_text)
+
+    def count_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        assert self._wrapped_llm is not None
+        return self._wrapped_llm.count_tokens_batch(source_texts)
+
+    def estimate_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        assert self._wrapped_llm is not None
+        return self._wrapped_llm.estimate_tokens_batch(source_texts)
+
+    def text_fits_in_one_prompt(self, source_text: str, extra_token_count: int = 0) -> bool:
+        assert self._wrapped_llm is not None
+        return self._wrapped_llm.text_fits_in_one_prompt(source_text, extra_token_count)
+
+    def _query_key(self, user: str, system: Optional[str], history: Optional[List[QueryHistoryItem]]) -> str:
+        query = json.dumps([
+            self.config["llm_config"],
+            system,
+            [(history_item.role, history_item.content) for history_item in history] if history else [],
+            user,
+        ], sort_keys=True, default=str)
+
+        return hashlib.sha256(query.encode('utf-8')).hexdigest()
@@ -3,7 +3,7 @@
 # Copyright (c) Unifree
 # This code is licensed under MIT license (see LICENSE.txt for details)
 
-from typing import Tuple
+from typing import Tuple, List, Dict, Optional, Callable, Any
 
 
 def extract_first_source_code(response: str, code_delimiter: str = "```") -> str:
@@ -13,19 +13,10 @@ def extract_first_source_code(response: str, code_delimiter: str = "```") -> str
     :param code_delimiter:  Delimiter that is used to separate the code. Default is ````
     :return: String with the first occurrence or whole response if no delimiters found
     """
-    result = ''
+    extractor = FirstSourceCodeExtractor(code_delimiter)
+    extractor.feed(response)
 
-    starting_ix = response.find(code_delimiter)
-    if starting_ix >= 0:
-        starting_ix = response.find("\n", starting_ix)  # Move to the new line
-        ending_ix = response.find(code_delimiter, starting_ix)
-        if ending_ix > 0 and starting_ix > 0:
-            result = response[starting_ix:ending_ix]
-
-    if len(result) == 0:
-        result = response
-
-    return result.rstrip().lstrip()
+    return extractor.result()
 
 
 def extract_header_implementation(response: str, header_ext: str = '.h', implementation_ext='.cpp', code_delimiter: str = "```") -> Tuple[str, str]:
@@ -58,51 +49,307 @@ def extract_header_implementation(response: str, header_ext: str = '.h', impleme
 
     :return: Best attempt at parsed header/implementation
     """
-    header = ''
-    is_in_header = False
+    extractor = HeaderImplementationExtractor(header_ext, implementation_ext, code_delimiter)
+    extractor.feed(response)
+
+    return extractor.result()
+
+
+def create_incremental_extractor(extractor_fn: Callable[[str], Any]) -> Optional[Any]:
+    """
+    Create incremental extractor that is equivalent to the given extractor function
+    :param extractor_fn: Extractor function, i.e. `extract_first_source_code`
+    :return: New incremental extractor or None if the function has no incremental version
+    """
+    if extractor_fn is extract_first_source_code:
+        return FirstSourceCodeExtractor()
+    elif extractor_fn is extract_header_implementation:
+        return HeaderImplementationExtractor()
+
+    return None
+
+
+def is_extracted(extractor_fn: Callable[[str], Any], response: str) -> bool:
+    """
+    Check that the extractor function finds what it is looking for in the response, rather than falling back to the
+    whole response
+    :param extractor_fn: Extractor function, i.e. `extract_first_source_code`
+    :param response: Response from the model
+    :return: True if the result was extracted
+    """
+    if extractor_fn is extract_first_source_code:
+        extractor = FirstSourceCodeExtractor()
+        extractor.feed(response)
+        return extractor.is_complete
+    elif extractor_fn is extract_header_implementation:
+        extractor = HeaderImplementationExtractor()
+        extractor.feed(response)
+        return extractor.is_header_done
+
+    return extractor_fn(response) is not None
+
+
+class FirstSourceCodeExtractor:
+    """
+    Resumable state machine behind `extract_first_source_code`. Response fragments are fed as they are generated and
+    the extractor reports when the first code block is complete, so the rest of the response does not need to be
+    generated.
+    """
+    _code_delimiter: str
+    _fragments: List[str]
+    _state: int
+
+    _unscanned: str
+    _unscanned_start_ix: int
+    _code_start_ix: int
+    _code_end_ix: int
+
+    _LOOKING_FOR_OPENING_DELIMITER = 0
+    _LOOKING_FOR_NEW_LINE = 1
+    _LOOKING_FOR_CLOSING_DELIMITER = 2
+    _COMPLETE = 3
+
+    def __init__(self, code_delimiter: str = "```") -> None:
+        self._code_delimiter = code_delimiter
+        self._fragments = []
+        self._state = self._LOOKING_FOR_OPENING_DELIMITER
+
+        self._unscanned = ''
+        self._unscanned_start_ix = 0
+        self._code_start_ix = -1
+        self._code_end_ix = -1
+
+    @property
+    def is_complete(self) -> bool:
+        return self._state == self._COMPLETE
+
+    def feed(self, fragment: str) -> bool:
+        """
+        Feed next fragment of the response
+        :param fragment: Response fragment
+        :return: True if the first code block is complete
+        """
+        self._fragments.append(fragment)
+        if self.is_complete:
+            return True
+
+        self._unscanned += fragment
+        while not self.is_complete:
+            if self._state == self._LOOKING_FOR_NEW_LINE:
+                ix = self._unscanned.find("\n")
+                if ix < 0:
+                    self._skip_unscanned(len(self._unscanned))
+                    break
+
+                self._code_start_ix = self._unscanned_start_ix + ix
+                self._skip_unscanned(ix + 1)
+                self._state = self._LOOKING_FOR_CLOSING_DELIMITER
+            else:
+                ix = self._unscanned.find(self._code_delimiter)
+                if ix < 0:
+                    # Delimiter could be split between fragments, so keep the tail
+                    self._skip_unscanned(max(0, len(self._unscanned) - len(self._code_delimiter) + 1))
+                    break
+
+                if self._state == self._LOOKING_FOR_CLOSING_DELIMITER:
+                    self._code_end_ix = self._unscanned_start_ix + ix
+
+                self._skip_unscanned(ix + len(self._code_delimiter))
+                self._state += 1
+
+        return self.is_complete
+
+    def result(self) -> str:
+        """
+        :return: The first code block or the whole response if there is no complete code block
+        """
+        response = ''.join(self._fragments)
+        if self.is_complete:
+            response = response[self._code_start_ix:self._code_end_ix]
+
+        return response.rstrip().lstrip()
+
+    def _skip_unscanned(self, length: int) -> None:
+        self._unscanned = self._unscanned[length:]
+        self._unscanned_start_ix += length
+
+
+class HeaderImplementationExtractor:
+    """
+    Resumable state machine behind `extract_header_implementation`. Response fragments are fed as they are generated
+    and the extractor reports when the header and the implementation code blocks are complete. Completion can only be
+    detected when the code blocks are separated with code delimiters, with comment based delimiters
+    ('// Player.h') the end of the implementation is unknown until the response ends.
+    """
+    _header_ext: str
+    _implementation_ext: str
+    _code_delimiter: str
 
-    implementation = ''
-    is_in_implementation = False
+    _fragments: List[str]
+    _partial_line: str
+
+    _header_lines: List[str]
+    _is_in_header: bool
+    _is_header_done: bool
+
+    _implementation_lines: List[str]
+    _is_in_implementation: bool
+    _is_implementation_done: bool
 
     # True in case header and implementation are separated by '// Filename.h' comment
-    is_comment_based_delimiter = False
+    _is_comment_based_delimiter: bool
 
-    for line in response.splitlines():
-        if line.lstrip().startswith(code_delimiter):
-            if is_comment_based_delimiter:
-                continue
+    def __init__(self, header_ext: str = '.h', implementation_ext='.cpp', code_delimiter: str = "```") -> None:
+        self._header_ext = header_ext
+        self._implementation_ext = implementation_ext
+        self._code_delimiter = code_delimiter
+
+        self._fragments = []
+        self._partial_line = ''
+
+        self._header_lines = []
+        self._is_in_header = False
+        self._is_header_done = False
+
+        self._implementation_lines = []
+        self._is_in_implementation = False
+        self._is_implementation_done = False
+
+        self._is_comment_based_delimiter = False
+
+    @property
+    def is_header_done(self) -> bool:
+        return self._is_header_done
+
+    @property
+    def is_implementation_done(self) -> bool:
+        return self._is_implementation_done
+
+    @property
+    def is_complete(self) -> bool:
+        return self._is_implementation_done
+
+    def feed(self, fragment: str) -> bool:
+        """
+        Feed next fragment of the response
+        :param fragment: Response fragment
+        :return: True if both header and implementation are complete
+        """
+        self._fragments.append(fragment)
+
+        lines = (self._partial_line + fragment).splitlines(keepends=True)
+        self._partial_line = ''
+
+        for ix, line in enumerate(lines):
+            line_content = line.splitlines()[0]
+
+            is_last_line = ix == len(lines) - 1
+            # Last line could continue in the next fragment. '\r' could be followed by '\n'
+            if is_last_line and (len(line_content) == len(line) or line.endswith("\r")):
+                self._partial_line = line
+            else:
+                self._process_line(line_content)
+
+        return self.is_complete
+
+    def result(self) -> Tuple[str, str]:
+        """
+        :return: Best attempt at parsed header/implementation
+        """
+        if len(self._partial_line) > 0:
+            self._process_line(self._partial_line.splitlines()[0])
+            self._partial_line = ''
+
+        header = ''.join(self._header_lines)
+        implementation = ''.join(self._implementation_lines)
 
-            is_opening_delimiter = not is_in_header and not is_in_implementation
+        # If we couldn't parse the response, just return everything in the header
+        if len(header) < 1 and len(implementation) < 1:
+            header = ''.join(self._fragments)
+            implementation = "SEE HEADER FOR FULL RESPONSE"
+
+        return header.rstrip().lstrip(), implementation.rstrip().lstrip()
+
+    def _process_line(self, line: str) -> None:
+        if line.lstrip().startswith(self._code_delimiter):
+            if self._is_comment_based_delimiter:
+                return
+
+            is_opening_delimiter = not self._is_in_header and not self._is_in_implementation
             if is_opening_delimiter:
-                is_header_present = len(header) > 0
+                is_header_present = len(self._header_lines) > 0
                 if is_header_present:
-                    is_in_implementation = True
-                    is_in_header = False
+                    self._is_in_implementation = True
+                    self._is_in_header = False
                 else:
-                    is_in_header = True
-                    is_in_implementation = False
+                    self._is_in_header = True
+                    self._is_in_implementation = False
             else:  # Closing delimiter
-                if is_in_header:
-                    is_in_header = False
-                if is_in_implementation:
-                    is_in_implementation = False
-        elif line.lstrip().startswith("//") and line.rstrip().endswith(header_ext):
-            is_in_header = True
-            is_in_implementation = False
-            is_comment_based_delimiter = True
-        elif line.lstrip().startswith("//") and line.rstrip().endswith(implementation_ext):
-            is_in_header = False
-            is_in_implementation = True
-            is_comment_based_delimiter = True
+                if self._is_in_header:
+                    self._is_in_header = False
+                    self._is_header_done = True
+                if self._is_in_implementation:
+                    self._is_in_implementation = False
+                    self._is_implementation_done = True
+        elif line.lstrip().startswith("//") and line.rstrip().endswith(self._header_ext):
+            self._is_in_header = True
+            self._is_in_implementation = False
+            self._is_comment_based_delimiter = True
+        elif line.lstrip().startswith("//") and line.rstrip().endswith(self._implementation_ext):
+            self._is_header_done = self._is_header_done or self._is_in_header
+            self._is_in_header = False
+            self._is_in_implementation = True
+            self._is_comment_based_delimiter = True
         else:
-            if is_in_header:
-                header += line + "\n"
-            elif is_in_implementation:
-                implementation += line + "\n"
+            if self._is_in_header:
+                self._header_lines.append(line + "\n")
+            elif self._is_in_implementation:
+                self._implementation_lines.append(line + "\n")
+
+
+def extract_delimited_files(response: str, file_names: List[str], file_delimiter: str = "### FILE:", code_delimiter: str = "```") -> Optional[Dict[str, str]]:
+    """
+    Split a response that contains several files. Each file is expected to start with a line made of the file
+    delimiter and file name, exactly as requested in the prompt, i.e. '### FILE: Player.cs', followed by the file code.
+    Delimiters inside code blocks are part of the code.
+
+    :param response:        Response from the model
+    :param file_names:      Names of the files that were requested
+    :param file_delimiter:  Delimiter that starts every file. Default is '### FILE:'
+    :param code_delimiter:  Delimiter that is used to separate the code. Default is ````
+
+    :return: Dictionary with code for each file name or None if the response cannot be unambiguously mapped to the
+             requested files (missing, unknown or duplicate files)
+    """
+    sections: Dict[str, List[str]] = {}
+    current_lines: Optional[List[str]] = None
+    is_in_code = False
+
+    for line in response.splitlines():
+        stripped_line = line.strip()
+        if not is_in_code and stripped_line.startswith(file_delimiter + " "):
+            file_name = stripped_line[len(file_delimiter):].strip().strip("`")
+            if file_name in sections:
+                return None  # Duplicate file, impossible to tell which one is correct
+
+            current_lines = []
+            sections[file_name] = current_lines
+            continue
+
+        if stripped_line.startswith(code_delimiter):
+            is_in_code = not is_in_code
+        if current_lines is not None:
+            current_lines.append(line)
+
+    if sorted(sections.keys()) != sorted(file_names):
+        return None
+
+    result = {}
+    for file_name, lines in sections.items():
+        code = extract_first_source_code("\n".join(lines), code_delimiter)
+        if len(code) < 1:
+            return None
 
-    # If we couldn't parse the response, just return everything in the header
-    if len(header) < 1 and len(implementation) < 1:
-        header = response
-        implementation = "SEE HEADER FOR FULL RESPONSE"
+        result[file_name] = code
 
-    return header.rstrip().lstrip(), implementation.rstrip().lstrip()
+    return result
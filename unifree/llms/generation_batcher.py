@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Any
+
+from unifree.utils import increment_statistic
+
+FragmentCallback = Optional[Callable[[str], bool]]
+BatchGenerator = Callable[[List[Any], List[FragmentCallback]], List[str]]
+
+
+class _GenerationRequest:
+    prompt: Any
+    on_fragment: FragmentCallback
+    future: Future
+
+    def __init__(self, prompt: Any, on_fragment: FragmentCallback) -> None:
+        self.prompt = prompt
+        self.on_fragment = on_fragment
+        self.future = Future()
+
+
+class GenerationBatcher:
+    """
+    Collects generation requests coming from concurrent threads and runs them through the model in batches. The first
+    request of a batch waits at most 'max_wait_ms' for other requests to join, the batch is started earlier as soon as
+    it reaches 'max_batch_size'. Requests arriving while a batch is being generated form the next batch.
+
+    All generation happens on a single background thread, so the model is never used concurrently.
+    """
+    _generate_batch: BatchGenerator
+    _max_batch_size: int
+    _max_wait_sec: float
+
+    _queue: "queue.Queue[_GenerationRequest]"
+    _thread: Optional[threading.Thread]
+    _lock: threading.Lock
+
+    def __init__(self, generate_batch: BatchGenerator, max_batch_size: int = 4, max_wait_ms: float = 20) -> None:
+        """
+        :param generate_batch: Function that generates responses for a list of prompts. It receives one (optional)
+                               fragment callback per prompt and returns responses in the order of the prompts
+        :param max_batch_size: Maximum number of prompts generated together
+        :param max_wait_ms: How long the first request of a batch waits for other requests to join
+        """
+        self._generate_batch = generate_batch
+        self._max_batch_size = max(1, max_batch_size)
+        self._max_wait_sec = max(0.0, max_wait_ms / 1000.0)
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def generate(self, prompt: Any, on_fragment: FragmentCallback = None) -> str:
+        """
+        Generate response for the prompt as a part of a batch. Blocks until the response is ready
+        :param prompt: Prompt to generate response for, passed to the batch generation function as is
+        :param on_fragment: Called (from the batching thread) with every generated fragment, returns True when the
+                            rest of the response is not needed
+        :return: Generated response
+        """
+        self._ensure_started()
+
+        request = _GenerationRequest(prompt, on_fragment)
+        self._queue.put(request)
+
+        return request.future.result()
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._serve, name="generation-batcher", daemon=True)
+                self._thread.start()
+
+    def _serve(self) -> None:
+        while True:
+            batch = self._collect_batch()
+
+            try:
+                responses = self._generate_batch(
+                    [request.prompt for request in batch],
+                    [request.on_fragment for request in batch],
+                )
+            except BaseException as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            increment_statistic("LLM generation batches")
+            increment_statistic("LLM batched generations", len(batch))
+
+            for request, response in zip(batch, responses):
+                request.future.set_result(response)
+
+    def _collect_batch(self) -> List[_GenerationRequest]:
+        batch = [self._queue.get()]
+
+        deadline = time.monotonic() + self._max_wait_sec
+        while len(batch) < self._max_batch_size:
+            remaining_sec = deadline - time.monotonic()
+            try:
+                if remaining_sec > 0:
+                    batch.append(self._queue.get(timeout=remaining_sec))
+                else:
+                    batch.append(self._queue.get_nowait())  # Take whatever is already waiting
+            except queue.Empty:
+                break
+
+        return batch
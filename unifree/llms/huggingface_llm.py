@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
-from typing import Optional, List, Dict
+import threading
+from dataclasses import dataclass
+from typing import Optional, List, Dict, Callable, Any, ClassVar
 
 from unifree import LLM, QueryHistoryItem, log
+from unifree.llms.generation_batcher import GenerationBatcher
 from unifree.utils import get_or_create_global_instance
 
 
@@ -11,7 +14,19 @@ from unifree.utils import get_or_create_global_instance
 
 class HuggingfaceLLM(LLM):
     """
-    This is a model that represents Huggingface 'AutoModelForCausalLM' transformer model.
+    This is a model that represents Huggingface 'AutoModelForCausalLM' transformer model. By default the model is
+    loaded with ctransformers, 'backend: transformers' loads it with Huggingface transformers instead.
+
+    When 'batching' is configured, concurrent queries (i.e. chunks translated in parallel) are collected for up to
+    'max_wait_ms' and generated together. Transformers backend decodes the whole batch at once, ctransformers can only
+    decode one prompt at a time, so its batches are generated one after another on a single thread.
+
+    Prompts start with the system prompt and the few-shot history, which are mostly the same between requests. With
+    'prefix_cache' configured, history examples are always placed in the same relative order (the order they were first
+    seen in), so requests sharing examples share a longer prefix. Transformers backend keeps the model state after
+    such prefixes in an LRU cache limited by 'max_memory_mb'. ctransformers reuses the state of the previously evaluated
+    prompt only, so prompts of a batch are generated in sorted order to put prompts with common prefixes one after
+    another.
 
       llm:
         class: HuggingfaceLLM
@@ -20,57 +35,202 @@ class HuggingfaceLLM(LLM):
           context_length: 4096
           model_type: llama
           gpu_layers: 50
+          max_response_tokens: 2000   # Optional, limit on the number of generated tokens
+          stop: ["[INST]"]            # Optional, stop sequences
+          backend: ctransformers      # Optional, 'ctransformers' (default) or 'transformers'
+          tokenizer_checkpoint: codellama/CodeLlama-34b-Instruct-hf  # Optional, tokenizer used when only tokens are counted
+          batching:                   # Optional, generate concurrent queries in batches
+            max_batch_size: 4
+            max_wait_ms: 20
+          prefix_cache:               # Optional, reuse model state of common prompt prefixes
+            max_memory_mb: 1024
 
     """
+    _history_item_ordinals: ClassVar[Dict[str, int]] = {}
+    _history_item_ordinals_lock: ClassVar[threading.Lock] = threading.Lock()
+
     _model: Optional[any]
+    _tokenizer: Optional[any]
+    _batcher: Optional[GenerationBatcher]
 
     def __init__(self, config: Dict) -> None:
         super().__init__(config)
 
         self._model = None
+        self._tokenizer = None
+        self._batcher = None
 
     def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
-        prompt = ''
+        return self.query_streaming(user, system, history)
+
+    def query_streaming(
+            self,
+            user: str,
+            system: Optional[str] = None,
+            history: Optional[List[QueryHistoryItem]] = None,
+            on_fragment: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        prompt = self.create_prompt(user, system, history)
+
+        log.debug(f"\n==== LLM REQUEST ====\n{prompt.text}\n")
+
+        if self._batcher:
+            response = self._batcher.generate(prompt, on_fragment)
+        else:
+            response = self._generate_batch([prompt], [on_fragment])[0]
+
+        log.debug(f"\n==== LLM RESPONSE ====\n{response}\n")
+
+        return response
+
+    def create_prompt(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> "_Prompt":
+        """
+        Create prompt from the query. The system prompt and history come first, so prompts of different queries share
+        as long prefix as possible
+        :return: Prompt and the length of its prefix shared with other queries (everything before the user query)
+        """
+        prefix = ''
         if system:
-            prompt += self._to_user_prompt(f"Remember these rules:\n{system}\n")
-            prompt += "\nCertainly, I will remember and follow these rules.\n"
+            prefix += self._to_user_prompt(f"Remember these rules:\n{system}\n")
+            prefix += "\nCertainly, I will remember and follow these rules.\n"
 
         if history:
+            if self.config["config"].get("prefix_cache"):
+                history = self._order_history(history)
+
             for item in history:
                 if item.role == "user":
-                    prompt += self._to_user_prompt(f"\n{item.content}\n")
+                    prefix += self._to_user_prompt(f"\n{item.content}\n")
                 else:
-                    prompt += f"\n{item.content}\n"
+                    prefix += f"\n{item.content}\n"
 
-        prompt += self._to_user_prompt(f"\n{user}\n")
+        return _Prompt(
+            text=prefix + self._to_user_prompt(f"\n{user}\n"),
+            prefix_length=len(prefix),
+        )
 
-        log.debug(f"\n==== LLM REQUEST ====\n{prompt}\n")
+    @classmethod
+    def _order_history(cls, history: List[QueryHistoryItem]) -> List[QueryHistoryItem]:
+        # History is a list of request/response pairs ordered by relevance, which differs between queries. Pairs are
+        # reordered by when they were first seen, which is the same for all queries
+        pairs = [history[ix:ix + 2] for ix in range(0, len(history), 2)]
 
-        response = self._model(prompt)
+        with cls._history_item_ordinals_lock:
+            for pair in pairs:
+                cls._history_item_ordinals.setdefault(pair[0].content, len(cls._history_item_ordinals))
 
-        log.debug(f"\n==== LLM RESPONSE ====\n{response}\n")
+            pairs.sort(key=lambda p: cls._history_item_ordinals[p[0].content])
 
-        return response
+        return [item for pair in pairs for item in pair]
 
     def initialize(self) -> None:
-        from ctransformers import AutoModelForCausalLM
+        llm_config = self.config["config"]
+        checkpoint = llm_config["checkpoint"]
+
+        self._model = get_or_create_global_instance(checkpoint, self._load_model)
+
+        batching_config = llm_config.get("batching")
+        if batching_config:
+            # One batcher per model, so queries from all files (LLM instances) can be batched together
+            self._batcher = get_or_create_global_instance(f"{checkpoint}:batcher", lambda: GenerationBatcher(
+                self._generate_batch,
+                max_batch_size=batching_config.get("max_batch_size") or 4,
+                max_wait_ms=batching_config.get("max_wait_ms") or 20,
+            ))
+
+    def initialize_tokenizer(self) -> None:
+        llm_config = self.config["config"]
+        checkpoint = llm_config["checkpoint"]
 
+        tokenizer_checkpoint = llm_config.get("tokenizer_checkpoint")
+        if not tokenizer_checkpoint and llm_config.get("backend") == "transformers":
+            tokenizer_checkpoint = checkpoint
+
+        if tokenizer_checkpoint:
+            from transformers import AutoTokenizer
+            self._tokenizer = get_or_create_global_instance(
+                f"{tokenizer_checkpoint}:tokenizer",
+                lambda: AutoTokenizer.from_pretrained(tokenizer_checkpoint),
+            )
+        else:
+            # GGUF weights are memory mapped by ctransformers and tokenization never touches them, so a CPU-only
+            # instance keeps only the vocabulary resident
+            self._model = get_or_create_global_instance(f"{checkpoint}:cpu", lambda: self._load_model(gpu_layers=0))
+
+    def _load_model(self, gpu_layers: Optional[int] = None) -> any:
         llm_config = self.config["config"]
         checkpoint = llm_config["checkpoint"]
 
-        self._model = get_or_create_global_instance(checkpoint, lambda: AutoModelForCausalLM.from_pretrained(
+        if llm_config.get("backend") == "transformers":
+            from unifree.llms.transformers_model import TransformersModel
+            return TransformersModel.from_pretrained(
+                checkpoint,
+                prefix_cache_mb=(llm_config.get("prefix_cache") or {}).get("max_memory_mb"),
+            )
+
+        from ctransformers import AutoModelForCausalLM
+        return AutoModelForCausalLM.from_pretrained(
             checkpoint,
             model_type=llm_config["model_type"],
-            gpu_layers=llm_config["gpu_layers"],
+            gpu_layers=llm_config["gpu_layers"] if gpu_layers is None else gpu_layers,
             context_length=llm_config["context_length"],
-        ))
+        )
+
+    def _generate_batch(self, prompts: List["_Prompt"], on_fragments: List[Optional[Callable[[str], bool]]]) -> List[str]:
+        if hasattr(self._model, "generate_batch"):
+            return self._model.generate_batch(
+                [prompt.text for prompt in prompts],
+                on_fragments,
+                prefix_lengths=[prompt.prefix_length for prompt in prompts],
+                **self._generation_parameters(),
+            )
+
+        # ctransformers only reuses the longest common prefix with the previously evaluated prompt
+        responses = [''] * len(prompts)
+        for prompt_ix in sorted(range(len(prompts)), key=lambda ix: prompts[ix].text):
+            responses[prompt_ix] = self._generate(prompts[prompt_ix].text, on_fragments[prompt_ix])
+
+        return responses
+
+    def _generate(self, prompt: str, on_fragment: Optional[Callable[[str], bool]]) -> str:
+        fragments = []
+        tokens = self._model(prompt, stream=True, **self._generation_parameters())
+        try:
+            for fragment in tokens:
+                fragments.append(fragment)
+                if on_fragment and on_fragment(fragment):
+                    break  # Rest of the response is not needed
+        finally:
+            tokens.close()  # Stops generation
+
+        return ''.join(fragments)
 
     def fits_in_one_prompt(self, token_count: int) -> bool:
         return token_count < self.config["config"]["context_length"]
 
     def count_tokens(self, source_text: str) -> int:
+        if self._tokenizer:
+            return len(self._tokenizer.encode(source_text, add_special_tokens=False))
+
         return len(self._model.tokenize(source_text))
 
+    def _generation_parameters(self) -> Dict[str, Any]:
+        llm_config = self.config["config"]
+
+        result = {}
+        if llm_config.get("max_response_tokens"):
+            result["max_new_tokens"] = llm_config["max_response_tokens"]
+        if llm_config.get("stop"):
+            result["stop"] = llm_config["stop"]
+
+        return result
+
     def _to_user_prompt(self, user: str) -> str:
         prompt_template = self.config["config"]["prompt_template"]
         return prompt_template.replace("${PROMPT}", user)
+
+
+@dataclass
+class _Prompt:
+    text: str
+    prefix_length: int
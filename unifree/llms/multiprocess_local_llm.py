@@ -3,11 +3,15 @@ import sys
 # Copyright (c) Unifree
 # This code is licensed under MIT license (see LICENSE.txt for details)
 
-from concurrent.futures import ProcessPoolExecutor
+import concurrent.futures
+import json
+import multiprocessing
+import threading
 from dataclasses import dataclass
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Any
 
 from unifree import LLM, QueryHistoryItem, log
+from unifree.llms.supervised_worker_pool import SupervisedWorkerPool
 from unifree.utils import load_llm
 
 
@@ -27,10 +31,33 @@ class MultiprocessLocalLLM(LLM):
         wrapper_config:
           num_workers: 5
           query_timeout_sec: 10
+          queue_timeout_sec: 600        # Optional, longest time a query waits for a worker, defaults to 600
+          max_start_failures: 5         # Optional, see below
+          model_sharing: fork           # Optional, see below
+          tokenizer_only_parent: true   # Optional, see below
     ```
+
+    By default every worker process loads its own copy of the model and the parent loads one more copy to count tokens.
+    Two options reduce that:
+      - 'model_sharing: fork' loads the model once in the parent and forks workers afterwards. Workers share the
+        parent's memory copy-on-write, so weights that are only read are held once, no matter the number of workers.
+        Workers are forked once, by `initialize` right after the model is loaded. Forking a process that runs other
+        threads (migration workers, the pool supervisor) could copy a lock another thread holds, and hang the child on
+        it, so such workers are not restarted: a worker that is killed or crashes gives up its slot and the remaining
+        workers take its queries.
+      - 'tokenizer_only_parent: true' makes the parent load only the tokenizer (see `LLM.initialize_tokenizer`), for
+        setups where workers have to load their own models (i.e. each worker uses its own GPU). Ignored with 'fork'.
+    Memory mapped model files (GGUF loaded by ctransformers) are shared through the page cache in either case.
+
+    Workers are supervised (see `SupervisedWorkerPool`): a worker that spends more than 'query_timeout_sec' on a query
+    is killed and restarted, so is a crashed worker (not with 'model_sharing: fork', see above). Queries go to the worker with the shortest queue. A worker that
+    exits while loading the model is restarted with a backoff, after 'max_start_failures' exits in a row it is given up.
+    A query fails if it does not finish within 'queue_timeout_sec' plus 'query_timeout_sec'.
+
+    Instances with the same configuration share the worker processes.
     """
-    _shared_executor: Optional[ProcessPoolExecutor] = None
-    _query_timeout_sec: int = 20
+    _shared_executors: Dict[str, SupervisedWorkerPool] = {}
+    _shared_executor_lock: threading.Lock = threading.Lock()
 
     _local_model: Optional[LLM]
 
@@ -41,20 +68,35 @@ class MultiprocessLocalLLM(LLM):
 
     def initialize(self) -> None:
         llm_config = self.config["llm_config"]
+        wrapper_config = self.config["wrapper_config"]
 
         self._local_model = load_llm(llm_config)
-        self._local_model.initialize()
+        if wrapper_config.get("tokenizer_only_parent") and wrapper_config.get("model_sharing") != "fork":
+            self._local_model.initialize_tokenizer()
+        else:
+            self._local_model.initialize()
+
+        if wrapper_config.get("model_sharing") == "fork":
+            self.maybe_initialize_shared_executor(self.config, self._local_model)  # Fork before queries start threads
 
     def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
-        self.maybe_initialize_shared_executor(self.config)
+        executor = self.maybe_initialize_shared_executor(self.config, self._local_model)
 
-        result_future = self._shared_executor.submit(_multi_process_worker_translate, _QueryRequest(
+        result_future = executor.submit(_QueryRequest(
             user=user,
             system=system,
             history=history
         ))
+        wrapper_config = self.config["wrapper_config"]
+        timeout_sec = (wrapper_config.get("queue_timeout_sec") or 600) + (wrapper_config.get("query_timeout_sec") or 0)
+
+        # WorkerTimeoutError of the pool is a TimeoutError too, so the wait is separate from getting the result
+        if not concurrent.futures.wait([result_future], timeout=timeout_sec).done:
+            result_future.cancel()  # Still queued, no worker took it
+            raise RuntimeError(f"LocalLLM query failed: no response in {timeout_sec} sec")
+
         try:
-            result = result_future.result(timeout=self._query_timeout_sec)
+            result = result_future.result()
             if result.is_success():
                 return result.response
             else:
@@ -70,18 +112,80 @@ class MultiprocessLocalLLM(LLM):
         assert self._local_model is not None
         return self._local_model.count_tokens(source_text)
 
+    def count_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        assert self._local_model is not None
+        return self._local_model.count_tokens_batch(source_texts)
+
+    def estimate_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        assert self._local_model is not None
+        return self._local_model.estimate_tokens_batch(source_texts)
+
+    def text_fits_in_one_prompt(self, source_text: str, extra_token_count: int = 0) -> bool:
+        assert self._local_model is not None
+        return self._local_model.text_fits_in_one_prompt(source_text, extra_token_count)
+
     @classmethod
-    def maybe_initialize_shared_executor(cls, config: Dict):
-        if not cls._shared_executor:
+    def maybe_initialize_shared_executor(cls, config: Dict, local_model: Optional[LLM] = None) -> SupervisedWorkerPool:
+        """
+        :return: Worker pool of the configuration, started on the first call
+        """
+        executor_key = _executor_key(config)
+        executor = cls._shared_executors.get(executor_key)
+        if executor:
+            return executor
+
+        with cls._shared_executor_lock:
+            executor = cls._shared_executors.get(executor_key)
+            if executor:
+                return executor
+
             wrapper_config = config["wrapper_config"]
             llm_config = config["llm_config"]
-            # cls._shared_executor = ProcessPoolExecutor(
-            cls._shared_executor = ProcessPoolExecutor(
-                max_workers=wrapper_config["num_workers"],
+
+            mp_context = None
+            inherited_llm = None
+            restart_workers = True
+            if wrapper_config.get("model_sharing") == "fork":
+                # Workers inherit the model loaded in the parent instead of loading their own, forked processes get
+                # their arguments without pickling. Replacements would be forked from a multithreaded parent
+                inherited_llm = local_model
+                mp_context = multiprocessing.get_context("fork")
+                restart_workers = False
+
+            executor = SupervisedWorkerPool(
+                worker_count=wrapper_config["num_workers"],
                 initializer=_multi_process_worker_init,
-                initargs=(llm_config,)
+                initargs=(llm_config, inherited_llm),
+                handler=_multi_process_worker_translate,
+                task_timeout_sec=wrapper_config.get("query_timeout_sec"),
+                max_start_failures=wrapper_config.get("max_start_failures") or 5,
+                restart_workers=restart_workers,
+                mp_context=mp_context,
             )
-            cls._query_timeout_sec = wrapper_config["query_timeout_sec"]
+            cls._shared_executors[executor_key] = executor
+
+            return executor
+
+    def health_stats(self) -> Optional[Dict[str, Any]]:
+        """
+        :return: State of the worker processes (see `SupervisedWorkerPool.health`), None if workers are not started
+        """
+        executor = self._shared_executors.get(_executor_key(self.config))
+        return executor.health() if executor else None
+
+    @classmethod
+    def shutdown_shared_executor(cls) -> None:
+        """
+        Stop the worker processes of every configuration
+        """
+        with cls._shared_executor_lock:
+            for executor in cls._shared_executors.values():
+                executor.shutdown()
+            cls._shared_executors.clear()
+
+
+def _executor_key(config: Dict) -> str:
+    return json.dumps({"llm_config": config["llm_config"], "wrapper_config": config["wrapper_config"]}, sort_keys=True, default=str)
 
 
 @dataclass
@@ -109,15 +213,19 @@ class _QueryResult:
 _process_local_llm: Optional[LLM] = None
 
 
-def _multi_process_worker_init(config: Dict):
+def _multi_process_worker_init(config: Dict, inherited_llm: Optional[LLM] = None):
     global _process_local_llm
 
+    if inherited_llm is not None:
+        _process_local_llm = inherited_llm  # Forked from the parent process
+        return
+
     try:
         _process_local_llm = load_llm(config)
         _process_local_llm.initialize()
     except Exception as e:
         log.error(f"Failed to load local LLM model with: {e}", exc_info=e)
-        _process_local_llm = None
+        raise  # The worker exits before it is ready, the pool restarts it with a backoff or gives up its slot
 
 
 def _multi_process_worker_translate(query: _QueryRequest) -> _QueryResult:
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import json
+from typing import Dict, List, Tuple, Optional, Callable
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from unifree.llms.chatgpt_llm import ChatGptLLM
+from unifree.utils import get_or_create_global_instance
+
+
+class OpenAiCompatibleLLM(ChatGptLLM):
+    """
+    This class queries any server that implements OpenAI chat completions API (OpenAI itself, llama.cpp server,
+    vLLM, etc.). Requests go through a pooled HTTP session that keeps connections alive between requests.
+
+    The configuration looks like:
+
+    ```
+    llm:
+      class: OpenAiCompatibleLLM
+      config:
+          base_url: http://localhost:8080/v1
+          secret_key: <INSERTED DYNAMICALLY BY free.py>
+          model: codellama-34b-instruct
+          max_tokens: 4000
+          connection_pool_size: 16
+          connect_timeout_sec: 10
+          read_timeout_sec: 600
+          stream: true
+    ```
+
+    """
+
+    def request_completion(self, messages: List[Dict[str, str]]) -> str:
+        http_response = self._post_chat_completions(messages, stream=False)
+
+        completion = http_response.json()
+        choices = completion.get("choices") or []
+        if len(choices) < 1 or not choices[0].get("message", {}).get("content"):
+            raise RuntimeError(f"{self.base_url} returned malformed response: {completion}")
+
+        return choices[0]["message"]["content"]
+
+    def request_streaming_completion(self, messages: List[Dict[str, str]], on_fragment: Optional[Callable[[str], bool]]) -> str:
+        fragments = []
+
+        with self._post_chat_completions(messages, stream=True) as http_response:
+            # Server-sent events, one 'data: <json>' line per chunk
+            for line in http_response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    continue  # Read the stream to the end, so the connection can be reused
+
+                choices = json.loads(data).get("choices") or []
+                fragment = choices[0].get("delta", {}).get("content") if len(choices) > 0 else None
+                if fragment:
+                    fragments.append(fragment)
+                    if on_fragment and on_fragment(fragment):
+                        break  # Closing the response before it is fully read drops the connection and stops generation
+
+        if len(fragments) < 1:
+            raise RuntimeError(f"{self.base_url} returned empty response")
+
+        return ''.join(fragments)
+
+    def _post_chat_completions(self, messages: List[Dict[str, str]], stream: bool) -> requests.Response:
+        llm_config = self.config["config"]
+
+        headers = {}
+        if llm_config.get("secret_key"):
+            headers["Authorization"] = f"Bearer {llm_config['secret_key']}"
+
+        body = self.completion_parameters()
+        body["messages"] = messages
+        if stream:
+            body["stream"] = True
+
+        http_response = self.session.post(
+            f"{self.base_url}/chat/completions",
+            json=body,
+            headers=headers,
+            timeout=self.timeout,
+            stream=stream,
+        )
+        http_response.raise_for_status()
+
+        return http_response
+
+    @property
+    def base_url(self) -> str:
+        return (self.config["config"].get("base_url") or "https://api.openai.com/v1").rstrip("/")
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        return self._llm_config_value("connect_timeout_sec", 10), self._llm_config_value("read_timeout_sec", 600)
+
+    @property
+    def session(self) -> requests.Session:
+        # A new LLM instance is created for every migrated file, so the session (and its connection pool) is shared
+        # between all instances talking to the same server
+        return get_or_create_global_instance(f"openai_compatible_session:{self.base_url}", self._create_session)
+
+    def _create_session(self) -> requests.Session:
+        pool_size = self._llm_config_value("connection_pool_size", 16)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return session
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import json
+import threading
+import time
+from typing import Optional, List, Dict, Callable, Tuple
+
+from unifree import LLM, QueryHistoryItem, log, current_query_context
+from unifree.llms.batch_job_llm import DeferredResponseError
+from unifree.utils import load_llm, get_or_create_global_instance, increment_statistic
+
+
+class _RateLimit:
+    """
+    Token bucket: holds up to 'per_minute' units and refills at 'per_minute' units per minute
+    """
+    _per_minute: float
+    _available: float
+    _updated_at: float
+
+    def __init__(self, per_minute: float) -> None:
+        self._per_minute = per_minute
+        self._available = per_minute
+        self._updated_at = time.monotonic()
+
+    def wait_time_sec(self, amount: float) -> float:
+        self._refill()
+
+        amount = min(amount, self._per_minute)  # Larger requests only have to wait for a full bucket
+        return max(0.0, (amount - self._available) * 60.0 / self._per_minute)
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self._available -= min(amount, self._per_minute)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._available = min(self._per_minute, self._available + (now - self._updated_at) * self._per_minute / 60.0)
+        self._updated_at = now
+
+
+class _Backend:
+    name: str
+    llm: LLM
+    max_concurrency: Optional[int]
+    rate_limits: List[Tuple[str, _RateLimit]]
+
+    outstanding: int
+    latency_sec: Optional[float]
+    consecutive_failures: int
+    ejected_until: float
+
+    def __init__(self, config: Dict) -> None:
+        self.name = config.get("name") or config["llm_config"]["class"]
+        self.llm = load_llm(config["llm_config"])
+        self.max_concurrency = config.get("max_concurrency")
+
+        self.rate_limits = []
+        if config.get("requests_per_minute"):
+            self.rate_limits.append(("requests", _RateLimit(config["requests_per_minute"])))
+        if config.get("tokens_per_minute"):
+            self.rate_limits.append(("tokens", _RateLimit(config["tokens_per_minute"])))
+
+        self.outstanding = 0
+        self.latency_sec = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def wait_time_sec(self, token_count: int, now: float, ignore_ejection: bool = False) -> Optional[float]:
+        """
+        :return: How long to wait until the backend can take the query, None if it has to wait for a running query
+        """
+        if self.max_concurrency and self.outstanding >= self.max_concurrency:
+            return None
+
+        wait_time_sec = 0.0 if ignore_ejection else max(0.0, self.ejected_until - now)
+        for kind, rate_limit in self.rate_limits:
+            wait_time_sec = max(wait_time_sec, rate_limit.wait_time_sec(token_count if kind == "tokens" else 1))
+
+        return wait_time_sec
+
+    def cost(self, default_latency_sec: float) -> float:
+        return (self.outstanding + 1) * (self.latency_sec if self.latency_sec is not None else default_latency_sec)
+
+
+class _Pool:
+    """
+    State of the backends shared by all PoolLLM instances with the same configuration
+    """
+    backends: List[_Backend]
+    failure_threshold: int
+    ejection_sec: float
+    latency_smoothing: float
+
+    _condition: threading.Condition
+
+    def __init__(self, config: Dict) -> None:
+        health_config = config.get("health") or {}
+
+        self.backends = [_Backend(backend_config) for backend_config in config.get("backends") or []]
+        self.failure_threshold = health_config.get("failure_threshold") or 3
+        self.ejection_sec = health_config.get("ejection_sec") or 30
+        self.latency_smoothing = health_config.get("latency_smoothing") or 0.3
+
+        self._condition = threading.Condition()
+
+        if len(self.backends) < 1:
+            raise RuntimeError("PoolLLM requires at least one backend under 'backends'")
+
+        for backend in self.backends:
+            backend.llm.initialize()
+
+    def acquire(self, token_count: int, excluded: List[_Backend]) -> _Backend:
+        """
+        Wait for the backend with the lowest expected latency that is healthy, below its concurrency limit and within
+        its rate limits
+        :param token_count: Estimated size of the query, for token rate limits
+        :param excluded: Backends that already failed this query, used only if there is nothing else
+        :return: Backend to send the query to, its outstanding query count is already increased
+        """
+        with self._condition:
+            while True:
+                candidates = [backend for backend in self.backends if backend not in excluded] or self.backends
+
+                now = time.monotonic()
+                # With every backend ejected, trying one beats stalling the migration
+                ignore_ejection = all(backend.ejected_until > now for backend in candidates)
+                wait_times = [(backend, backend.wait_time_sec(token_count, now, ignore_ejection)) for backend in candidates]
+
+                ready = [backend for backend, wait_time in wait_times if wait_time == 0]
+                if len(ready) > 0:
+                    known_latencies = [backend.latency_sec for backend in self.backends if backend.latency_sec is not None]
+                    default_latency_sec = min(known_latencies) if len(known_latencies) > 0 else 1.0
+
+                    backend = min(ready, key=lambda b: b.cost(default_latency_sec))
+                    backend.outstanding += 1
+                    for kind, rate_limit in backend.rate_limits:
+                        rate_limit.consume(token_count if kind == "tokens" else 1)
+
+                    return backend
+
+                timed_waits = [wait_time for _, wait_time in wait_times if wait_time is not None]
+                self._condition.wait(min(timed_waits) if len(timed_waits) > 0 else None)
+
+    def release(self, backend: _Backend, latency_sec: Optional[float], is_failure: bool = True) -> None:
+        """
+        :param backend: Backend returned by `acquire`
+        :param latency_sec: How long the query took, None if it failed or got no response
+        :param is_failure: Whether a query without latency counts as a failure of the backend
+        """
+        with self._condition:
+            backend.outstanding -= 1
+
+            if latency_sec is not None:
+                backend.consecutive_failures = 0
+                backend.latency_sec = latency_sec if backend.latency_sec is None else \
+                    self.latency_smoothing * latency_sec + (1 - self.latency_smoothing) * backend.latency_sec
+            elif is_failure:
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.failure_threshold:
+                    log.warn(f"Backend '{backend.name}' failed {backend.consecutive_failures} times in a row, ejecting it for {self.ejection_sec}s")
+                    increment_statistic("LLM backend ejections")
+
+                    backend.consecutive_failures = 0
+                    backend.ejected_until = time.monotonic() + self.ejection_sec
+
+            self._condition.notify_all()
+
+
+class PoolLLM(LLM):
+    """
+    This class spreads queries over several LLMs (i.e. the same model behind different API keys or self-hosted
+    servers). Every query goes to the backend with the lowest expected latency: the number of queries it is running
+    times its average query latency. Backends over their concurrency or rate limits are skipped, if all of them are,
+    the query waits.
+
+    A failed query is retried on another backend. A backend failing 'failure_threshold' queries in a row is ejected
+    (gets no queries) for 'ejection_sec' seconds.
+
+    The first backend is used to count tokens and plan chunks, so all backends should run similar models.
+
+    The configuration would look like:
+
+    ```
+    llm:
+      class: PoolLLM
+      backends:
+        - name: key-1
+          max_concurrency: 8                # Optional, maximum number of queries in flight
+          requests_per_minute: 500          # Optional
+          tokens_per_minute: 80000          # Optional, counts (estimated) prompt tokens
+          llm_config:
+            class: <LLM class>
+            config: <LLM config>
+        - name: local-server
+          llm_config:
+            class: <LLM class>
+            config: <LLM config>
+      health:                               # Optional
+        failure_threshold: 3
+        ejection_sec: 30
+    ```
+    """
+    _pool: Optional[_Pool]
+
+    def __init__(self, config: Dict) -> None:
+        super().__init__(config)
+
+        self._pool = None
+
+    def initialize(self) -> None:
+        # Strategies create an LLM per file, they all have to share the same backends to balance between them
+        pool_key = json.dumps({"backends": self.config.get("backends"), "health": self.config.get("health")}, sort_keys=True, default=str)
+        self._pool = get_or_create_global_instance(f"pool_llm:{pool_key}", lambda: _Pool(self.config))
+
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        return self.query_streaming(user, system, history)
+
+    def query_streaming(
+            self,
+            user: str,
+            system: Optional[str] = None,
+            history: Optional[List[QueryHistoryItem]] = None,
+            on_fragment: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        assert self._pool is not None
+
+        texts = [user] + ([system] if system else []) + [item.content for item in history or []]
+        token_count = sum(self.primary_llm.estimate_tokens_batch(texts))
+
+        failed: List[_Backend] = []
+        while True:
+            backend = self._pool.acquire(token_count, failed)
+            increment_statistic(f"LLM queries sent to '{backend.name}'")
+
+            started_at = time.monotonic()
+            try:
+                response = backend.llm.query_streaming(user, system, history, on_fragment)
+            except DeferredResponseError:
+                self._pool.release(backend, None, is_failure=False)
+                raise  # Exported to a batch job, another backend would export it again
+            except Exception as e:
+                self._pool.release(backend, None)
+
+                failed.append(backend)
+                if len(failed) >= len(self._pool.backends):
+                    raise
+
+                log.warn(f"Query to '{backend.name}' failed, retrying on another backend: {e}")
+                increment_statistic("Retried LLM queries")
+
+                # Callback could be in the middle of parsing the failed response, the next attempt needs a fresh one
+                context = current_query_context()
+                on_fragment = context.create_on_fragment() if context and context.create_on_fragment else None
+                continue
+
+            self._pool.release(backend, time.monotonic() - started_at)
+
+            return response
+
+    @property
+    def primary_llm(self) -> LLM:
+        assert self._pool is not None
+        return self._pool.backends[0].llm
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        return self.primary_llm.fits_in_one_prompt(token_count)
+
+    def count_tokens(self, source_text: str) -> int:
+        return self.primary_llm.count_tokens(source_text)
+
+    def count_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        return self.primary_llm.count_tokens_batch(source_texts)
+
+    def estimate_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        return self.primary_llm.estimate_tokens_batch(source_texts)
+
+    def text_fits_in_one_prompt(self, source_text: str, extra_token_count: int = 0) -> bool:
+        return self.primary_llm.text_fits_in_one_prompt(source_text, extra_token_count)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+from typing import Optional, List, Dict, Callable
+
+from unifree import LLM, QueryHistoryItem, QueryContext, log, current_query_context
+from unifree.llms.batch_job_llm import DeferredResponseError
+from unifree.utils import load_llm, increment_statistic
+
+
+class _Route:
+    name: str
+    llm: LLM
+    max_tokens: Optional[int]
+    chunk_kinds: Optional[List[str]]
+    max_complexity: Optional[int]
+
+    def __init__(self, config: Dict) -> None:
+        self.name = config.get("name") or config["llm_config"]["class"]
+        self.llm = load_llm(config["llm_config"])
+        self.max_tokens = config.get("max_tokens")
+        self.chunk_kinds = config.get("chunk_kinds")
+        self.max_complexity = config.get("max_complexity")
+
+    def matches(self, token_count: int, context: Optional[QueryContext]) -> bool:
+        if self.max_tokens is not None and token_count > self.max_tokens:
+            return False
+        if not context:
+            return self.chunk_kinds is None and self.max_complexity is None
+        if self.chunk_kinds is not None and context.chunk_kind not in self.chunk_kinds:
+            return False
+        if self.max_complexity is not None and context.complexity > self.max_complexity:
+            return False
+
+        return True
+
+
+class RoutingLLM(LLM):
+    """
+    This class sends every query to one of several LLMs. Routes are listed from the cheapest to the most capable model,
+    a query goes to the first route whose conditions it meets (and that fits it into one prompt). A route without
+    conditions takes everything. Conditions are checked against the query context set by the migration strategy (see
+    `QueryContext`).
+
+    If the response is not valid (code could not be extracted from it) or the query fails, it is escalated to the
+    next route in the list, regardless of its conditions. The last route is also used to count tokens and plan chunks.
+
+    The configuration would look like:
+
+    ```
+    llm:
+      class: RoutingLLM
+      routes:
+        - name: fast
+          max_tokens: 2000                          # Optional, maximum (estimated) size of the query
+          chunk_kinds: [class_only, methods_only]   # Optional, 'full', 'class_only', 'methods_only' or 'batch'
+          max_complexity: 10                        # Optional, maximum number of decision points in the code
+          llm_config:
+            class: <LLM class>
+            config: <LLM config>
+        - name: strong
+          llm_config:
+            class: <LLM class>
+            config: <LLM config>
+      escalate: true                                # Optional, default is true
+    ```
+    """
+    _routes: List[_Route]
+
+    def __init__(self, config: Dict) -> None:
+        super().__init__(config)
+
+        self._routes = []
+
+    def initialize(self) -> None:
+        routes_config = self.config.get("routes") or []
+        if len(routes_config) < 1:
+            raise RuntimeError("RoutingLLM requires at least one route under 'routes'")
+
+        self._routes = [_Route(route_config) for route_config in routes_config]
+        for route in self._routes:
+            route.llm.initialize()
+
+    def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
+        return self.query_streaming(user, system, history)
+
+    def query_streaming(
+            self,
+            user: str,
+            system: Optional[str] = None,
+            history: Optional[List[QueryHistoryItem]] = None,
+            on_fragment: Optional[Callable[[str], bool]] = None,
+    ) -> str:
+        context = current_query_context()
+        route_ix = self.select_route(user, system, history, context)
+        escalate = self.config.get("escalate", True) is not False
+
+        while True:
+            route = self._routes[route_ix]
+            is_last_attempt = not escalate or route_ix == len(self._routes) - 1
+
+            increment_statistic(f"LLM queries routed to '{route.name}'")
+            try:
+                response = route.llm.query_streaming(user, system, history, on_fragment)
+                if is_last_attempt or not context or not context.is_valid_response or context.is_valid_response(response):
+                    return response
+
+                log.debug(f"Response of '{route.name}' is not valid, escalating...")
+            except DeferredResponseError:
+                raise  # Exported to a batch job, the response is not known yet to escalate on
+            except Exception as e:
+                if is_last_attempt:
+                    raise
+                log.warn(f"Query to '{route.name}' failed, escalating: {e}")
+
+            increment_statistic("Escalated LLM queries")
+            route_ix += 1
+
+            # Callback could be in the middle of parsing the failed response, the next attempt needs a fresh one
+            on_fragment = context.create_on_fragment() if context and context.create_on_fragment else None
+
+    def select_route(
+            self,
+            user: str,
+            system: Optional[str] = None,
+            history: Optional[List[QueryHistoryItem]] = None,
+            context: Optional[QueryContext] = None,
+    ) -> int:
+        """
+        :return: Index of the first route the query meets the conditions of, or of the last route
+        """
+        texts = [user] + ([system] if system else []) + [item.content for item in history or []]
+
+        for route_ix, route in enumerate(self._routes[:-1]):
+            token_count = sum(route.llm.estimate_tokens_batch(texts))
+            if route.llm.fits_in_one_prompt(token_count) and route.matches(token_count, context):
+                return route_ix
+
+        return len(self._routes) - 1
+
+    @property
+    def primary_llm(self) -> LLM:
+        assert len(self._routes) > 0
+        return self._routes[-1].llm
+
+    def fits_in_one_prompt(self, token_count: int) -> bool:
+        return self.primary_llm.fits_in_one_prompt(token_count)
+
+    def count_tokens(self, source_text: str) -> int:
+        return self.primary_llm.count_tokens(source_text)
+
+    def count_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        return self.primary_llm.count_tokens_batch(source_texts)
+
+    def estimate_tokens_batch(self, source_texts: List[str]) -> List[int]:
+        return self.primary_llm.estimate_tokens_batch(source_texts)
+
+    def text_fits_in_one_prompt(self, source_text: str, extra_token_count: int = 0) -> bool:
+        return self.primary_llm.text_fits_in_one_prompt(source_text, extra_token_count)
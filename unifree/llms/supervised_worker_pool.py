@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.connection import Connection, wait
+from typing import Callable, Any, Optional, Deque, List, Dict, Tuple
+
+from unifree import log
+from unifree.utils import increment_statistic
+
+_READY = "ready"
+
+
+class WorkerCrashedError(RuntimeError):
+    pass
+
+
+class WorkerTimeoutError(TimeoutError):
+    pass
+
+
+class _Task:
+    payload: Any
+    future: Future
+    dispatched_at: float
+
+    def __init__(self, payload: Any) -> None:
+        self.payload = payload
+        self.future = Future()
+        self.dispatched_at = 0.0
+
+
+class _Worker:
+    """
+    Slot of the pool. The process in the slot could be replaced, the queue of the slot stays
+    """
+    process: Optional[multiprocessing.Process]
+    connection: Optional[Connection]
+    ready: bool
+    queue: Deque[_Task]
+    in_flight: Optional[_Task]
+    completed_count: int
+    restart_count: int
+    start_failure_count: int
+    """Number of processes in a row that exited before they were ready"""
+    restart_at: Optional[float]
+    """When the next process of the slot starts, set while the slot waits for it"""
+    failed: bool
+    """Processes of the slot failed to start too many times in a row (or exited, if workers are not restarted), the
+    slot takes no more tasks"""
+
+    def __init__(self) -> None:
+        self.process = None
+        self.connection = None
+        self.ready = False
+        self.queue = deque()
+        self.in_flight = None
+        self.completed_count = 0
+        self.restart_count = 0
+        self.start_failure_count = 0
+        self.restart_at = None
+        self.failed = False
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.queue) + (1 if self.in_flight else 0)
+
+    @property
+    def is_healthy(self) -> bool:
+        return not self.failed and self.start_failure_count == 0 and self.process is not None
+
+
+class SupervisedWorkerPool:
+    """
+    Pool of worker processes supervised by a background thread. Unlike `ProcessPoolExecutor`:
+      - every worker has its own queue and a task goes to the worker with the fewest queued tasks,
+      - a worker that runs a task longer than 'task_timeout_sec' is killed and restarted, the task fails with
+        `WorkerTimeoutError`,
+      - a worker that crashes is restarted, only the task it was running fails (with `WorkerCrashedError`),
+      - tasks queued for a killed or crashed worker move to healthy workers, or wait for its replacement if there are
+        none,
+      - a worker that exits before it is ready (i.e. it runs out of memory loading a model) is restarted with an
+        exponential backoff, after 'max_start_failures' such exits in a row its slot is given up and its queued tasks
+        fail with `WorkerCrashedError`,
+      - with 'restart_workers' off, a killed or crashed worker is not replaced, its slot is given up instead (i.e.
+        workers forked from a parent that has other threads by now, see `MultiprocessLocalLLM`).
+
+    Workers receive one task at a time, the time a task spends in the queue is not limited by the pool.
+    """
+    _worker_count: int
+    _initializer: Callable
+    _initargs: Tuple
+    _handler: Callable[[Any], Any]
+    _task_timeout_sec: Optional[float]
+    _max_start_failures: int
+    _restart_backoff_sec: float
+    _max_restart_backoff_sec: float
+    _restart_workers: bool
+    _mp_context: Any
+
+    _workers: List[_Worker]
+    _lock: threading.Lock
+    _supervisor: threading.Thread
+    _shutdown: bool
+
+    _timeout_count: int
+    _crash_count: int
+
+    def __init__(
+            self,
+            worker_count: int,
+            initializer: Callable,
+            initargs: Tuple,
+            handler: Callable[[Any], Any],
+            task_timeout_sec: Optional[float] = None,
+            max_start_failures: int = 5,
+            restart_backoff_sec: float = 0.5,
+            max_restart_backoff_sec: float = 30,
+            restart_workers: bool = True,
+            mp_context: Any = None,
+    ) -> None:
+        """
+        :param worker_count: Number of worker processes
+        :param initializer: Called once in every (re)started worker process with 'initargs'
+        :param initargs: Arguments for the initializer
+        :param handler: Called in a worker process for every task, its result becomes the result of the task
+        :param task_timeout_sec: Maximum time a worker could spend on one task, None for no limit
+        :param max_start_failures: Number of worker processes of a slot in a row that could exit before they are
+                                   ready, before the slot is given up
+        :param restart_backoff_sec: Delay before restarting a worker that exited before it was ready, doubled with
+                                    every such exit in a row
+        :param max_restart_backoff_sec: Longest delay before restarting a worker
+        :param restart_workers: Replace workers that are killed or crash, otherwise their slots are given up
+        :param mp_context: Multiprocessing context to start workers with
+        """
+        self._worker_count = worker_count
+        self._initializer = initializer
+        self._initargs = initargs
+        self._handler = handler
+        self._task_timeout_sec = task_timeout_sec
+        self._max_start_failures = max_start_failures
+        self._restart_backoff_sec = restart_backoff_sec
+        self._max_restart_backoff_sec = max_restart_backoff_sec
+        self._restart_workers = restart_workers
+        self._mp_context = mp_context or multiprocessing.get_context()
+
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._timeout_count = 0
+        self._crash_count = 0
+
+        self._workers = [_Worker() for _ in range(worker_count)]
+        for worker in self._workers:
+            self._start_process(worker)
+
+        self._supervisor = threading.Thread(target=self._supervise, name="worker-pool-supervisor", daemon=True)
+        self._supervisor.start()
+
+    def submit(self, payload: Any) -> Future:
+        """
+        Queue a task for the least loaded worker
+        :param payload: Argument for the handler, must be picklable
+        :return: Future of the handler result
+        """
+        task = _Task(payload)
+
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Worker pool is shut down")
+
+            workers = [worker for worker in self._workers if not worker.failed]
+            if len(workers) < 1:
+                task.future.set_exception(self._no_workers_error())
+                return task.future
+
+            # Workers that are being restarted only get tasks if no other worker could take them
+            worker = min(workers, key=lambda w: (not w.is_healthy, w.queue_depth))
+            worker.queue.append(task)
+            self._dispatch(worker)
+
+        return task.future
+
+    def health(self) -> Dict[str, Any]:
+        """
+        :return: State of every worker and counts of timed out and crashed tasks
+        """
+        with self._lock:
+            return {
+                "workers": [{
+                    "pid": worker.process.pid if worker.process else None,
+                    "alive": bool(worker.process and worker.process.is_alive()),
+                    "ready": worker.ready,
+                    "failed": worker.failed,
+                    "queue_depth": worker.queue_depth,
+                    "completed": worker.completed_count,
+                    "restarts": worker.restart_count,
+                } for worker in self._workers],
+                "timeouts": self._timeout_count,
+                "crashes": self._crash_count,
+            }
+
+    def shutdown(self, timeout_sec: float = 5) -> None:
+        """
+        Stop all workers. Tasks that are not finished fail
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+
+            for worker in self._workers:
+                try:
+                    if worker.connection:
+                        worker.connection.send(None)
+                except (OSError, ValueError):
+                    pass
+
+        self._supervisor.join(timeout_sec)
+
+        with self._lock:
+            for worker in self._workers:
+                if worker.process:
+                    worker.process.join(timeout_sec)
+                    if worker.process.is_alive():
+                        worker.process.kill()
+                        worker.process.join()
+                    worker.connection.close()
+
+                tasks = ([worker.in_flight] if worker.in_flight else []) + list(worker.queue)
+                worker.in_flight = None
+                worker.queue.clear()
+                for task in tasks:
+                    _fail(task, RuntimeError("Worker pool is shut down"))
+
+    def _start_process(self, worker: _Worker) -> None:
+        parent_connection, child_connection = self._mp_context.Pipe()
+
+        worker.process = self._mp_context.Process(
+            target=_worker_main,
+            args=(child_connection, self._initializer, self._initargs, self._handler),
+            daemon=True,
+        )
+        worker.process.start()
+        child_connection.close()
+
+        worker.connection = parent_connection
+        worker.ready = False
+        worker.restart_at = None
+
+    def _dispatch(self, worker: _Worker) -> None:
+        if not worker.ready or worker.in_flight or len(worker.queue) < 1:
+            return
+
+        task = worker.queue.popleft()
+        if not task.future.set_running_or_notify_cancel():
+            self._dispatch(worker)
+            return
+
+        task.dispatched_at = time.monotonic()
+        worker.in_flight = task
+        worker.connection.send(task.payload)
+
+    def _supervise(self) -> None:
+        while True:
+            with self._lock:
+                if self._shutdown:
+                    return
+                self._start_delayed_processes()
+
+                started_workers = [worker for worker in self._workers if worker.process]
+                waitables = {worker.connection: worker for worker in started_workers}
+                waitables.update({worker.process.sentinel: worker for worker in started_workers})
+
+            for waitable in wait(list(waitables.keys()), timeout=0.05):
+                worker = waitables[waitable]
+                with self._lock:
+                    if self._shutdown:
+                        return
+                    if worker.process is None:
+                        continue  # Already restarted
+                    if worker.connection is waitable:
+                        self._receive(worker)
+                    elif worker.process.sentinel == waitable and not worker.process.is_alive():
+                        self._restart(worker, WorkerCrashedError(f"Worker process exited with code {worker.process.exitcode}"))
+
+            with self._lock:
+                if self._shutdown:
+                    return
+                self._kill_timed_out_workers()
+
+    def _receive(self, worker: _Worker) -> None:
+        try:
+            message = worker.connection.recv()
+        except (EOFError, OSError):
+            return  # Process exited, it is handled through its sentinel
+
+        if message == _READY:
+            worker.ready = True
+            worker.start_failure_count = 0
+        elif worker.in_flight:
+            is_success, value = message
+            task, worker.in_flight = worker.in_flight, None
+            worker.completed_count += 1
+
+            if is_success:
+                task.future.set_result(value)
+            else:
+                task.future.set_exception(value)
+
+        self._dispatch(worker)
+
+    def _kill_timed_out_workers(self) -> None:
+        if self._task_timeout_sec is None:
+            return
+
+        now = time.monotonic()
+        for worker in self._workers:
+            if worker.process and worker.in_flight and now - worker.in_flight.dispatched_at > self._task_timeout_sec:
+                self._timeout_count += 1
+                increment_statistic("Local LLM worker timeouts")
+
+                self._restart(worker, WorkerTimeoutError(f"Task did not finish in {self._task_timeout_sec} sec"))
+
+    def _restart(self, worker: _Worker, error: Exception) -> None:
+        if isinstance(error, WorkerCrashedError):
+            self._crash_count += 1
+            increment_statistic("Local LLM worker crashes")
+
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join()
+        worker.connection.close()
+
+        pid = worker.process.pid
+        worker.start_failure_count = 0 if worker.ready else worker.start_failure_count + 1
+        worker.process, worker.connection, worker.ready = None, None, False
+
+        if worker.in_flight:
+            task, worker.in_flight = worker.in_flight, None
+            task.future.set_exception(error)
+
+        if worker.start_failure_count >= self._max_start_failures or not self._restart_workers:
+            if self._restart_workers:
+                log.error(f"Worker {pid} failed to start {worker.start_failure_count} times in a row, giving up its slot: {error}")
+            else:
+                log.error(f"Worker {pid} exited and workers are not restarted, giving up its slot: {error}")
+            worker.failed = True
+            self._move_queued_tasks(worker)
+            return
+
+        worker.restart_count += 1
+        increment_statistic("Local LLM worker restarts")
+
+        # Queued tasks go to healthy workers, they stay in the slot for the new process if there are none
+        self._move_queued_tasks(worker)
+
+        if worker.start_failure_count == 0:
+            log.warn(f"Restarting worker {pid}: {error}")
+            self._start_process(worker)
+        else:
+            delay_sec = min(self._restart_backoff_sec * 2 ** (worker.start_failure_count - 1), self._max_restart_backoff_sec)
+            log.warn(f"Worker {pid} exited before it was ready ({worker.start_failure_count} times in a row), restarting it in {delay_sec:.1f} sec: {error}")
+            worker.restart_at = time.monotonic() + delay_sec
+
+    def _start_delayed_processes(self) -> None:
+        now = time.monotonic()
+        for worker in self._workers:
+            if worker.restart_at is not None and worker.restart_at <= now:
+                self._start_process(worker)
+
+    def _move_queued_tasks(self, worker: _Worker) -> None:
+        """
+        Move tasks queued for the worker to healthy workers. Tasks of a failed worker go to any worker that is not
+        failed, or fail if there is none
+        """
+        targets = [target for target in self._workers if target is not worker and target.is_healthy]
+        if worker.failed and len(targets) < 1:
+            targets = [target for target in self._workers if not target.failed]
+
+        tasks = list(worker.queue)
+        worker.queue.clear()
+
+        for task in tasks:
+            if len(targets) > 0:
+                target = min(targets, key=lambda w: w.queue_depth)
+                target.queue.append(task)
+                self._dispatch(target)
+            elif worker.failed:
+                _fail(task, self._no_workers_error())
+            else:
+                worker.queue.append(task)
+
+    def _no_workers_error(self) -> Exception:
+        return WorkerCrashedError("All workers failed to start" if self._restart_workers else "All workers exited, workers are not restarted")
+
+
+def _fail(task: _Task, error: Exception) -> None:
+    if not task.future.cancelled():
+        task.future.set_exception(error)
+
+
+def _worker_main(connection: Connection, initializer: Callable, initargs: Tuple, handler: Callable[[Any], Any]) -> None:
+    initializer(*initargs)
+    connection.send(_READY)
+
+    while True:
+        try:
+            payload = connection.recv()
+        except EOFError:
+            return
+        if payload is None:
+            return
+
+        try:
+            message = (True, handler(payload))
+        except Exception as e:
+            message = (False, e)
+
+        try:
+            connection.send(message)
+        except Exception as e:  # i.e. the result could not be pickled
+            connection.send((False, RuntimeError(f"Failed to send task result: {e}")))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import copy
+import hashlib
+from typing import List, Optional, Callable, Any, Dict
+
+from unifree.utils import LruCache, increment_statistic
+
+
+class TransformersModel:
+    """
+    Causal language model loaded with Huggingface 'transformers'. Unlike ctransformers models, it can decode several
+    prompts in one batch: prompts are left padded to the same length and every decode step advances all of them.
+    Sequences that are finished (stop sequence generated or fragment callback asked to stop) are padded until the
+    whole batch is done.
+
+    With a prefix cache, the model state (KV cache) after a prompt prefix (i.e. system prompt and few-shot history) is
+    kept in memory, and prompts starting with the same prefix only evaluate what follows it. Prompts of a batch that
+    share a prefix are generated together from one copy of the cached state.
+    """
+    _model: Any
+    _tokenizer: Any
+    _prefix_cache: Optional[LruCache[Any]]
+
+    def __init__(self, model: Any, tokenizer: Any, prefix_cache_mb: Optional[float] = None) -> None:
+        """
+        :param model: Huggingface causal language model
+        :param tokenizer: Tokenizer of the model
+        :param prefix_cache_mb: Memory limit of the prefix cache, None disables the cache
+        """
+        self._model = model
+        self._tokenizer = tokenizer
+        self._prefix_cache = LruCache(int(prefix_cache_mb * 1024 * 1024), _cache_size_bytes) if prefix_cache_mb else None
+
+        self._tokenizer.padding_side = "left"  # Generated tokens must follow the prompt directly
+        if self._tokenizer.pad_token is None:
+            self._tokenizer.pad_token = self._tokenizer.eos_token
+
+    @classmethod
+    def from_pretrained(cls, checkpoint: str, prefix_cache_mb: Optional[float] = None) -> "TransformersModel":
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        model = AutoModelForCausalLM.from_pretrained(checkpoint)
+        model.eval()
+
+        return cls(model, AutoTokenizer.from_pretrained(checkpoint), prefix_cache_mb)
+
+    def tokenize(self, text: str) -> List[int]:
+        return self._tokenizer.encode(text, add_special_tokens=False)
+
+    def generate_batch(
+            self,
+            prompts: List[str],
+            on_fragments: List[Optional[Callable[[str], bool]]],
+            prefix_lengths: Optional[List[int]] = None,
+            max_new_tokens: int = 256,
+            stop: Optional[List[str]] = None,
+    ) -> List[str]:
+        """
+        Generate responses for all prompts in one batch
+        :param prompts: Prompts to generate responses for
+        :param on_fragments: Optional callback per prompt, called with every generated fragment. Returning True stops
+                             generation for that prompt
+        :param prefix_lengths: Length (in characters) of the part of each prompt that is shared with other prompts and
+                               should be looked up in the prefix cache
+        :param max_new_tokens: Maximum number of tokens generated for each prompt
+        :param stop: Stop sequences
+        :return: Responses in the order of the prompts
+        """
+        if self._prefix_cache is None or prefix_lengths is None:
+            return self._generate('', prompts, on_fragments, max_new_tokens, stop)
+
+        prompt_ixs_by_prefix: Dict[str, List[int]] = {}
+        for prompt_ix, (prompt, prefix_length) in enumerate(zip(prompts, prefix_lengths)):
+            prompt_ixs_by_prefix.setdefault(prompt[:prefix_length], []).append(prompt_ix)
+
+        responses = [''] * len(prompts)
+        for prefix, prompt_ixs in prompt_ixs_by_prefix.items():
+            group_responses = self._generate(
+                prefix,
+                [prompts[ix][len(prefix):] for ix in prompt_ixs],
+                [on_fragments[ix] for ix in prompt_ixs],
+                max_new_tokens,
+                stop,
+            )
+            for prompt_ix, response in zip(prompt_ixs, group_responses):
+                responses[prompt_ix] = response
+
+        return responses
+
+    def _generate(
+            self,
+            prefix: str,
+            suffixes: List[str],
+            on_fragments: List[Optional[Callable[[str], bool]]],
+            max_new_tokens: int,
+            stop: Optional[List[str]],
+    ) -> List[str]:
+        import torch
+        from transformers import StoppingCriteria, StoppingCriteriaList
+
+        inputs = self._tokenizer(suffixes, return_tensors="pt", padding=True, add_special_tokens=False)
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs["attention_mask"]
+
+        generation_parameters = {}
+        if prefix:
+            # Padding ends up between the prefix and the suffixes, it is masked out
+            prefix_ids = self._tokenizer([prefix], return_tensors="pt", add_special_tokens=False)["input_ids"]
+            input_ids = torch.cat([prefix_ids.expand(len(suffixes), -1), input_ids], dim=1)
+            attention_mask = torch.cat([torch.ones(len(suffixes), prefix_ids.shape[1], dtype=attention_mask.dtype), attention_mask], dim=1)
+
+            prefix_state = copy.deepcopy(self._prefix_state(prefix_ids))
+            if len(suffixes) > 1:
+                prefix_state.batch_repeat_interleave(len(suffixes))
+            generation_parameters["past_key_values"] = prefix_state
+
+        prompt_length = input_ids.shape[1]
+
+        responses = [''] * len(suffixes)
+        finished = [False] * len(suffixes)
+        tokenizer = self._tokenizer
+
+        class _FragmentStoppingCriteria(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                for ix in range(len(suffixes)):
+                    if finished[ix]:
+                        continue
+
+                    response = tokenizer.decode(input_ids[ix, prompt_length:], skip_special_tokens=True)
+                    fragment = response[len(responses[ix]):]
+                    responses[ix] = response
+
+                    stop_ix = _find_stop(response, stop)
+                    if stop_ix is not None:
+                        responses[ix] = response[:stop_ix]
+                        finished[ix] = True
+                    elif fragment and on_fragments[ix] and on_fragments[ix](fragment):
+                        finished[ix] = True
+
+                return torch.tensor(finished, dtype=torch.bool, device=input_ids.device)
+
+        with torch.no_grad():
+            output = self._model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=self._tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([_FragmentStoppingCriteria()]),
+                **generation_parameters,
+            )
+
+        for ix in range(len(suffixes)):
+            if not finished[ix]:  # Stopped by EOS or by the token limit, criteria may not have seen the last token
+                response = self._tokenizer.decode(output[ix, prompt_length:], skip_special_tokens=True)
+                stop_ix = _find_stop(response, stop)
+                responses[ix] = response[:stop_ix] if stop_ix is not None else response
+
+        return responses
+
+    def _prefix_state(self, prefix_ids: Any) -> Any:
+        import torch
+
+        key = hashlib.sha256(prefix_ids.numpy().tobytes()).hexdigest()
+
+        state = self._prefix_cache.get(key)
+        if state is not None:
+            increment_statistic("Prefix cache hits")
+            return state
+
+        increment_statistic("Prefix cache misses")
+        with torch.no_grad():
+            state = self._model(input_ids=prefix_ids, use_cache=True).past_key_values
+
+        self._prefix_cache.put(key, state)
+
+        return state
+
+
+def _cache_size_bytes(state: Any) -> int:
+    size = 0
+    for layer in state.layers:
+        for tensor in [layer.keys, layer.values]:
+            if tensor is not None:
+                size += tensor.numel() * tensor.element_size()
+
+    return size
+
+
+def _find_stop(response: str, stop: Optional[List[str]]) -> Optional[int]:
+    if not stop:
+        return None
+
+    stop_ixs = [ix for ix in (response.find(s) for s in stop) if ix >= 0]
+    return min(stop_ixs) if len(stop_ixs) > 0 else None
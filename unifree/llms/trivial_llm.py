@@ -18,12 +18,16 @@ class TrivialLLM(LLM):
     llm:
       class: TrivialLLM
       config:
+        weights_mb: 64  # Optional, allocates dummy weights of this size to simulate memory held by a model
     ```
     """
+    weights: Optional[bytearray]
 
     def __init__(self, config: Dict) -> None:
         super().__init__(config)
 
+        self.weights = None
+
     def query(self, user: str, system: Optional[str] = None, history: Optional[List[QueryHistoryItem]] = None) -> str:
         return user
 
@@ -34,4 +38,9 @@ class TrivialLLM(LLM):
         return len(source_text)
 
     def initialize(self) -> None:
+        weights_mb = self._llm_config_value("weights_mb", 0)
+        if weights_mb:
+            self.weights = bytearray(b'\x01') * (weights_mb * 1024 * 1024)  # Touch every page, like loaded weights
+
+    def initialize_tokenizer(self) -> None:
         pass
@@ -6,24 +6,71 @@
 import logging
 import sys
 import traceback
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Any, Optional, Iterator
 
 import unifree
 
 py_logger = logging.getLogger("lion")
 
+_event_listener: ContextVar[Optional[Callable[[Dict[str, Any]], None]]] = ContextVar("event_listener", default=None)
+_log_level: ContextVar[Optional[str]] = ContextVar("log_level", default=None)
+
+
+@contextmanager
+def event_listener(listener: Callable[[Dict[str, Any]], None]) -> Iterator[None]:
+    """
+    Send messages (`{"type": "log", "level": ..., "message": ...}`) and progress (see `progress`) logged within the
+    block to the listener, in addition to the usual output. Messages of all levels are sent. Applies to the current
+    thread and to threads started by `ConcurrentMigrationStrategy.map_concurrently`
+    """
+    token = _event_listener.set(listener)
+    try:
+        yield
+    finally:
+        _event_listener.reset(token)
+
+
+@contextmanager
+def log_level_scope(level: str) -> Iterator[None]:
+    """
+    Print messages logged within the block at the given level instead of `unifree.log_level` (i.e. for one of several
+    concurrent migrations). Applies to the current thread and to threads started by
+    `ConcurrentMigrationStrategy.map_concurrently`
+    """
+    token = _log_level.set(level)
+    try:
+        yield
+    finally:
+        _log_level.reset(token)
+
+
+def _current_log_level() -> Optional[str]:
+    level = _log_level.get()
+    return level if level is not None else unifree.log_level
+
+
+def _notify(event: Dict[str, Any]) -> None:
+    listener = _event_listener.get()
+    if listener is not None:
+        listener(event)
+
 
 def debug(message: str) -> None:
-    if unifree.log_level == "debug":
+    if _current_log_level() == "debug":
         print(message, file=sys.stdout)
 
     py_logger.debug(message)
+    _notify({"type": "log", "level": "debug", "message": message})
 
 
 def info(message: str) -> None:
-    if unifree.log_level in ["debug", "info"]:
+    if _current_log_level() in ["debug", "info"]:
         print(message, file=sys.stdout)
 
     py_logger.info(message)
+    _notify({"type": "log", "level": "info", "message": message})
 
 
 def warn(message: str, exc_info=False) -> None:
@@ -33,6 +80,7 @@ def warn(message: str, exc_info=False) -> None:
             traceback.print_exc(file=sys.stderr)
 
     py_logger.warning(message, exc_info=exc_info)
+    _notify({"type": "log", "level": "warn", "message": message})
 
 
 def error(message: str, exc_info=False) -> None:
@@ -41,7 +89,15 @@ def error(message: str, exc_info=False) -> None:
         traceback.print_exc(file=sys.stderr)
 
     py_logger.error(message, exc_info=exc_info)
+    _notify({"type": "log", "level": "error", "message": message})
+
+
+def progress(unit: str, done: int, total: int) -> None:
+    """
+    Report progress to the event listener only, the console shows progress bars
+    """
+    _notify({"type": "progress", "unit": unit, "done": done, "total": total})
 
 
 def is_debug():
-    return unifree.log_level == 'debug'
+    return _current_log_level() == 'debug'
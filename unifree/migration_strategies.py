@@ -6,4 +6,6 @@
 
 from .csharp_migration_strategies import \
     CSharpCompilationUnitToSingleFileWithLLM, \
-    CSharpCompilationUnitToInterfaceImplementationWithLLM
+    CSharpCompilationUnitToInterfaceImplementationWithLLM, \
+    CSharpCompilationUnitsBatchToSingleFilesWithLLM
+from .unity_scene_migration_strategies import UnityYamlToGodotScene
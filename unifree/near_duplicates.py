@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+from __future__ import annotations
+
+import functools
+import zlib
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import numpy as np
+import tree_sitter
+
+_MAX_VALUE = np.uint64(0xFFFFFFFF)
+_SAMPLE_SIZE = 64
+
+
+@dataclass
+class NearDuplicateGroup:
+    reference: int
+    """Index of the member most similar to the other members"""
+    members: List[int]
+    """Indexes of all members (including the reference), in the input order"""
+
+
+def syntax_tokens(tree: tree_sitter.Tree) -> List[str]:
+    """
+    :return: Leaves of the syntax tree without comments, literals are replaced by their type so files that only differ
+             in constants have the same tokens
+    """
+    result = []
+
+    def collect_tokens(node: tree_sitter.Node) -> None:
+        if "literal" in node.type:
+            result.append(node.type)
+        elif node.child_count == 0:
+            if node.type != "comment":
+                result.append(node.text.decode('utf-8'))
+        else:
+            for child in node.children:
+                collect_tokens(child)
+
+    collect_tokens(tree.root_node)
+
+    return result
+
+
+@functools.lru_cache(maxsize=1_000_000)
+def _token_hash(token: str) -> int:
+    return zlib.crc32(token.encode('utf-8'))
+
+
+def token_hashes(tokens: List[str]) -> np.ndarray:
+    """
+    :return: 32 bit hash of every token, the input of `NearDuplicateDetector.signatures`
+    """
+    return np.fromiter((_token_hash(token) for token in tokens), dtype=np.uint64, count=len(tokens))
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """
+    splitmix64 finalizer, spreads hashes of similar shingles over all 64 bits
+    """
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+class NearDuplicateDetector:
+    """
+    Finds groups of near-duplicate files (i.e. copy-paste variants that differ in a few names and constants) with
+    MinHash signatures of token shingles and locality-sensitive hashing.
+
+    Signatures use one permutation hashing: every shingle is hashed once and the hash goes into one of 'permutations'
+    buckets, empty buckets are filled from the next non-empty one. Files whose signatures agree on all rows of at least
+    one of 'bands' bands are candidates, candidates are grouped if their estimated Jaccard similarity is at least
+    'threshold'.
+
+    The configuration would look like:
+
+    ```
+    near_duplicates:
+      threshold: 0.8      # Minimum estimated Jaccard similarity of shingles
+      shingle_size: 5     # Tokens per shingle
+      permutations: 128   # Signature size
+      bands: 16           # Must divide 'permutations', more bands find less similar candidates
+    ```
+    """
+    _threshold: float
+    _shingle_size: int
+    _permutations: int
+    _bands: int
+
+    def __init__(self, config: Dict) -> None:
+        self._threshold = config.get("threshold") or 0.8
+        self._shingle_size = config.get("shingle_size") or 5
+        self._permutations = config.get("permutations") or 128
+        self._bands = config.get("bands") or 16
+
+        if self._permutations % self._bands != 0:
+            raise RuntimeError(f"Number of near duplicate bands ({self._bands}) must divide the number of permutations ({self._permutations})")
+
+        rng = np.random.default_rng(0)
+        self._shingle_coefficients = rng.integers(1, 2 ** 63, self._shingle_size, dtype=np.uint64) | np.uint64(1)
+        self._band_coefficients = rng.integers(1, 2 ** 63, self._permutations // self._bands, dtype=np.uint64) | np.uint64(1)
+
+    def signatures(self, file_hashes: List[np.ndarray]) -> np.ndarray:
+        """
+        :param file_hashes: Token hashes of every file, see `token_hashes`
+        :return: MinHash signature of every file (rows), files without tokens have no valid signature
+        """
+        file_ids, shingles = self._shingle_hashes(file_hashes)
+
+        buckets = file_ids * np.uint64(self._permutations) + shingles % np.uint64(self._permutations)
+        result = np.full(len(file_hashes) * self._permutations, _MAX_VALUE, dtype=np.uint64)
+        np.minimum.at(result, buckets, shingles >> np.uint64(32))
+        result = result.reshape(len(file_hashes), self._permutations)
+
+        # Densification: an empty bucket takes the value of the next non-empty one (wrapping around), shifted by the distance
+        empty = result == _MAX_VALUE
+        sparse_rows = np.flatnonzero(empty.any(axis=1) & ~empty.all(axis=1))
+        if len(sparse_rows) > 0:
+            sparse = np.concatenate([result[sparse_rows]] * 2, axis=1)
+            columns = np.arange(2 * self._permutations)
+
+            next_filled = np.where(sparse != _MAX_VALUE, columns, 2 * self._permutations)
+            next_filled = np.minimum.accumulate(next_filled[:, ::-1], axis=1)[:, ::-1][:, :self._permutations]
+            distances = (next_filled - columns[:self._permutations]).astype(np.uint64)
+
+            filled = (np.take_along_axis(sparse, next_filled, axis=1) + distances * np.uint64(0x9E3779B1)) & np.uint64(0xFFFFFFFE)
+            result[sparse_rows] = np.where(distances > 0, filled, result[sparse_rows])
+
+        return result
+
+    def _shingle_hashes(self, file_hashes: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Hash every `shingle_size` consecutive tokens of every file (one shingle of all tokens in files with fewer tokens),
+        all files at once
+
+        :return: (file index, shingle hash) of every shingle
+        """
+        lengths = np.fromiter((len(hashes) for hashes in file_hashes), dtype=np.int64, count=len(file_hashes))
+        if lengths.sum() < 1:
+            return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+
+        # Pad every file to the shingle size, so short files get one shingle and no shingle spans two files
+        padded_lengths = lengths + self._shingle_size - 1
+        padding = np.zeros(self._shingle_size - 1, dtype=np.uint64)
+        tokens = np.concatenate([part for hashes in file_hashes for part in (hashes.astype(np.uint64, copy=False), padding)])
+
+        shingle_count = len(tokens) - self._shingle_size + 1
+        shingles = np.zeros(shingle_count, dtype=np.uint64)
+        for offset in range(self._shingle_size):
+            shingles += tokens[offset:offset + shingle_count] * self._shingle_coefficients[offset]
+
+        shingles_per_file = np.maximum(lengths - self._shingle_size + 1, np.minimum(lengths, 1))
+        file_ids = np.repeat(np.arange(len(file_hashes), dtype=np.uint64), padded_lengths)[:shingle_count]
+        positions = np.arange(shingle_count) - np.repeat(np.cumsum(padded_lengths) - padded_lengths, padded_lengths)[:shingle_count]
+        is_shingle = positions < np.repeat(shingles_per_file, padded_lengths)[:shingle_count]
+
+        return file_ids[is_shingle], _mix(shingles[is_shingle])
+
+    def group(self, signatures: np.ndarray) -> List[NearDuplicateGroup]:
+        """
+        :param signatures: Signatures of files, see `signatures`
+        :return: Groups of at least two near-duplicate files
+        """
+        valid = ~(signatures == _MAX_VALUE).all(axis=1)
+        pairs = self._candidate_pairs(signatures, valid)
+        if len(pairs) < 1:
+            return []
+
+        similarities = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+        pairs = pairs[similarities >= self._threshold]
+
+        parents = list(range(len(signatures)))
+
+        def find(ix: int) -> int:
+            while parents[ix] != ix:
+                parents[ix] = parents[parents[ix]]
+                ix = parents[ix]
+            return ix
+
+        for first, second in pairs.tolist():
+            first_root, second_root = find(first), find(second)
+            if first_root != second_root:
+                parents[max(first_root, second_root)] = min(first_root, second_root)
+
+        members_by_root: Dict[int, List[int]] = {}
+        for ix in np.unique(pairs).tolist():
+            members_by_root.setdefault(find(ix), []).append(ix)
+
+        return [NearDuplicateGroup(reference=self._medoid(signatures, members), members=members) for members in members_by_root.values()]
+
+    def _candidate_pairs(self, signatures: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        """
+        :return: Unique (first, second) pairs of files whose signatures have an identical band, each file is paired with
+                 the first file of its band bucket
+        """
+        rows = self._permutations // self._bands
+        indexes = np.flatnonzero(valid)
+        pairs = []
+
+        for band in range(self._bands):
+            band_hashes = (signatures[indexes, band * rows:(band + 1) * rows] * self._band_coefficients).sum(axis=1)
+
+            order = np.argsort(band_hashes, kind='stable')
+            sorted_hashes = band_hashes[order]
+            run_starts = np.concatenate([[True], sorted_hashes[1:] != sorted_hashes[:-1]])
+            first_of_run = order[np.maximum.accumulate(np.where(run_starts, np.arange(len(order)), 0))]
+
+            duplicates = first_of_run != order
+            pairs.append(np.stack([indexes[first_of_run[duplicates]], indexes[order[duplicates]]], axis=1))
+
+        pairs = np.concatenate(pairs) if len(pairs) > 0 else np.empty((0, 2), dtype=np.int64)
+        return np.unique(pairs, axis=0)
+
+    @staticmethod
+    def _medoid(signatures: np.ndarray, members: List[int]) -> int:
+        """
+        :return: Member with the highest similarity to (a sample of) the other members, the first one on ties
+        """
+        if len(members) < 3:
+            return members[0]
+
+        member_signatures = signatures[members]
+        sample = member_signatures[np.linspace(0, len(members) - 1, min(len(members), _SAMPLE_SIZE)).astype(np.int64)]
+
+        similarities = np.concatenate([
+            (member_signatures[start:start + 1024, np.newaxis, :] == sample[np.newaxis, :, :]).mean(axis=2).sum(axis=1)
+            for start in range(0, len(members), 1024)
+        ])
+        return members[int(np.argmax(similarities))]
@@ -3,7 +3,10 @@
 # Copyright (c) Unifree
 # This code is licensed under MIT license (see LICENSE.txt for details)
 
+import contextvars
 import os.path
+import threading
+import time
 import traceback
 from abc import ABC
 from typing import List, Union, Dict, Optional, Iterable
@@ -11,6 +14,7 @@ from typing import List, Union, Dict, Optional, Iterable
 from tqdm.contrib.concurrent import thread_map
 
 from unifree import log, MigrationStrategy, utils, FileMigrationSpec
+from unifree.llms.batch_job_llm import DeferredResponseError
 
 
 class ConcurrentMigrationStrategy(MigrationStrategy, ABC):
@@ -19,7 +23,29 @@ class ConcurrentMigrationStrategy(MigrationStrategy, ABC):
         super().__init__(config)
 
     def map_concurrently(self, fn, iterables, **tqdm_kwargs) -> Iterable:
-        return thread_map(fn, iterables, **tqdm_kwargs)
+        """
+        Map items on worker threads with a progress bar. Workers run in a copy of the caller's context, so the log event
+        listener and the statistics and migration scopes of the caller apply to them, and report progress to the listener
+        """
+        items = list(iterables)
+        context = contextvars.copy_context()
+        unit = tqdm_kwargs.get("unit") or "item"
+
+        done_count = 0
+        done_count_lock = threading.Lock()
+
+        def map_item(item):
+            nonlocal done_count
+            try:
+                return fn(item)
+            finally:
+                with done_count_lock:
+                    done_count += 1
+                    current_done_count = done_count
+
+                log.progress(unit, current_done_count, len(items))
+
+        return thread_map(lambda item: context.copy().run(map_item, item), items, **tqdm_kwargs)
 
 
 class CreateMigrations(ConcurrentMigrationStrategy):
@@ -66,7 +92,7 @@ class CreateMigrations(ConcurrentMigrationStrategy):
         results = self.map_concurrently(
             self._map_file_path_to_migration,
             project_files,
-            max_workers=self.config["concurrency"]["create_strategy_worker"] if self.config["concurrency"]["create_strategy_worker"] else 1,
+            max_workers=self.config["concurrency"]["create_strategy_workers"] if self.config["concurrency"]["create_strategy_workers"] else 1,
             unit='path',
             chunksize=1,
         )
@@ -85,6 +111,9 @@ class CreateMigrations(ConcurrentMigrationStrategy):
         for warning in warnings:
             log.warn(warning)
 
+        self._batch_small_migrations()
+        self._group_near_duplicates()
+
     def _load_source_file_paths(self) -> List[str]:
         absolute_paths = []
 
@@ -132,6 +161,66 @@ class CreateMigrations(ConcurrentMigrationStrategy):
 
         return result
 
+    def _batch_small_migrations(self) -> None:
+        from unifree.csharp_migration_strategies import CSharpCompilationUnitsBatchToSingleFilesWithLLM
+
+        migration_count = len(self._migrations)
+        self._migrations = CSharpCompilationUnitsBatchToSingleFilesWithLLM.create_batches(self._migrations, self.config)
+
+        if len(self._migrations) < migration_count:
+            log.info(f"Batched small files: {migration_count:,} migrations reduced to {len(self._migrations):,}")
+
+    def _group_near_duplicates(self) -> None:
+        """
+        Find groups of near-duplicate files (configured in 'near_duplicates', see `NearDuplicateDetector`). One file of
+        every group is translated first, the others are translated with its translation as the only example
+        """
+        from unifree.csharp_migration_strategies import CSharpCompilationUnitToSingleFileWithLLM
+        from unifree.near_duplicates import NearDuplicateDetector, syntax_tokens, token_hashes
+
+        near_duplicates_config = self.config["near_duplicates"]
+        if not near_duplicates_config:
+            return
+
+        if _uses_llm_class(self.config["llm"], "BatchJobLLM"):
+            # Batch job responses are found by the request, and phase one can't send the translation of the reference
+            log.info("Not looking for near-duplicates, they are not supported with batch jobs")
+            return
+
+        strategies = [migration for migration in self._migrations if isinstance(migration, CSharpCompilationUnitToSingleFileWithLLM)]
+        if len(strategies) < 2:
+            return
+
+        def file_token_hashes(strategy: CSharpCompilationUnitToSingleFileWithLLM):
+            try:
+                return token_hashes(syntax_tokens(strategy.tree))
+            except Exception as e:
+                log.debug(f"Not looking for near duplicates of {strategy}: {e}")  # Strategy reports it when executed
+                return token_hashes([])
+
+        log.info(f"Looking for near-duplicates among {len(strategies):,} files...")
+        file_hashes = list(self.map_concurrently(
+            file_token_hashes, strategies,
+            max_workers=self.config["concurrency"]["create_strategy_workers"] if self.config["concurrency"]["create_strategy_workers"] else 1,
+            unit='file',
+            chunksize=1,
+        ))
+
+        start_time = time.perf_counter()
+        detector = NearDuplicateDetector(near_duplicates_config if isinstance(near_duplicates_config, dict) else {})
+        groups = detector.group(detector.signatures(file_hashes))
+
+        for group in groups:
+            for member in group.members:
+                if member != group.reference:
+                    strategies[member].near_duplicate_reference = strategies[group.reference]
+
+        if len(groups) > 0:
+            grouped_file_count = sum(len(group.members) for group in groups)
+            log.info(f"Found {len(groups):,} groups of near-duplicates with {grouped_file_count:,} files (largest has "
+                     f"{max(len(group.members) for group in groups):,}) in {time.perf_counter() - start_time:.2f}s, "
+                     f"{grouped_file_count - len(groups):,} files will be translated with a near-duplicate as the example")
+
     def _initialize_shared_objects(self):
         from unifree.source_code_parsers import CSharpCodeParser
         CSharpCodeParser.initialize()
@@ -156,14 +245,22 @@ class ExecuteMigrations(ConcurrentMigrationStrategy):
         self._strategies = strategies
 
     def execute(self) -> None:
+        self._prefetch_known_translations()
+
         log.info(f"Executing {len(self._strategies):,} migration strategies...")
 
-        results = self.map_concurrently(
-            self._execute_strategy, self._strategies,
-            max_workers=self.config["concurrency"]["execute_strategy_workers"] if self.config["concurrency"]["execute_strategy_workers"] else 1,
-            unit='file',
-            chunksize=1,
-        )
+        # Near-duplicates need the translation of their group reference, so they go after everything else
+        is_near_duplicate = [getattr(strategy, "near_duplicate_reference", None) is not None for strategy in self._strategies]
+        results = []
+        for near_duplicates in [False, True]:
+            strategies = [strategy for strategy, is_member in zip(self._strategies, is_near_duplicate) if is_member == near_duplicates]
+            if len(strategies) > 0:
+                results += self.map_concurrently(
+                    self._execute_strategy, strategies,
+                    max_workers=self._execute_strategy_workers,
+                    unit='file',
+                    chunksize=1,
+                )
 
         warnings = []
         for result in results:
@@ -177,8 +274,68 @@ class ExecuteMigrations(ConcurrentMigrationStrategy):
         for warning in warnings:
             log.warn(warning)
 
+        statistics = utils.get_statistics()
+        for name, value in statistics.items():
+            log.info(f"{name}: {value:,}")
+
+        if statistics.get("Translation memory lookups"):
+            hit_rate = statistics.get("Translation memory hits", 0) / statistics["Translation memory lookups"]
+            log.info(f"Translation memory hit rate: {hit_rate:.1%}, {statistics.get('Translation memory hits', 0):,} LLM queries avoided")
+
+    def _prefetch_known_translations(self) -> None:
+        """
+        Retrieve known translations of everything strategies will translate in large batches, instead of one lookup per
+        request from many threads. Chunk planning needs known translations of whole files, so those come first
+        """
+        from unifree.known_translations_db import KnownTranslationsDb
+        if not KnownTranslationsDb.is_instance_initialized() or (self.config["known_translations"] or {}).get("prefetch") is False:
+            return
+
+        strategies = [strategy for strategy in self._strategies if hasattr(strategy, "known_translation_queries")]
+        if len(strategies) < 1:
+            return
+
+        log.info(f"Retrieving known translations for {len(strategies):,} migration strategies...")
+
+        known_translations_db = KnownTranslationsDb.instance()
+        for include_chunks in [False, True]:
+            queries = self.map_concurrently(
+                lambda strategy: self._known_translation_queries(strategy, include_chunks), strategies,
+                max_workers=self._execute_strategy_workers,
+                unit='file',
+                chunksize=1,
+                disable=not include_chunks,
+            )
+            known_translations_db.prefetch([query for strategy_queries in queries for query in strategy_queries])
+
+    @staticmethod
+    def _known_translation_queries(strategy: MigrationStrategy, include_chunks: bool) -> List[str]:
+        try:
+            return strategy.known_translation_queries(include_chunks)
+        except Exception as e:
+            log.debug(f"Not prefetching known translations for {strategy}: {e}")  # Strategy reports it when executed
+            return []
+
+    @property
+    def _execute_strategy_workers(self) -> int:
+        return self.config["concurrency"]["execute_strategy_workers"] if self.config["concurrency"]["execute_strategy_workers"] else 1
+
     def _execute_strategy(self, strategy: MigrationStrategy) -> Optional[str]:
         try:
             strategy.execute()
+        except DeferredResponseError:
+            utils.increment_statistic("Files waiting for batch job responses")
         except Exception as e:
             return f"Failed to execute {strategy}: {e}"
+
+
+def _uses_llm_class(llm_config: Optional[Dict], class_name: str) -> bool:
+    """
+    :return: True if the LLM or any LLM it wraps (i.e. backends of a `PoolLLM`) is of the given class
+    """
+    if isinstance(llm_config, dict):
+        return llm_config.get("class") == class_name or any(_uses_llm_class(value, class_name) for value in llm_config.values())
+    if isinstance(llm_config, list):
+        return any(_uses_llm_class(value, class_name) for value in llm_config)
+
+    return False
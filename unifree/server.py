@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import os
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional, Iterator, Tuple
+
+import unifree
+from unifree import log, utils
+
+
+class MigrationJob:
+    """
+    Migration submitted to a `MigrationServer`, with the events (log messages and progress) it emitted so far. Only the
+    last `max_events` events are kept
+    """
+    id: str
+    config: str
+    source: str
+    destination: str
+    verbose: bool
+    status: str
+    """One of 'queued', 'running', 'succeeded' or 'failed'"""
+    exit_code: Optional[int]
+    statistics: Dict[str, int]
+    finished_at: Optional[float]
+
+    _llm_secret_key: Optional[str]
+    _events: List[Dict[str, Any]]
+    _dropped_event_count: int
+    _max_events: int
+    _condition: threading.Condition
+
+    def __init__(self, config: str, source: str, destination: str, llm_secret_key: Optional[str] = None, verbose: bool = False,
+                 max_events: int = 10_000) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.config = config
+        self.source = source
+        self.destination = destination
+        self.verbose = verbose
+        self.status = "queued"
+        self.exit_code = None
+        self.statistics = {}
+        self.finished_at = None
+
+        self._llm_secret_key = llm_secret_key
+        self._events = []
+        self._dropped_event_count = 0
+        self._max_events = max_events
+        self._condition = threading.Condition()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ["succeeded", "failed"]
+
+    def run(self) -> None:
+        from unifree.free import run_migration
+
+        self._set_status("running")
+
+        try:
+            with utils.statistics_scope() as statistics, log.event_listener(self.add_event):
+                exit_code = run_migration(self.config, self.source, self.destination, self._llm_secret_key, self.verbose)
+                self.statistics = dict(statistics)
+        except Exception as e:
+            log.error(f"Job {self.id} failed: {e}", exc_info=e)
+            exit_code = 70  # os.EX_SOFTWARE
+
+        self.exit_code = exit_code
+        self._set_status("succeeded" if exit_code == os.EX_OK else "failed")
+
+    def add_event(self, event: Dict[str, Any]) -> None:
+        if event["type"] == "log" and event["level"] == "debug" and not self.verbose:
+            return
+
+        with self._condition:
+            self._append_event(event)
+
+    def events(self) -> Iterator[Dict[str, Any]]:
+        """
+        :return: All kept events of the job, blocks for new events until the job is finished. The last event is the
+                 final status of the job
+        """
+        next_ix = 0  # Counts dropped events too
+        while True:
+            with self._condition:
+                while next_ix >= self._dropped_event_count + len(self._events) and not self.is_finished:
+                    self._condition.wait()
+
+                events = self._events[max(0, next_ix - self._dropped_event_count):]
+                next_ix = self._dropped_event_count + len(self._events)
+                is_finished = self.is_finished
+
+            yield from events
+
+            if is_finished:
+                return
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "config": self.config,
+            "source": self.source,
+            "destination": self.destination,
+            "status": self.status,
+            "exit_code": self.exit_code,
+            "statistics": self.statistics,
+        }
+
+    def _set_status(self, status: str) -> None:
+        with self._condition:
+            if status in ["succeeded", "failed"]:
+                self.finished_at = time.time()
+
+            self.status = status
+            self._append_event({"type": "status", **self.to_dict()})
+
+    def _append_event(self, event: Dict[str, Any]) -> None:
+        self._events.append({"time": time.time(), **event})
+        if len(self._events) > self._max_events:
+            del self._events[0]
+            self._dropped_event_count += 1
+
+        self._condition.notify_all()
+
+
+class MigrationServer:
+    """
+    Long-running process that migrates projects on request. Everything that is shared between migrations stays loaded
+    between jobs: the tree-sitter grammar, known translations (index and sentence transformer) and LLMs that keep their
+    models and connection pools in global instances (i.e. `HuggingfaceLLM`, `PoolLLM`). Up to `max_concurrent_jobs`
+    jobs run at the same time and share these instances, so concurrent jobs with the same LLM configuration share one
+    LLM pool. State of a single migration (i.e. prefetched known translations, batch job requests) is released when its
+    job finishes, and finished jobs are forgotten after `finished_job_ttl_sec` or when there are more than
+    `max_finished_jobs` of them.
+
+    The server listens on a TCP address ('127.0.0.1:8765') or on a Unix socket ('unix:/tmp/unifree.sock') and speaks
+    HTTP with JSON bodies:
+
+    - `POST /jobs` with `{"config": ..., "source": ..., "destination": ..., "llm_secret_key": ..., "verbose": ...}`
+      queues a migration and returns the job (see `MigrationJob.to_dict`)
+    - `GET /jobs` and `GET /jobs/<id>` return jobs
+    - `GET /jobs/<id>/events` streams events of the job as JSON lines until the job is finished
+
+    Paths are resolved by the server, so they should be absolute. Run it with `python unifree/server.py --address ...`
+    and submit migrations with `python unifree/free.py --server ...`. Known translations and the tree-sitter grammar
+    are loaded once, restart the server to pick up changes to them.
+    """
+    _address: str
+    _jobs: Dict[str, MigrationJob]
+    _jobs_lock: threading.Lock
+    _max_finished_jobs: int
+    _finished_job_ttl_sec: float
+    _executor: ThreadPoolExecutor
+    _http_server: socketserver.BaseServer
+
+    def __init__(self, address: str, max_concurrent_jobs: int = 2, max_finished_jobs: int = 100, finished_job_ttl_sec: float = 24 * 3600) -> None:
+        self._address = address
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._max_finished_jobs = max_finished_jobs
+        self._finished_job_ttl_sec = finished_job_ttl_sec
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_jobs, thread_name_prefix="migration_job")
+
+        # Progress bars of concurrent jobs overlap. tqdm removes its lock when a progress bar closes, unless the lock
+        # existed before
+        from tqdm.auto import tqdm
+        tqdm.get_lock()
+
+        handler = _create_request_handler(self)
+        unix_socket_path = _unix_socket_path(address)
+        if unix_socket_path is not None:
+            if os.path.exists(unix_socket_path):
+                os.remove(unix_socket_path)
+            self._http_server = _ThreadingUnixHTTPServer(unix_socket_path, handler)
+        else:
+            self._http_server = ThreadingHTTPServer(_tcp_address(address), handler)
+
+    @property
+    def address(self) -> str:
+        """
+        :return: Address the server listens on, with the actual port if it was started on port 0
+        """
+        if isinstance(self._http_server, ThreadingHTTPServer):
+            host, port = self._http_server.server_address[:2]
+            return f"{host}:{port}"
+
+        return self._address
+
+    def preload(self, config_name: str) -> None:
+        """
+        Load everything migrations with the given config share, before the first job needs it
+        """
+        from unifree.known_translations_db import KnownTranslationsDb
+        from unifree.source_code_parsers import CSharpCodeParser
+
+        log.info(f"Preloading '{config_name}'...")
+        config = utils.load_config(config_name)
+
+        CSharpCodeParser(config)
+        KnownTranslationsDb.initialize_instance(config)
+        if config["known_translations"]:
+            _ = KnownTranslationsDb.instance().sentence_transformer
+
+        if config["llm"]:
+            utils.load_llm(config["llm"]).initialize()
+
+    def submit(self, config: str, source: str, destination: str, llm_secret_key: Optional[str] = None, verbose: bool = False) -> MigrationJob:
+        job = MigrationJob(config, source, destination, llm_secret_key, verbose)
+        with self._jobs_lock:
+            self._evict_finished_jobs()
+            self._jobs[job.id] = job
+
+        self._executor.submit(job.run)
+        log.info(f"Queued job {job.id}: '{source}' to '{destination}' with '{config}'")
+
+        return job
+
+    def job(self, job_id: str) -> Optional[MigrationJob]:
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> List[MigrationJob]:
+        with self._jobs_lock:
+            self._evict_finished_jobs()
+            return list(self._jobs.values())
+
+    def _evict_finished_jobs(self) -> None:
+        now = time.time()
+        finished_jobs = sorted((job for job in self._jobs.values() if job.finished_at is not None), key=lambda job: job.finished_at)
+        for ix, job in enumerate(finished_jobs):
+            if ix < len(finished_jobs) - self._max_finished_jobs or now - job.finished_at > self._finished_job_ttl_sec:
+                del self._jobs[job.id]
+
+    def serve_forever(self) -> None:
+        log.info(f"Listening on {self.address}...")
+        self._http_server.serve_forever()
+
+    def shutdown(self) -> None:
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        self._executor.shutdown(wait=True)
+
+        unix_socket_path = _unix_socket_path(self._address)
+        if unix_socket_path is not None and os.path.exists(unix_socket_path):
+            os.remove(unix_socket_path)
+
+
+class MigrationServerClient:
+    """
+    Client of a `MigrationServer`
+    """
+    _address: str
+
+    def __init__(self, address: str) -> None:
+        self._address = address
+
+    def submit(self, config: str, source: str, destination: str, llm_secret_key: Optional[str] = None, verbose: bool = False) -> Dict[str, Any]:
+        return self._request("POST", "/jobs", {
+            "config": config,
+            "source": os.path.abspath(source),
+            "destination": os.path.abspath(destination),
+            "llm_secret_key": llm_secret_key,
+            "verbose": verbose,
+        })
+
+    def job(self, job_id: str) -> Dict[str, Any]:
+        return self._request("GET", f"/jobs/{job_id}")
+
+    def events(self, job_id: str) -> Iterator[Dict[str, Any]]:
+        connection = self._connect(timeout=None)
+        try:
+            connection.request("GET", f"/jobs/{job_id}/events")
+            response = connection.getresponse()
+            if response.status != 200:
+                raise RuntimeError(f"Unable to stream events of job {job_id}: {response.status} {response.read().decode('utf-8')}")
+
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            connection.close()
+
+    def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        connection = self._connect(timeout=60)
+        try:
+            connection.request(method, path, body=json.dumps(body) if body is not None else None, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            result = json.loads(response.read() or b"{}")
+            if response.status >= 400:
+                raise RuntimeError(f"Migration server failed {method} {path}: {result.get('error', response.status)}")
+
+            return result
+        finally:
+            connection.close()
+
+    def _connect(self, timeout: Optional[float]) -> http.client.HTTPConnection:
+        unix_socket_path = _unix_socket_path(self._address)
+        if unix_socket_path is not None:
+            return _UnixHTTPConnection(unix_socket_path, timeout)
+
+        host, port = _tcp_address(self._address)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+
+def submit_migration(address: str, config: str, source: str, destination: str, llm_secret_key: Optional[str] = None, verbose: bool = False) -> int:
+    """
+    Run a migration on a `MigrationServer`, printing its messages and progress
+    :return: Exit code of the migration
+    """
+    client = MigrationServerClient(address)
+    job = client.submit(config, source, destination, llm_secret_key, verbose)
+    log.info(f"Submitted job {job['id']} to {address}")
+
+    for event in client.events(job["id"]):
+        if event["type"] == "log":
+            print(event["message"], file=sys.stderr if event["level"] in ["warn", "error"] else sys.stdout)
+        elif event["type"] == "progress" and (event["done"] == event["total"] or log.is_debug()):
+            log.info(f"{event['done']:,}/{event['total']:,} {event['unit']}")
+        elif event["type"] == "status" and event["exit_code"] is not None:
+            return event["exit_code"]
+
+    exit_code = client.job(job["id"])["exit_code"]
+    return exit_code if exit_code is not None else 70  # os.EX_SOFTWARE
+
+
+def _unix_socket_path(address: str) -> Optional[str]:
+    if address.startswith("unix:"):
+        return address[len("unix:"):]
+    if address.startswith("/") or address.startswith("."):
+        return address
+
+    return None
+
+
+def _tcp_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    _socket_path: str
+
+    def __init__(self, socket_path: str, timeout: Optional[float]) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+
+def _create_request_handler(server: MigrationServer) -> type:
+    class MigrationRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path == "/jobs":
+                self._send_json(200, [job.to_dict() for job in server.jobs()])
+                return
+
+            match = re.fullmatch(r"/jobs/([0-9a-f]+)(/events)?", self.path)
+            job = server.job(match.group(1)) if match else None
+            if job is None:
+                self._send_json(404, {"error": f"Not found: {self.path}"})
+            elif match.group(2):
+                self._stream_events(job)
+            else:
+                self._send_json(200, job.to_dict())
+
+        def do_POST(self) -> None:
+            if self.path != "/jobs":
+                self._send_json(404, {"error": f"Not found: {self.path}"})
+                return
+
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+                job = server.submit(
+                    config=request["config"],
+                    source=request["source"],
+                    destination=request["destination"],
+                    llm_secret_key=request.get("llm_secret_key"),
+                    verbose=bool(request.get("verbose")),
+                )
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": f"Invalid job: {e}"})
+                return
+
+            self._send_json(202, job.to_dict())
+
+        def _stream_events(self, job: MigrationJob) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+
+            try:
+                for event in job.events():
+                    self.wfile.write(json.dumps(event).encode('utf-8') + b"\n")
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # Client went away, the job keeps running
+
+        def _send_json(self, status: int, body: Any) -> None:
+            content = json.dumps(body).encode('utf-8')
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def address_string(self) -> str:
+            return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+        def log_message(self, format: str, *args: Any) -> None:
+            log.debug(f"{self.address_string()} - {format % args}")
+
+    return MigrationRequestHandler
+
+
+def main() -> None:
+    args_parser = argparse.ArgumentParser(
+        description="Run a migration server that keeps models and indexes loaded between migrations",
+        usage=f"""\npython3 unifree/server.py -a Address [-j Max_Concurrent_Jobs] [-p Config_Name ...] [-v]
+            \nExample call: python3 unifree/server.py -a unix:/tmp/unifree.sock -p godot
+        """
+    )
+    args_parser.add_argument(
+        '--address', '-a',
+        required=False,
+        default="127.0.0.1:8765",
+        type=str,
+        help=f"TCP address (host:port) or Unix socket (unix:/path/to/socket) to listen on",
+    )
+    args_parser.add_argument(
+        '--max_concurrent_jobs', '-j',
+        required=False,
+        default=2,
+        type=int,
+        help=f"Maximum number of migrations running at the same time",
+    )
+    args_parser.add_argument(
+        '--preload', '-p',
+        required=False,
+        default=[],
+        action='append',
+        help=f"Name of a configuration to load models and indexes for at startup (can be repeated)",
+    )
+    args_parser.add_argument(
+        '--verbose', '-v',
+        required=False,
+        default=False,
+        action='store_true',
+        help=f"Print verbose information about the migrations")
+
+    args = args_parser.parse_args()
+    if args.verbose:
+        unifree.log_level = 'debug'
+
+    server = MigrationServer(args.address, args.max_concurrent_jobs)
+    for config_name in args.preload:
+        server.preload(config_name)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
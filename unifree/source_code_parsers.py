@@ -4,7 +4,7 @@
 # This code is licensed under MIT license (see LICENSE.txt for details)
 
 import os.path
-from typing import Dict
+from typing import Dict, Optional
 
 import tree_sitter
 
@@ -13,6 +13,9 @@ from unifree import log
 
 
 class CSharpCodeParser:
+    _language: Optional[tree_sitter.Language] = None
+    """Grammar shared by all parsers, it is loaded once per process"""
+
     _parser: tree_sitter.Parser
     _config: Dict
 
@@ -21,7 +24,14 @@ class CSharpCodeParser:
         self.initialize()
 
         self._parser = tree_sitter.Parser()
-        self._parser.set_language(tree_sitter.Language(self._c_sharp_library_path(), "c_sharp"))
+        self._parser.set_language(self._load_language())
+
+    @classmethod
+    def _load_language(cls) -> tree_sitter.Language:
+        if cls._language is None:
+            cls._language = tree_sitter.Language(cls._c_sharp_library_path(), "c_sharp")
+
+        return cls._language
 
     @classmethod
     def initialize(cls) -> None:
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+import math
+import threading
+
+
+class TokenEstimator:
+    """
+    Estimates number of tokens from the UTF-8 size of the text. The ratio of bytes per token is calibrated from exact
+    token counts of sampled texts, so each backend (tokenizer) gets its own ratio.
+    """
+    _bytes_per_token: float
+    _calibration_sample_count: int
+
+    _sample_count: int
+    _sample_bytes: int
+    _sample_tokens: int
+    _lock: threading.Lock
+
+    def __init__(self, default_bytes_per_token: float = 3.5, calibration_sample_count: int = 16) -> None:
+        self._bytes_per_token = default_bytes_per_token
+        self._calibration_sample_count = calibration_sample_count
+
+        self._sample_count = 0
+        self._sample_bytes = 0
+        self._sample_tokens = 0
+        self._lock = threading.Lock()
+
+    @property
+    def bytes_per_token(self) -> float:
+        return self._bytes_per_token
+
+    @property
+    def needs_calibration(self) -> bool:
+        return self._sample_count < self._calibration_sample_count
+
+    def estimate(self, source_text: str) -> int:
+        return math.ceil(len(source_text.encode('utf-8')) / self._bytes_per_token)
+
+    def add_sample(self, source_text: str, token_count: int) -> None:
+        """
+        Calibrate the estimator with an exact token count
+        :param source_text: Text that was tokenized
+        :param token_count: Exact number of tokens in the text
+        """
+        if token_count < 1:
+            return
+
+        with self._lock:
+            self._sample_count += 1
+            self._sample_bytes += len(source_text.encode('utf-8'))
+            self._sample_tokens += token_count
+
+            self._bytes_per_token = self._sample_bytes / self._sample_tokens
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, List, Tuple
+
+import unifree
+from unifree import log
+from unifree.utils import camel_to_snake, get_or_create_global_instance, increment_statistic
+
+_TOKEN_REGEX = re.compile(r'''
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+    |(?P<string>\$?@?"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    |(?P<identifier>@?[A-Za-z_][A-Za-z0-9_]*)
+    |(?P<whitespace>\s+)
+    |(?P<other>.)
+''', re.DOTALL | re.VERBOSE)
+
+_CSHARP_KEYWORDS = {
+    "abstract", "as", "base", "bool", "break", "byte", "case", "catch", "char", "checked", "class", "const", "continue",
+    "decimal", "default", "delegate", "do", "double", "else", "enum", "event", "explicit", "extern", "false", "finally",
+    "fixed", "float", "for", "foreach", "goto", "if", "implicit", "in", "int", "interface", "internal", "is", "lock",
+    "long", "namespace", "new", "null", "object", "operator", "out", "override", "params", "private", "protected",
+    "public", "readonly", "ref", "return", "sbyte", "sealed", "short", "sizeof", "stackalloc", "static", "string",
+    "struct", "switch", "this", "throw", "true", "try", "typeof", "uint", "ulong", "unchecked", "unsafe", "ushort",
+    "using", "virtual", "void", "volatile", "while", "var", "get", "set", "value", "async", "await", "yield", "partial",
+    "where", "nameof", "dynamic", "record", "init",
+}
+
+
+class NormalizedCode:
+    """
+    Code with comments and formatting removed and identifiers (except keywords) replaced by their order of appearance,
+    so `float speed = 2f;` and `float velocity = 2f;` have the same normalized text
+    """
+    text: str
+    identifiers: List[str]
+
+    def __init__(self, code: str) -> None:
+        tokens = []
+        identifier_ordinals: Dict[str, int] = {}
+
+        for match in _TOKEN_REGEX.finditer(code):
+            kind = match.lastgroup
+            if kind in ["comment", "whitespace"]:
+                continue
+
+            token = match.group()
+            if kind == "identifier" and token not in _CSHARP_KEYWORDS:
+                token = f"${identifier_ordinals.setdefault(token, len(identifier_ordinals))}"
+
+            tokens.append(token)
+
+        self.text = " ".join(tokens)
+        self.identifiers = list(identifier_ordinals.keys())
+
+    @property
+    def hash(self) -> str:
+        return hashlib.sha256(self.text.encode('utf-8')).hexdigest()
+
+
+class TranslationMemory:
+    """
+    Local store (sqlite) of successful translations from all previous runs. A chunk of code is translated without an
+    LLM query if the memory has a translation of the same code, or of code that only differs in comments, formatting
+    and identifier names. In the latter case identifiers are renamed in the stored translation. Every renamed
+    identifier has to appear in the stored translation (as is or in snake_case), otherwise the translation is not
+    reused: it may not depend on the identifier the way the renaming assumes (i.e. `Start` is translated to `_ready`).
+
+    Translations are only reused for the same prompt (type and text) and target.
+
+    The configuration would look like:
+
+    ```
+    translation_memory:
+      path: ~/.unifree/translation_memory.sqlite  # Optional, defaults to '.cache/translation_memory.sqlite' in the project root
+    ```
+    """
+    _connection: sqlite3.Connection
+    _lock: threading.Lock
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)  # Access is serialized by the lock
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS translations (
+                    scope TEXT NOT NULL,
+                    normalized_hash TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    hit_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (scope, normalized_hash, source)
+                )
+            """)
+
+    @classmethod
+    def instance(cls, config: Dict) -> Optional[TranslationMemory]:
+        """
+        :return: Memory configured in 'translation_memory', None if it is not configured
+        """
+        memory_config = config["translation_memory"]
+        if memory_config is None or memory_config is False:
+            return None
+
+        path = (memory_config or {}).get("path") or os.path.join(unifree.project_root, ".cache", "translation_memory.sqlite")
+        path = os.path.abspath(os.path.expanduser(path))
+
+        return get_or_create_global_instance(f"translation_memory:{path}", lambda: TranslationMemory(path))
+
+    def lookup(self, scope: str, code: str) -> Optional[str]:
+        """
+        :param scope: Prompt and target the translation is for, see `create_scope`
+        :param code: Code to translate
+        :return: Stored response, with identifiers renamed to the ones of the code, None if there is none
+        """
+        normalized_code = NormalizedCode(code)
+
+        with self._lock:
+            candidates: List[Tuple[str, str]] = self._connection.execute(
+                "SELECT source, response FROM translations WHERE scope = ? AND normalized_hash = ? ORDER BY hit_count DESC",
+                (scope, normalized_code.hash),
+            ).fetchall()
+
+        increment_statistic("Translation memory lookups")
+
+        # Exact match first, it needs no renaming
+        for source, response in sorted(candidates, key=lambda candidate: candidate[0] != code):
+            renamed_response = _rename_identifiers(response, NormalizedCode(source).identifiers, normalized_code.identifiers)
+            if renamed_response is None:
+                continue
+
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "UPDATE translations SET hit_count = hit_count + 1 WHERE scope = ? AND normalized_hash = ? AND source = ?",
+                    (scope, normalized_code.hash, source),
+                )
+
+            increment_statistic("Translation memory hits")
+            return renamed_response
+
+        return None
+
+    def record(self, scope: str, code: str, response: str) -> None:
+        """
+        Store a successful translation
+        :param scope: Prompt and target the translation is for, see `create_scope`
+        :param code: Translated code
+        :param response: LLM response the translation was extracted from
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO translations (scope, normalized_hash, source, response, created_at) VALUES (?, ?, ?, ?, ?)",
+                (scope, NormalizedCode(code).hash, code, response, time.time()),
+            )
+
+    @staticmethod
+    def create_scope(*parts: Optional[str]) -> str:
+        """
+        :param parts: Everything the translation depends on, besides the code (i.e. prompt, target extension)
+        :return: Scope of stored translations
+        """
+        return hashlib.sha256("\0".join(part or "" for part in parts).encode('utf-8')).hexdigest()
+
+
+def _rename_identifiers(response: str, old_identifiers: List[str], new_identifiers: List[str]) -> Optional[str]:
+    """
+    Rename identifiers (and their snake_case forms) in the response, simultaneously
+    :return: Renamed response, None if an identifier to rename does not appear in the response
+    """
+    renames: Dict[str, str] = {}
+    for old_identifier, new_identifier in zip(old_identifiers, new_identifiers):
+        if old_identifier == new_identifier:
+            continue
+
+        variants = {old_identifier.lstrip('@'): new_identifier.lstrip('@'), camel_to_snake(old_identifier.lstrip('@')): camel_to_snake(new_identifier.lstrip('@'))}
+        present_variants = {old: new for old, new in variants.items() if re.search(rf"\b{re.escape(old)}\b", response)}
+        if len(present_variants) < 1:
+            return None
+
+        renames.update(present_variants)
+
+    if len(renames) < 1:
+        return response
+
+    pattern = re.compile(r"\b(" + "|".join(re.escape(old) for old in sorted(renames, key=len, reverse=True)) + r")\b")
+    return pattern.sub(lambda match: renames[match.group(1)], response)
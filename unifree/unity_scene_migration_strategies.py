@@ -0,0 +1,677 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+from __future__ import annotations
+
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, TextIO, Callable
+
+from unifree import MigrationStrategy, FileMigrationSpec, log, utils
+from unifree.unity_yaml import read_unity_documents, UnityValue
+
+_TRANSFORM_PROPERTIES = {"m_GameObject", "m_Father", "m_Children", "m_LocalPosition", "m_LocalRotation", "m_LocalScale", "m_RootOrder", "m_PrefabInstance"}
+_COLLIDER_PROPERTIES = {"m_Enabled", "m_Center", "m_Size", "m_Radius", "m_Height", "m_Direction"}
+
+# Properties of the documents the scene is made of. Components are found from the components of their game object
+_PROPERTIES_BY_TYPE = {
+    "GameObject": {"m_Name", "m_IsActive", "m_Component"},
+    "Transform": _TRANSFORM_PROPERTIES,
+    "RectTransform": _TRANSFORM_PROPERTIES,
+    "PrefabInstance": {"m_Modification", "m_SourcePrefab"},
+    "SceneRoots": {"m_Roots"},
+    "MonoBehaviour": {"m_Script"},
+    "Camera": {"field of view", "near clip plane", "far clip plane", "orthographic", "orthographic size"},
+    "Light": {"m_Type", "m_Color", "m_Intensity", "m_Range", "m_SpotAngle", "m_Shadows"},
+    "MeshRenderer": {"m_Enabled"},
+    "SkinnedMeshRenderer": {"m_Enabled"},
+    "SpriteRenderer": {"m_Color", "m_FlipX", "m_FlipY"},
+    "AudioSource": {"m_PlayOnAwake", "m_Volume"},
+    "Rigidbody": {"m_Mass", "m_UseGravity", "m_IsKinematic"},
+    "BoxCollider": _COLLIDER_PROPERTIES,
+    "SphereCollider": _COLLIDER_PROPERTIES,
+    "CapsuleCollider": _COLLIDER_PROPERTIES,
+}
+
+# Component types that make a node, in the order of preference for the node itself. The others become child nodes
+_NODE_TYPES = [
+    ("Rigidbody", "RigidBody3D"),
+    ("Camera", "Camera3D"),
+    ("Light", "Light"),  # Depends on the type of the light
+    ("MeshRenderer", "MeshInstance3D"),
+    ("SkinnedMeshRenderer", "MeshInstance3D"),
+    ("SpriteRenderer", "Sprite3D"),
+    ("AudioSource", "AudioStreamPlayer3D"),
+]
+_COLLIDER_SHAPES = {"BoxCollider": "BoxShape3D", "SphereCollider": "SphereShape3D", "CapsuleCollider": "CapsuleShape3D"}
+_INVALID_NODE_NAME_CHARACTERS = re.compile(r'[.:@/"%]')
+
+
+@dataclass
+class _GameObject:
+    name: str
+    active: bool
+    component_ids: List[int]
+
+
+@dataclass
+class _Transform:
+    game_object_id: int
+    father_id: int
+    child_ids: List[int]
+    position: Tuple[float, float, float]
+    rotation: Tuple[float, float, float, float]
+    scale: Tuple[float, float, float]
+    root_order: Optional[int]
+    is_rect: bool
+
+
+@dataclass
+class _Component:
+    type_name: str
+    properties: Dict[str, UnityValue]
+
+
+@dataclass
+class _PrefabInstance:
+    source_guid: Optional[str]
+    transform_parent_id: int
+    name: Optional[str]
+    position: List[float]
+    rotation: List[float]
+    scale: List[float]
+
+
+@dataclass
+class _GodotNode:
+    name: str
+    parent_path: Optional[str]
+    """Path of the parent relative to the root ('.' for children of the root), None for the root"""
+    type: Optional[str]
+    instance: Optional[str] = None
+    """Id of the scene resource the node is an instance of"""
+    properties: List[Tuple[str, str]] = field(default_factory=list)
+
+
+class _UnityScene:
+    """
+    Object graph of a Unity scene or prefab: game objects, their transforms and the components the Godot scene is made of
+    """
+    game_objects: Dict[int, _GameObject]
+    transforms: Dict[int, _Transform]
+    components: Dict[int, _Component]
+    prefab_instances: Dict[int, _PrefabInstance]
+    stripped_transforms: Dict[int, int]
+    """Placeholders of prefab instance roots, by their file id: id of the prefab instance"""
+    root_ids: Optional[List[int]]
+    """Roots in the order of the scene hierarchy, if the scene lists them"""
+
+    def __init__(self) -> None:
+        self.game_objects = {}
+        self.transforms = {}
+        self.components = {}
+        self.prefab_instances = {}
+        self.stripped_transforms = {}
+        self.root_ids = None
+
+    @classmethod
+    def read(cls, file_path: str) -> _UnityScene:
+        result = cls()
+        for document in read_unity_documents(file_path, _PROPERTIES_BY_TYPE):
+            result.add(document.type_name, document.file_id, document.stripped, document.properties)
+
+        return result
+
+    def add(self, type_name: str, file_id: int, stripped: bool, properties: Dict[str, UnityValue]) -> None:
+        if type_name in ["Transform", "RectTransform"] and stripped:
+            self.stripped_transforms[file_id] = _file_id(properties.get("m_PrefabInstance"))
+        elif type_name in ["Transform", "RectTransform"]:
+            self.transforms[file_id] = _Transform(
+                game_object_id=_file_id(properties.get("m_GameObject")),
+                father_id=_file_id(properties.get("m_Father")),
+                child_ids=[_file_id(child) for child in properties.get("m_Children") or []],
+                position=_vector(properties.get("m_LocalPosition"), "xyz", 0.0),
+                rotation=_vector(properties.get("m_LocalRotation"), "xyzw", 0.0, w=1.0),
+                scale=_vector(properties.get("m_LocalScale"), "xyz", 1.0),
+                root_order=_int(properties.get("m_RootOrder")),
+                is_rect=type_name == "RectTransform",
+            )
+        elif type_name == "GameObject" and not stripped:
+            self.game_objects[file_id] = _GameObject(
+                name=properties.get("m_Name") or "",
+                active=properties.get("m_IsActive") != "0",
+                component_ids=[_file_id((component or {}).get("component")) for component in properties.get("m_Component") or []],
+            )
+        elif type_name == "PrefabInstance":
+            self.prefab_instances[file_id] = self._create_prefab_instance(properties)
+        elif type_name == "SceneRoots":
+            self.root_ids = [_file_id(root) for root in properties.get("m_Roots") or []]
+        elif type_name == "MonoBehaviour" and not stripped:
+            # Script data can be large and is not part of the scene, only the script is kept
+            self.components[file_id] = _Component(type_name, {"m_Script": {"guid": (properties.get("m_Script") or {}).get("guid")}})
+        elif not stripped:
+            self.components[file_id] = _Component(type_name, properties)
+
+    @staticmethod
+    def _create_prefab_instance(properties: Dict[str, UnityValue]) -> _PrefabInstance:
+        modification = properties.get("m_Modification") or {}
+        result = _PrefabInstance(
+            source_guid=(properties.get("m_SourcePrefab") or {}).get("guid"),
+            transform_parent_id=_file_id(modification.get("m_TransformParent")),
+            name=None,
+            position=[0.0, 0.0, 0.0],
+            rotation=[0.0, 0.0, 0.0, 1.0],
+            scale=[1.0, 1.0, 1.0],
+        )
+
+        # Unity records the name and the transform of the instance root as modifications. Modifications of other objects
+        # of the prefab follow the ones of the root
+        root_transform_id = None
+        for item in modification.get("m_Modifications") or []:
+            item = item if isinstance(item, dict) else {}
+            property_path, value, target_id = item.get("propertyPath"), item.get("value"), _file_id(item.get("target"))
+            if property_path == "m_Name" and result.name is None:
+                result.name = value
+            elif property_path and "." in property_path:
+                vector_name, _, axis = property_path.partition(".")
+                vector = {"m_LocalPosition": result.position, "m_LocalRotation": result.rotation, "m_LocalScale": result.scale}.get(vector_name)
+                if vector is None or len(axis) != 1 or axis not in "xyzw"[:len(vector)]:
+                    continue
+
+                root_transform_id = root_transform_id or target_id
+                if target_id == root_transform_id:
+                    vector["xyzw".index(axis)] = _float(value, vector["xyzw".index(axis)])
+
+        return result
+
+
+class UnityYamlToGodotScene(MigrationStrategy):
+    """
+    Strategy to migrate a Unity scene (.unity) or prefab (.prefab) to a Godot scene (.tscn), without an LLM.
+
+    The file is read one YAML document at a time (see `read_unity_documents`), only the object graph is kept in
+    memory. Game objects become nodes, with the type of their main component (i.e. `Camera3D` for a camera,
+    `RigidBody3D` for a rigid body), other components become child nodes. Colliders become `CollisionShape3D` nodes,
+    scripts are attached to the node (or child nodes, if there are several) from their migrated location. Prefab
+    instances become instances of the migrated prefab scenes. Positions and rotations are converted from the left-handed
+    Unity coordinates to Godot coordinates.
+
+    Add it to the strategies:
+
+    ```
+    strategies:
+      .unity: UnityYamlToGodotScene
+      .prefab: UnityYamlToGodotScene
+    ```
+    """
+    _file_migration_spec: FileMigrationSpec
+
+    def __init__(self, file_migration_spec: FileMigrationSpec, config: Dict) -> None:
+        super().__init__(config)
+        self._file_migration_spec = file_migration_spec
+
+    @property
+    def source_file_path(self) -> str:
+        return self._file_migration_spec.source_file_path
+
+    @property
+    def relative_source_file_path(self) -> str:
+        return os.path.relpath(self.source_file_path, self._file_migration_spec.source_project_path)
+
+    @property
+    def destination_file_path(self) -> str:
+        return os.path.join(
+            self._file_migration_spec.destination_project_path,
+            utils.create_destination_relative_path(self.relative_source_file_path, ".tscn", self.config),
+        )
+
+    def execute(self) -> None:
+        scene = _UnityScene.read(self.source_file_path)
+
+        destination_file_path = self.destination_file_path
+        os.makedirs(os.path.dirname(destination_file_path), exist_ok=True)
+
+        log.debug(f"Writing {len(scene.game_objects):,} game objects and {len(scene.prefab_instances):,} prefab instances to '{destination_file_path}'...")
+        with open(destination_file_path, 'w') as output_file:
+            _GodotSceneWriter(scene, self._asset_paths_by_guid(), self._resource_path).write(output_file, self._root_name(), self.source_file_path.endswith(".prefab"))
+
+        utils.increment_statistic("Unity scenes and prefabs migrated without an LLM")
+
+    def _root_name(self) -> str:
+        return os.path.splitext(os.path.basename(self.source_file_path))[0]
+
+    def _resource_path(self, relative_asset_path: str) -> Optional[str]:
+        """
+        :return: Godot path of the migrated asset, None if it is not migrated
+        """
+        _, extension = os.path.splitext(relative_asset_path)
+        if extension == ".cs" and self.config["target"]["extension"]:
+            extension = self.config["target"]["extension"]
+        elif extension in [".prefab", ".unity"]:
+            extension = ".tscn"
+        else:
+            return None
+
+        return "res://" + utils.create_destination_relative_path(relative_asset_path, extension, self.config).replace(os.sep, "/")
+
+    def _asset_paths_by_guid(self) -> Dict[str, str]:
+        project_path = os.path.abspath(self._file_migration_spec.source_project_path)
+        # Read once per migration, a MigrationServer could migrate a changed checkout of the same path later
+        return utils.get_or_create_migration_instance(f"unity_asset_paths_by_guid:{project_path}", lambda: _read_asset_guids(project_path))
+
+    def __str__(self) -> str:
+        return f"[Migrate '{self.source_file_path}' to '{self.destination_file_path}']"
+
+
+class _GodotSceneWriter:
+    _scene: _UnityScene
+    _asset_paths_by_guid: Dict[str, str]
+    _resource_path: Callable[[str], Optional[str]]
+
+    _external_resources: Dict[Tuple[str, str], str]
+    """(type, path): id"""
+    _sub_resources: List[Tuple[str, str, List[Tuple[str, str]]]]
+    """(type, id, properties)"""
+
+    def __init__(self, scene: _UnityScene, asset_paths_by_guid: Dict[str, str], resource_path: Callable[[str], Optional[str]]) -> None:
+        self._scene = scene
+        self._asset_paths_by_guid = asset_paths_by_guid
+        self._resource_path = resource_path
+
+        self._external_resources = {}
+        self._sub_resources = []
+
+    def write(self, output_file: TextIO, root_name: str, is_prefab: bool) -> None:
+        """
+        :param output_file: File to write the .tscn scene to
+        :param root_name: Name of the root node of scenes
+        :param is_prefab: True if the file is a prefab, its root object becomes the root of the Godot scene
+        """
+        nodes = self._create_nodes(root_name, is_prefab)
+
+        output_file.write(f"[gd_scene load_steps={len(self._external_resources) + len(self._sub_resources) + 1} format=3]\n\n")
+
+        for (resource_type, path), resource_id in self._external_resources.items():
+            output_file.write(f'[ext_resource type="{resource_type}" path="{_escape(path)}" id="{resource_id}"]\n')
+        if len(self._external_resources) > 0:
+            output_file.write("\n")
+
+        for resource_type, resource_id, properties in self._sub_resources:
+            output_file.write(f'[sub_resource type="{resource_type}" id="{resource_id}"]\n')
+            output_file.writelines(f"{name} = {value}\n" for name, value in properties)
+            output_file.write("\n")
+
+        for node in nodes:
+            header = f'[node name="{_escape(node.name)}"'
+            if node.type:
+                header += f' type="{node.type}"'
+            if node.parent_path is not None:
+                header += f' parent="{_escape(node.parent_path)}"'
+            if node.instance:
+                header += f' instance=ExtResource("{node.instance}")'
+
+            output_file.write(header + "]\n")
+            output_file.writelines(f"{name} = {value}\n" for name, value in node.properties)
+            output_file.write("\n")
+
+    def _create_nodes(self, root_name: str, is_prefab: bool) -> List[_GodotNode]:
+        root_ids = self._root_ids()
+
+        # A prefab has one root object, it is the root of the Godot scene. Scenes get a root node for their objects
+        result = []
+        if is_prefab and len(root_ids) == 1:
+            stack = [(root_ids[0], None)]
+        else:
+            result.append(_GodotNode(name=_node_name(root_name, "Scene"), parent_path=None, type="Node3D"))
+            stack = [(root_id, ".") for root_id in reversed(root_ids)]
+
+        children_ids = self._children_ids()
+        sibling_names: Dict[Optional[str], Dict[str, int]] = {}
+
+        # Depth first, so parents are written before their children
+        while len(stack) > 0:
+            node_id, parent_path = stack.pop()
+
+            nodes = self._create_object_nodes(node_id, parent_path)
+            if len(nodes) < 1:
+                continue
+
+            node = nodes[0]
+            node.name = _unique_name(node.name, sibling_names.setdefault(parent_path, {}))
+            node_path = None if parent_path is None else node.name if parent_path == "." else f"{parent_path}/{node.name}"
+
+            for child_node in nodes[1:]:
+                child_node.parent_path = node_path or "."
+                child_node.name = _unique_name(child_node.name, sibling_names.setdefault(child_node.parent_path, {}))
+
+            result.extend(nodes)
+            stack.extend((child_id, node_path or ".") for child_id in reversed(children_ids.get(node_id, [])))
+
+        return result
+
+    def _node_id(self, transform_id: int) -> int:
+        """
+        :return: Node id of the transform: the prefab instance for placeholders of prefab instance roots
+        """
+        return self._scene.stripped_transforms.get(transform_id, transform_id)
+
+    def _parent_id(self, node_id: int) -> int:
+        if node_id in self._scene.prefab_instances:
+            return self._node_id(self._scene.prefab_instances[node_id].transform_parent_id)
+
+        return self._node_id(self._scene.transforms[node_id].father_id)
+
+    def _root_ids(self) -> List[int]:
+        node_ids = list(self._scene.transforms.keys()) + list(self._scene.prefab_instances.keys())
+        roots = [node_id for node_id in node_ids if self._parent_id(node_id) == 0]
+
+        if self._scene.root_ids:
+            order = {self._node_id(root_id): ix for ix, root_id in enumerate(self._scene.root_ids)}
+        else:
+            order = {node_id: self._scene.transforms[node_id].root_order for node_id in roots if node_id in self._scene.transforms}
+
+        return sorted(roots, key=lambda node_id: order.get(node_id) if order.get(node_id) is not None else len(node_ids))
+
+    def _children_ids(self) -> Dict[int, List[int]]:
+        """
+        :return: Children of every node in the order of the hierarchy (the order of 'm_Children'). Children that are not
+                 listed (i.e. objects added to prefab instances) come last
+        """
+        result: Dict[int, List[int]] = {}
+        for node_id in list(self._scene.transforms.keys()) + list(self._scene.prefab_instances.keys()):
+            parent_id = self._parent_id(node_id)
+            if parent_id != 0:
+                result.setdefault(parent_id, []).append(node_id)
+
+        for parent_id, child_ids in result.items():
+            parent_transform = self._scene.transforms.get(parent_id)
+            if parent_transform is not None and len(parent_transform.child_ids) > 0:
+                order = {self._node_id(child_id): ix for ix, child_id in enumerate(parent_transform.child_ids)}
+                child_ids.sort(key=lambda child_id: order.get(child_id, len(order)))
+
+        return result
+
+    def _create_object_nodes(self, node_id: int, parent_path: Optional[str]) -> List[_GodotNode]:
+        """
+        :return: Node of the object followed by nodes of its secondary components (their parent path is set by the caller)
+        """
+        if node_id in self._scene.prefab_instances:
+            return [self._create_prefab_instance_node(self._scene.prefab_instances[node_id], parent_path)]
+
+        transform = self._scene.transforms.get(node_id)
+        game_object = self._scene.game_objects.get(transform.game_object_id) if transform else None
+        if game_object is None:
+            return []
+
+        components = [self._scene.components[component_id] for component_id in game_object.component_ids if component_id in self._scene.components]
+        components_by_type: Dict[str, List[_Component]] = {}
+        for component in components:
+            components_by_type.setdefault(component.type_name, []).append(component)
+
+        node_components = [(type_name, node_type, components_by_type[type_name][0]) for type_name, node_type in _NODE_TYPES if type_name in components_by_type]
+        colliders = [component for component in components if component.type_name in _COLLIDER_SHAPES]
+
+        if transform.is_rect:
+            node = _GodotNode(name=_node_name(game_object.name, "Control"), parent_path=parent_path, type="Control")
+        elif len(colliders) > 0 and "Rigidbody" not in components_by_type:
+            node = _GodotNode(name=_node_name(game_object.name, "StaticBody3D"), parent_path=parent_path, type="StaticBody3D")
+        elif len(node_components) > 0:
+            type_name, node_type, component = node_components.pop(0)
+            node = self._create_component_node(_node_name(game_object.name, node_type), parent_path, node_type, component)
+        else:
+            node = _GodotNode(name=_node_name(game_object.name, "Node3D"), parent_path=parent_path, type="Node3D")
+
+        if not transform.is_rect:
+            node.properties[:0] = _transform_properties(transform.position, transform.rotation, transform.scale)
+        if not game_object.active:
+            node.properties.append(("visible", "false"))
+
+        result = [node]
+        for type_name, node_type, component in node_components:
+            result.append(self._create_component_node(None, None, node_type, component))
+
+        for component in colliders:
+            result.append(self._create_collider_node(component))
+
+        scripts = [self._script_resource(component) for component in components_by_type.get("MonoBehaviour", [])]
+        for ix, script in enumerate([script for script in scripts if script is not None]):
+            script_path, script_id = script
+            if ix == 0:
+                node.properties.append(("script", f'ExtResource("{script_id}")'))
+            else:
+                script_name = os.path.splitext(os.path.basename(script_path))[0]
+                result.append(_GodotNode(name=_node_name(script_name, "Script"), parent_path=None, type="Node", properties=[("script", f'ExtResource("{script_id}")')]))
+
+        return result
+
+    def _create_component_node(self, name: Optional[str], parent_path: Optional[str], node_type: str, component: _Component) -> _GodotNode:
+        properties = component.properties
+        result_properties: List[Tuple[str, str]] = []
+
+        if node_type == "Light":
+            node_type = {"0": "SpotLight3D", "1": "DirectionalLight3D"}.get(properties.get("m_Type"), "OmniLight3D")
+
+            color = properties.get("m_Color")
+            if color:
+                result_properties.append(("light_color", _color(color)))
+            if properties.get("m_Intensity") is not None:
+                result_properties.append(("light_energy", _number(_float(properties.get("m_Intensity"), 1.0))))
+            if (properties.get("m_Shadows") or {}).get("m_Type") not in [None, "0"]:
+                result_properties.append(("shadow_enabled", "true"))
+            if node_type == "OmniLight3D" and properties.get("m_Range") is not None:
+                result_properties.append(("omni_range", _number(_float(properties.get("m_Range"), 10.0))))
+            if node_type == "SpotLight3D":
+                if properties.get("m_Range") is not None:
+                    result_properties.append(("spot_range", _number(_float(properties.get("m_Range"), 10.0))))
+                if properties.get("m_SpotAngle") is not None:
+                    result_properties.append(("spot_angle", _number(_float(properties.get("m_SpotAngle"), 30.0) / 2)))
+
+        elif node_type == "Camera3D":
+            if properties.get("orthographic") == "1":
+                result_properties.append(("projection", "1"))
+                result_properties.append(("size", _number(2 * _float(properties.get("orthographic size"), 5.0))))
+            elif properties.get("field of view") is not None:
+                result_properties.append(("fov", _number(_float(properties.get("field of view"), 60.0))))
+            if properties.get("near clip plane") is not None:
+                result_properties.append(("near", _number(_float(properties.get("near clip plane"), 0.05))))
+            if properties.get("far clip plane") is not None:
+                result_properties.append(("far", _number(_float(properties.get("far clip plane"), 4000.0))))
+
+        elif node_type == "RigidBody3D":
+            if properties.get("m_Mass") is not None:
+                result_properties.append(("mass", _number(_float(properties.get("m_Mass"), 1.0))))
+            if properties.get("m_UseGravity") == "0":
+                result_properties.append(("gravity_scale", "0.0"))
+            if properties.get("m_IsKinematic") == "1":
+                result_properties.append(("freeze", "true"))
+
+        elif node_type == "Sprite3D":
+            if properties.get("m_Color"):
+                result_properties.append(("modulate", _color(properties.get("m_Color"))))
+            if properties.get("m_FlipX") == "1":
+                result_properties.append(("flip_h", "true"))
+            if properties.get("m_FlipY") == "1":
+                result_properties.append(("flip_v", "true"))
+
+        elif node_type == "AudioStreamPlayer3D":
+            if properties.get("m_PlayOnAwake") == "1":
+                result_properties.append(("autoplay", "true"))
+            volume = _float(properties.get("m_Volume"), 1.0)
+            if volume != 1.0:
+                result_properties.append(("volume_db", _number(20 * math.log10(volume)) if volume > 0 else "-80.0"))
+
+        elif node_type == "MeshInstance3D" and properties.get("m_Enabled") == "0":
+            result_properties.append(("visible", "false"))
+
+        return _GodotNode(name=name or node_type, parent_path=parent_path, type=node_type, properties=result_properties)
+
+    def _create_collider_node(self, component: _Component) -> _GodotNode:
+        properties = component.properties
+        shape_type = _COLLIDER_SHAPES[component.type_name]
+
+        shape_properties = []
+        if shape_type == "BoxShape3D":
+            size = _vector(properties.get("m_Size"), "xyz", 1.0)
+            shape_properties.append(("size", f"Vector3({', '.join(_number(value) for value in size)})"))
+        else:
+            shape_properties.append(("radius", _number(_float(properties.get("m_Radius"), 0.5))))
+            if shape_type == "CapsuleShape3D":
+                shape_properties.append(("height", _number(_float(properties.get("m_Height"), 2.0))))
+
+        shape_id = f"{shape_type}_{len(self._sub_resources) + 1}"
+        self._sub_resources.append((shape_type, shape_id, shape_properties))
+
+        # Capsules are along Y in Godot, Unity capsules can be along X (0) or Z (2)
+        rotation = {"0": (0.0, 0.0, -math.sqrt(0.5), math.sqrt(0.5)), "2": (math.sqrt(0.5), 0.0, 0.0, math.sqrt(0.5))}.get(
+            properties.get("m_Direction") if shape_type == "CapsuleShape3D" else None, (0.0, 0.0, 0.0, 1.0))
+
+        result = _GodotNode(name="CollisionShape3D", parent_path=None, type="CollisionShape3D")
+        result.properties.extend(_transform_properties(_vector(properties.get("m_Center"), "xyz", 0.0), rotation, (1.0, 1.0, 1.0)))
+        result.properties.append(("shape", f'SubResource("{shape_id}")'))
+        if properties.get("m_Enabled") == "0":
+            result.properties.append(("disabled", "true"))
+
+        return result
+
+    def _create_prefab_instance_node(self, prefab_instance: _PrefabInstance, parent_path: Optional[str]) -> _GodotNode:
+        asset_path = self._asset_paths_by_guid.get(prefab_instance.source_guid or "")
+        resource_path = self._resource_path(asset_path) if asset_path else None
+        default_name = os.path.splitext(os.path.basename(asset_path))[0] if asset_path else "PrefabInstance"
+
+        if resource_path is None:
+            result = _GodotNode(name=_node_name(prefab_instance.name or default_name, "PrefabInstance"), parent_path=parent_path, type="Node3D")
+        else:
+            result = _GodotNode(name=_node_name(prefab_instance.name or default_name, "PrefabInstance"), parent_path=parent_path, type=None,
+                                instance=self._external_resource("PackedScene", resource_path))
+
+        result.properties.extend(_transform_properties(tuple(prefab_instance.position), tuple(prefab_instance.rotation), tuple(prefab_instance.scale)))
+        return result
+
+    def _script_resource(self, component: _Component) -> Optional[Tuple[str, str]]:
+        """
+        :return: (path, id) of the migrated script of a MonoBehaviour, None if the script is not part of the project
+        """
+        asset_path = self._asset_paths_by_guid.get((component.properties.get("m_Script") or {}).get("guid") or "")
+        resource_path = self._resource_path(asset_path) if asset_path else None
+        if resource_path is None:
+            return None
+
+        return resource_path, self._external_resource("Script", resource_path)
+
+    def _external_resource(self, resource_type: str, path: str) -> str:
+        key = (resource_type, path)
+        if key not in self._external_resources:
+            self._external_resources[key] = str(len(self._external_resources) + 1)
+
+        return self._external_resources[key]
+
+
+def _read_asset_guids(project_path: str) -> Dict[str, str]:
+    """
+    :return: Paths of assets in the project (relative to it) by their GUID, from the .meta files
+    """
+    result = {}
+    for root, _, files in os.walk(project_path):
+        for file in files:
+            if not file.endswith(".meta"):
+                continue
+
+            try:
+                with open(os.path.join(root, file), 'r', encoding='utf-8', errors='replace') as meta_file:
+                    for line in meta_file:
+                        if line.startswith("guid:"):
+                            result[line[len("guid:"):].strip()] = os.path.relpath(os.path.join(root, file[:-len(".meta")]), project_path)
+                            break
+            except OSError as e:
+                log.debug(f"Unable to read '{file}': {e}")
+
+    return result
+
+
+def _transform_properties(position: Tuple[float, ...], rotation: Tuple[float, ...], scale: Tuple[float, ...]) -> List[Tuple[str, str]]:
+    """
+    :return: Godot 'transform' property of a Unity transform, none if it is the identity
+    """
+    # Unity is left-handed: mirroring the Z axis negates X and Y of rotations
+    x, y, z, w = -rotation[0], -rotation[1], rotation[2], rotation[3]
+    origin = (position[0], position[1], -position[2])
+
+    length = math.sqrt(x * x + y * y + z * z + w * w) or 1.0
+    x, y, z, w = x / length, y / length, z / length, w / length
+    rows = [
+        (1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)),
+        (2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)),
+        (2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)),
+    ]
+    basis = [rows[row][column] * scale[column] for row in range(3) for column in range(3)]
+
+    values = basis + list(origin)
+    if all(abs(value - identity) < 1e-9 for value, identity in zip(values, [1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0])):
+        return []
+
+    return [("transform", f"Transform3D({', '.join(_number(value) for value in values)})")]
+
+
+def _file_id(reference: UnityValue) -> int:
+    try:
+        return int((reference or {}).get("fileID") or 0)
+    except (ValueError, AttributeError):
+        return 0
+
+
+def _float(value: UnityValue, default: float) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _int(value: UnityValue) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _vector(value: UnityValue, axes: str, default: float, w: float = 1.0) -> Tuple[float, ...]:
+    value = value if isinstance(value, dict) else {}
+    return tuple(_float(value.get(axis), w if axis == "w" else default) for axis in axes)
+
+
+def _color(value: UnityValue) -> str:
+    return f"Color({', '.join(_number(component) for component in _vector(value, 'rgba', 1.0))})"
+
+
+def _number(value: float) -> str:
+    result = f"{value:.6f}".rstrip("0").rstrip(".")
+    return "0" if result in ["-0", ""] else result
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _node_name(name: str, default: str) -> str:
+    return _INVALID_NODE_NAME_CHARACTERS.sub("_", name).strip() or default
+
+
+def _unique_name(name: str, used_names: Dict[str, int]) -> str:
+    """
+    Godot requires unique names of siblings, Unity does not
+    """
+    count = used_names.get(name, 0)
+    used_names[name] = count + 1
+    if count == 0:
+        return name
+
+    result = f"{name}{count + 1}"
+    while result in used_names:
+        count += 1
+        result = f"{name}{count + 1}"
+
+    used_names[result] = 1
+    return result
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Set, Iterator, List, Tuple
+
+_DOCUMENT_HEADER_REGEX = re.compile(r"--- !u!(\d+) &(-?\d+)( stripped)?")
+_DOUBLE_QUOTED_ESCAPE_REGEX = re.compile(r'\\(.)')
+_DOUBLE_QUOTED_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "0": "\0"}
+
+UnityValue = Any
+"""String, dict of values or list of values: Unity YAML scalars are not typed, numbers are returned as strings"""
+
+
+@dataclass
+class UnityDocument:
+    class_id: int
+    file_id: int
+    type_name: str
+    """Name of the serialized class, i.e. 'GameObject', 'Transform' or 'MonoBehaviour'"""
+    stripped: bool
+    """Placeholder of an object of a prefab instance, only references the instance"""
+    properties: Dict[str, UnityValue]
+
+
+def read_unity_documents(file_path: str, properties_by_type: Optional[Dict[str, Optional[Set[str]]]] = None) -> Iterator[UnityDocument]:
+    """
+    Read objects of a Unity YAML file (a scene, prefab or asset), one document at a time. Only one document is held in
+    memory and only the requested properties are parsed, so large scenes are read quickly and with bounded memory.
+
+    :param file_path: Path of the file
+    :param properties_by_type: Top level properties to parse per type name, None to parse all of them. Documents of other
+                               types are skipped. If None, all documents with all properties are returned
+    :return: Documents in the file order
+    """
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as input_file:
+        header: Optional[Tuple[int, int, bool]] = None
+        type_name: Optional[str] = None
+        wanted_properties: Optional[Set[str]] = None
+        is_wanted_document = False
+        is_wanted_property = False
+        lines: List[str] = []
+
+        for line in input_file:
+            if line.startswith("--- "):
+                if is_wanted_document:
+                    yield UnityDocument(header[0], header[1], type_name, header[2], parse_unity_yaml_block(lines))
+
+                match = _DOCUMENT_HEADER_REGEX.match(line)
+                header = (int(match.group(1)), int(match.group(2)), match.group(3) is not None) if match else None
+                type_name = None
+                is_wanted_document = False
+                lines = []
+            elif header is None:
+                continue  # Directives (%YAML, %TAG) or an unsupported document
+            elif type_name is None:
+                type_name = line.rstrip()[:-1]
+                is_wanted_document = properties_by_type is None or type_name in properties_by_type
+                wanted_properties = properties_by_type.get(type_name) if properties_by_type is not None else None
+                is_wanted_property = False
+            elif is_wanted_document:
+                # Top level properties are indented by 2 spaces, sequences may start at the same indentation
+                if line.startswith("  ") and not line.startswith("   ") and not line.startswith("  - "):
+                    is_wanted_property = wanted_properties is None or line[2:line.find(":")] in wanted_properties
+
+                if is_wanted_property:
+                    lines.append(line[2:].rstrip("\r\n"))
+
+        if is_wanted_document:
+            yield UnityDocument(header[0], header[1], type_name, header[2], parse_unity_yaml_block(lines))
+
+
+def parse_unity_yaml_block(lines: List[str]) -> Dict[str, UnityValue]:
+    """
+    Parse the subset of YAML Unity writes: block mappings, block sequences (at the same indentation as their key), flow
+    mappings and sequences and plain or quoted scalars (possibly continued on more lines)
+
+    :param lines: Lines of a mapping, without line breaks
+    :return: Parsed mapping
+    """
+    indented_lines = []
+    for line in lines:
+        content = line.lstrip(' ')
+        if content:
+            indented_lines.append((len(line) - len(content), content))
+
+    if len(indented_lines) < 1:
+        return {}
+
+    result, _ = _parse_node(indented_lines, 0, indented_lines[0][0])
+    return result if isinstance(result, dict) else {}
+
+
+def _parse_node(lines: List[Tuple[int, str]], ix: int, indent: int) -> Tuple[UnityValue, int]:
+    if lines[ix][1].startswith("-"):
+        return _parse_sequence(lines, ix, indent)
+
+    return _parse_mapping(lines, ix, indent)
+
+
+def _parse_mapping(lines: List[Tuple[int, str]], ix: int, indent: int) -> Tuple[Dict[str, UnityValue], int]:
+    result = {}
+    while ix < len(lines):
+        line_indent, content = lines[ix]
+        if line_indent != indent or content.startswith("- ") or content == "-":
+            break
+
+        key, _, value = content.partition(":")
+        value = value.strip()
+        ix += 1
+
+        if value:
+            value, ix = _parse_inline_value(value, lines, ix, indent)
+        elif ix < len(lines) and lines[ix][0] > indent:
+            value, ix = _parse_node(lines, ix, lines[ix][0])
+        elif ix < len(lines) and lines[ix][0] == indent and lines[ix][1].startswith("-"):
+            value, ix = _parse_sequence(lines, ix, indent)
+        else:
+            value = None
+
+        result[key] = value
+
+    return result, ix
+
+
+def _parse_sequence(lines: List[Tuple[int, str]], ix: int, indent: int) -> Tuple[List[UnityValue], int]:
+    result = []
+    while ix < len(lines):
+        line_indent, content = lines[ix]
+        if line_indent != indent or not (content.startswith("- ") or content == "-"):
+            break
+
+        item = content[2:].strip()
+        if not item:
+            ix += 1
+            value = None
+            if ix < len(lines) and lines[ix][0] > indent:
+                value, ix = _parse_node(lines, ix, lines[ix][0])
+        elif item[0] not in "{['\"" and (": " in item or item.endswith(":")):
+            # Mapping item, its first key is on the line of the dash
+            lines[ix] = (indent + 2, item)
+            value, ix = _parse_mapping(lines, ix, indent + 2)
+        else:
+            value, ix = _parse_inline_value(item, lines, ix + 1, indent)
+
+        result.append(value)
+
+    return result, ix
+
+
+def _parse_inline_value(text: str, lines: List[Tuple[int, str]], ix: int, indent: int) -> Tuple[UnityValue, int]:
+    """
+    Parse a value that starts on the line of its key, scalars may continue on more indented lines
+    """
+    if text[0] in "{[":
+        return _parse_flow(text, 0)[0], ix
+
+    while ix < len(lines) and lines[ix][0] > indent:
+        text += " " + lines[ix][1]
+        ix += 1
+
+    return _parse_scalar(text), ix
+
+
+def _parse_flow(text: str, position: int) -> Tuple[UnityValue, int]:
+    """
+    :return: Value starting at the position and the position after it
+    """
+    while position < len(text) and text[position] == " ":
+        position += 1
+
+    if position >= len(text):
+        return None, position
+
+    opening = text[position]
+    if opening not in "{[":
+        end = position
+        if opening in "'\"":
+            end = text.find(opening, position + 1)
+            while 0 < end < len(text) - 1 and text[end + 1] == opening and opening == "'":
+                end = text.find(opening, end + 2)
+            end = len(text) if end < 0 else end + 1
+
+        while end < len(text) and text[end] not in ",}]":
+            end += 1
+
+        return _parse_scalar(text[position:end]), end
+
+    closing = "}" if opening == "{" else "]"
+    result: Any = {} if opening == "{" else []
+    position += 1
+
+    while position < len(text):
+        while position < len(text) and text[position] in " ,":
+            position += 1
+
+        if position >= len(text):
+            break
+        if text[position] == closing:
+            return result, position + 1
+
+        if opening == "{":
+            colon = text.find(":", position)
+            if colon < 0:
+                break
+            key = text[position:colon].strip()
+            value, position = _parse_flow(text, colon + 1)
+            result[key] = value
+        else:
+            value, position = _parse_flow(text, position)
+            result.append(value)
+
+    return result, len(text)
+
+
+def _parse_scalar(text: str) -> Optional[str]:
+    text = text.strip()
+    if len(text) >= 2 and text[0] == "'" and text[-1] == "'":
+        return text[1:-1].replace("''", "'")
+    if len(text) >= 2 and text[0] == '"' and text[-1] == '"':
+        return _DOUBLE_QUOTED_ESCAPE_REGEX.sub(lambda match: _DOUBLE_QUOTED_ESCAPES.get(match.group(1), match.group(1)), text[1:-1])
+
+    return text
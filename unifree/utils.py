@@ -7,8 +7,10 @@ import importlib
 import os
 import re
 import threading
-from collections import defaultdict
-from typing import Type, Dict, Any, TypeVar, Callable
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Type, Dict, Any, TypeVar, Callable, Generic, Optional, Hashable, Iterator
 
 import yaml
 
@@ -66,6 +68,27 @@ def snake_to_camel(snake_case_str: str) -> str:
     return camel_case_str
 
 
+def create_destination_relative_path(relative_source_path: str, extension: str, config: Dict) -> str:
+    """
+    Path of a migrated file in the destination project, following the naming options in 'target'
+    :param relative_source_path: Path of the source file, relative to the source project
+    :param extension: Extension of the migrated file
+    :param config: Tool configuration
+    :return: Path relative to the destination project
+    """
+    relative_folder_path = os.path.dirname(relative_source_path)
+    if config["target"]["lower_folder_names"]:
+        relative_folder_path = relative_folder_path.lower()
+
+    file_name, _ = os.path.splitext(os.path.basename(relative_source_path))
+    if config["target"]["convert_filename_to_camelcase"]:
+        file_name = snake_to_camel(file_name)
+    elif config["target"]["convert_filename_to_snake_case"]:
+        file_name = camel_to_snake(file_name)
+
+    return os.path.join(relative_folder_path, file_name + extension)
+
+
 def to_default_dict(d):
     if isinstance(d, dict):
         return defaultdict(_return_none, {k: to_default_dict(v) for k, v in d.items()})
@@ -81,17 +104,155 @@ def _return_none():
 
 InstanceType = TypeVar('InstanceType')
 
-_global_instances: Dict[str, Any] = {}
-_global_instances_lock: threading.Lock = threading.Lock()
+class _Instances:
+    """
+    Instances by name, each created once. Only creation of the same instance is serialized, so creators can get or
+    create other instances (i.e. an LLM pool initializing its backends)
+    """
+    _instances: Dict[str, Any]
+    _creation_locks: Dict[str, threading.Lock]
+    _lock: threading.Lock
 
+    def __init__(self) -> None:
+        self._instances = {}
+        self._creation_locks = {}
+        self._lock = threading.Lock()
 
-def get_or_create_global_instance(name: str, new_instance_creator: Callable[[], InstanceType]) -> InstanceType:
-    global _global_instances
-    global _global_instances_lock
+    def get_or_create(self, name: str, new_instance_creator: Callable[[], InstanceType]) -> InstanceType:
+        if name not in self._instances:
+            with self._lock:
+                creation_lock = self._creation_locks.setdefault(name, threading.Lock())
 
-    if name not in _global_instances:
-        with _global_instances_lock:
-            if name not in _global_instances:
-                _global_instances[name] = new_instance_creator()
+            with creation_lock:
+                if name not in self._instances:
+                    self._instances[name] = new_instance_creator()
 
-    return _global_instances[name]
+        return self._instances[name]
+
+
+_global_instances: _Instances = _Instances()
+
+
+def get_or_create_global_instance(name: str, new_instance_creator: Callable[[], InstanceType]) -> InstanceType:
+    return _global_instances.get_or_create(name, new_instance_creator)
+
+
+_migration_instances: ContextVar[Optional[_Instances]] = ContextVar("migration_instances", default=None)
+
+
+def get_or_create_migration_instance(name: str, new_instance_creator: Callable[[], InstanceType]) -> InstanceType:
+    """
+    Like `get_or_create_global_instance`, but the instance is shared only within the current `migration_scope`, for state
+    that belongs to one migration (i.e. files of the project, batch job requests). Outside of scopes the instance is global
+    """
+    instances = _migration_instances.get()
+    return (instances if instances is not None else _global_instances).get_or_create(name, new_instance_creator)
+
+
+@contextmanager
+def migration_scope() -> Iterator[None]:
+    """
+    Keep instances of `get_or_create_migration_instance` created within the block separate from other migrations, and
+    release them at the end of the block. Applies to the current thread and to threads started by
+    `ConcurrentMigrationStrategy.map_concurrently`
+    """
+    token = _migration_instances.set(_Instances())
+    try:
+        yield
+    finally:
+        _migration_instances.reset(token)
+
+
+_statistics: Dict[str, int] = defaultdict(int)
+_statistics_lock: threading.Lock = threading.Lock()
+_statistics_scope: ContextVar[Optional[Dict[str, int]]] = ContextVar("statistics_scope", default=None)
+
+
+def increment_statistic(name: str, value: int = 1) -> None:
+    """
+    Increment a named counter that is reported at the end of the migration
+    :param name:    Human readable name of the counter
+    :param value:   Value to add
+    """
+    with _statistics_lock:
+        _statistics[name] += value
+
+        scope = _statistics_scope.get()
+        if scope is not None:
+            scope[name] = scope.get(name, 0) + value
+
+
+def get_statistics() -> Dict[str, int]:
+    """
+    :return: Counters of the current `statistics_scope`, counters of the whole process outside of scopes
+    """
+    with _statistics_lock:
+        scope = _statistics_scope.get()
+        return dict(scope if scope is not None else _statistics)
+
+
+@contextmanager
+def statistics_scope() -> Iterator[Dict[str, int]]:
+    """
+    Count statistics incremented within the block separately (i.e. for one of several concurrent migrations). Applies to
+    the current thread and to threads started by `ConcurrentMigrationStrategy.map_concurrently`
+    :return: Counters of the scope
+    """
+    token = _statistics_scope.set({})
+    try:
+        yield _statistics_scope.get()
+    finally:
+        _statistics_scope.reset(token)
+
+
+ValueType = TypeVar('ValueType')
+
+
+class LruCache(Generic[ValueType]):
+    """
+    Thread-safe cache that keeps the most recently used entries while their total size is at most `max_size`. By default
+    every entry has a size of 1, so `max_size` is the number of entries
+    """
+    _max_size: int
+    _size_of: Callable[[ValueType], int]
+    _entries: OrderedDict
+    _total_size: int
+    _lock: threading.Lock
+
+    def __init__(self, max_size: int, size_of: Optional[Callable[[ValueType], int]] = None) -> None:
+        self._max_size = max_size
+        self._size_of = size_of or (lambda value: 1)
+        self._entries = OrderedDict()
+        self._total_size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[ValueType]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: ValueType) -> None:
+        size = self._size_of(value)
+
+        with self._lock:
+            if key in self._entries:
+                self._total_size -= self._entries.pop(key)[1]
+            if size > self._max_size:
+                return  # Would evict everything else and still not fit
+
+            self._entries[key] = (value, size)
+            self._total_size += size
+
+            while self._total_size > self._max_size:
+                self._total_size -= self._entries.popitem(last=False)[1][1]
+
+    @property
+    def total_size(self) -> int:
+        return self._total_size
+
+    def __len__(self) -> int:
+        return len(self._entries)
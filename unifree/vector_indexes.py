@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Unifree
+# This code is licensed under MIT license (see LICENSE.txt for details)
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Any, Tuple, Union
+
+import numpy as np
+
+from unifree import log
+
+
+@dataclass
+class SearchHit:
+    id: str
+    payload: Dict[str, str]
+    similarity: float
+    """Cosine similarity of the query and the indexed vector"""
+
+
+class VectorIndex(ABC):
+    """
+    Index of normalized vectors with a payload (i.e. source and target of a known translation) each, searched by cosine
+    similarity. Indexes created with a file path are persisted by `flush`.
+    """
+    metadata: Dict[str, str]
+
+    def __init__(self) -> None:
+        self.metadata = {}
+
+    @abstractmethod
+    def ids(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def add(self, ids: List[str], vectors: np.ndarray, payloads: List[Dict[str, str]]) -> None:
+        """
+        :param ids: Ids of the vectors, must not be in the index yet
+        :param vectors: Normalized vectors, one row per id
+        :param payloads: Payload per id, returned with search hits
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, ids: List[str]) -> None:
+        pass
+
+    @abstractmethod
+    def search(self, queries: np.ndarray, count: int) -> List[List[SearchHit]]:
+        """
+        :param queries: Normalized query vectors, one row per query
+        :param count: Maximum number of hits per query
+        :return: Hits per query, from the most similar
+        """
+        pass
+
+    @abstractmethod
+    def get_vectors(self, ids: List[str]) -> np.ndarray:
+        """
+        :param ids: Ids of indexed vectors
+        :return: Vectors (dequantized), one row per id
+        """
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    @property
+    def max_batch_size(self) -> Optional[int]:
+        """
+        Maximum number of vectors `add` accepts at once, None if not limited
+        """
+        return None
+
+
+class ExactVectorIndex(VectorIndex):
+    """
+    Brute force search over all vectors, kept in one NumPy matrix. Vectors can be stored as float16 or int8 (scaled
+    per vector) to take half or a quarter of the memory, at a small loss of precision.
+    """
+    _BLOCK_ROWS = 8192
+
+    _file_path: Optional[str]
+    _quantization: Optional[str]
+
+    _ids: List[str]
+    _payloads: List[Dict[str, str]]
+    _vectors: Optional[np.ndarray]
+    _scales: Optional[np.ndarray]
+
+    def __init__(self, file_path: Optional[str] = None, quantization: Optional[str] = None) -> None:
+        """
+        :param file_path: Where the index is persisted, None keeps it in memory only
+        :param quantization: None (float32), 'float16' or 'int8'
+        """
+        super().__init__()
+
+        if quantization not in [None, "float16", "int8"]:
+            raise RuntimeError(f"Unknown vector quantization '{quantization}', it should be 'float16' or 'int8'")
+
+        self._file_path = file_path
+        self._quantization = quantization
+
+        self._ids = []
+        self._payloads = []
+        self._vectors = None
+        self._scales = None
+
+        if file_path and os.path.isfile(file_path):
+            self._load()
+
+    def ids(self) -> List[str]:
+        return list(self._ids)
+
+    def add(self, ids: List[str], vectors: np.ndarray, payloads: List[Dict[str, str]]) -> None:
+        if len(ids) < 1:
+            return
+
+        quantized_vectors, scales = _quantize(np.asarray(vectors, dtype=np.float32), self._quantization)
+
+        self._ids.extend(ids)
+        self._payloads.extend(payloads)
+        self._vectors = quantized_vectors if self._vectors is None else np.concatenate([self._vectors, quantized_vectors])
+        if scales is not None:
+            self._scales = scales if self._scales is None else np.concatenate([self._scales, scales])
+
+    def remove(self, ids: List[str]) -> None:
+        removed_ids = set(ids)
+        kept_rows = np.array([row for row, vector_id in enumerate(self._ids) if vector_id not in removed_ids], dtype=np.int64)
+
+        self._ids = [self._ids[row] for row in kept_rows]
+        self._payloads = [self._payloads[row] for row in kept_rows]
+        if self._vectors is not None:
+            self._vectors = self._vectors[kept_rows]
+        if self._scales is not None:
+            self._scales = self._scales[kept_rows]
+
+    def search(self, queries: np.ndarray, count: int) -> List[List[SearchHit]]:
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if len(self._ids) < 1 or count < 1:
+            return [[] for _ in range(len(queries))]
+
+        similarities = np.concatenate([
+            self._similarities(queries, slice(start, start + self._BLOCK_ROWS))
+            for start in range(0, len(self._ids), self._BLOCK_ROWS)
+        ], axis=1)
+
+        return [self._top_hits(query_similarities, np.arange(len(self._ids)), count) for query_similarities in similarities]
+
+    def get_vectors(self, ids: List[str]) -> np.ndarray:
+        rows_by_id = {vector_id: row for row, vector_id in enumerate(self._ids)}
+        return self._dequantized_rows(np.array([rows_by_id[vector_id] for vector_id in ids], dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def flush(self) -> None:
+        if not self._file_path:
+            return
+
+        os.makedirs(os.path.dirname(self._file_path), exist_ok=True)
+
+        temp_file_path = self._file_path + ".tmp"
+        with open(temp_file_path, 'wb') as file:
+            np.savez(file, **self._state())
+        os.replace(temp_file_path, self._file_path)  # Readers never see a partially written index
+
+    def _similarities(self, queries: np.ndarray, rows: Union[np.ndarray, slice]) -> np.ndarray:
+        """
+        :return: Matrix of similarities, a row per query and a column per index row
+        """
+        vectors = self._vectors[rows].astype(np.float32, copy=False)  # Dequantize only a block at a time
+        similarities = queries @ vectors.T
+        if self._scales is not None:
+            similarities *= self._scales[rows]
+
+        return similarities
+
+    def _dequantized_rows(self, rows: np.ndarray) -> np.ndarray:
+        vectors = self._vectors[rows].astype(np.float32)
+        if self._scales is not None:
+            vectors *= self._scales[rows, np.newaxis]
+
+        return vectors
+
+    def _top_hits(self, similarities: np.ndarray, rows: np.ndarray, count: int) -> List[SearchHit]:
+        if len(rows) > count:
+            top_ixs = np.argpartition(-similarities, count - 1)[:count]
+        else:
+            top_ixs = np.arange(len(rows))
+        top_ixs = top_ixs[np.argsort(-similarities[top_ixs], kind='stable')]
+
+        return [SearchHit(self._ids[rows[ix]], self._payloads[rows[ix]], float(similarities[ix])) for ix in top_ixs]
+
+    def _state(self) -> Dict[str, Any]:
+        state = {
+            "ids": np.array(self._ids, dtype=np.str_),
+            "payloads": np.array(json.dumps(self._payloads)),
+            "metadata": np.array(json.dumps(self.metadata)),
+            "quantization": np.array(self._quantization or ""),
+        }
+        if self._vectors is not None:
+            state["vectors"] = self._vectors
+        if self._scales is not None:
+            state["scales"] = self._scales
+
+        return state
+
+    def _load(self) -> None:
+        with np.load(self._file_path, allow_pickle=False) as state:
+            if str(state["quantization"]) != (self._quantization or ""):
+                log.debug(f"Vector index '{self._file_path}' is quantized differently, it is rebuilt")
+                return
+
+            self._load_state(state)
+
+    def _load_state(self, state: Any) -> None:
+        self._ids = [str(vector_id) for vector_id in state["ids"]]
+        self._payloads = json.loads(str(state["payloads"]))
+        self.metadata = json.loads(str(state["metadata"]))
+        self._vectors = state["vectors"] if "vectors" in state else None
+        self._scales = state["scales"] if "scales" in state else None
+
+
+class IvfVectorIndex(ExactVectorIndex):
+    """
+    Approximate search over an inverted file index: vectors are clustered around 'n_lists' centroids (k-means), and a
+    query is only compared to the vectors of its 'n_probe' nearest clusters. Until the index has 'min_train_size'
+    vectors, it is searched exhaustively. Clusters are recomputed when the index doubles in size. Concurrent searches
+    share one training, and see either the previous or the new clusters complete.
+    """
+    _n_lists: Optional[int]
+    _n_probe: int
+    _min_train_size: int
+
+    _centroids: Optional[np.ndarray]
+    _assignments: Optional[np.ndarray]
+    _trained_size: int
+    _list_rows: Optional[List[np.ndarray]]
+    _lock: threading.Lock
+
+    def __init__(self, file_path: Optional[str] = None, quantization: Optional[str] = None, n_lists: Optional[int] = None,
+                 n_probe: int = 8, min_train_size: int = 1000) -> None:
+        """
+        :param file_path: Where the index is persisted, None keeps it in memory only
+        :param quantization: None (float32), 'float16' or 'int8'
+        :param n_lists: Number of clusters, defaults to the square root of the index size
+        :param n_probe: Number of clusters searched per query
+        :param min_train_size: Minimum number of vectors to cluster, smaller indexes are searched exhaustively
+        """
+        self._n_lists = n_lists
+        self._n_probe = n_probe
+        self._min_train_size = min_train_size
+
+        self._centroids = None
+        self._assignments = None
+        self._trained_size = 0
+        self._list_rows = None
+        self._lock = threading.Lock()
+
+        super().__init__(file_path, quantization)
+
+    def add(self, ids: List[str], vectors: np.ndarray, payloads: List[Dict[str, str]]) -> None:
+        with self._lock:
+            super().add(ids, vectors, payloads)
+
+            if self._centroids is not None and len(ids) > 0:
+                self._assignments = np.concatenate([self._assignments, self._assign(np.asarray(vectors, dtype=np.float32), self._centroids)])
+                self._list_rows = None
+
+    def remove(self, ids: List[str]) -> None:
+        with self._lock:
+            if self._assignments is not None:
+                removed_ids = set(ids)
+                self._assignments = self._assignments[[vector_id not in removed_ids for vector_id in self._ids]]
+                self._list_rows = None
+
+            super().remove(ids)
+
+    def search(self, queries: np.ndarray, count: int) -> List[List[SearchHit]]:
+        centroids, list_rows = self._trained_lists()
+        if centroids is None:
+            return super().search(queries, count)
+
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if count < 1:
+            return [[] for _ in range(len(queries))]
+
+        n_probe = min(self._n_probe, len(centroids))
+        probed_lists = np.argpartition(-(queries @ centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+        # Every list is scored once, against all queries probing it
+        candidate_rows: List[List[np.ndarray]] = [[] for _ in queries]
+        candidate_similarities: List[List[np.ndarray]] = [[] for _ in queries]
+        for list_ix in np.unique(probed_lists):
+            rows = list_rows[list_ix]
+            if len(rows) < 1:
+                continue
+
+            query_ixs = np.nonzero((probed_lists == list_ix).any(axis=1))[0]
+            for query_ix, similarities in zip(query_ixs, self._similarities(queries[query_ixs], rows)):
+                candidate_rows[query_ix].append(rows)
+                candidate_similarities[query_ix].append(similarities)
+
+        return [
+            self._top_hits(np.concatenate(similarities), np.concatenate(rows), count) if len(rows) > 0 else []
+            for rows, similarities in zip(candidate_rows, candidate_similarities)
+        ]
+
+    def _trained_lists(self) -> Tuple[Optional[np.ndarray], Optional[List[np.ndarray]]]:
+        """
+        :return: Centroids and rows of each inverted list, trained or rebuilt first if needed. None while the index is
+            searched exhaustively
+        """
+        with self._lock:
+            self._train_if_needed()
+            if self._centroids is None:
+                return None, None
+
+            if self._list_rows is None:
+                order = np.argsort(self._assignments, kind='stable')
+                boundaries = np.searchsorted(self._assignments[order], np.arange(len(self._centroids) + 1))
+                self._list_rows = [order[boundaries[ix]:boundaries[ix + 1]] for ix in range(len(self._centroids))]
+
+            return self._centroids, self._list_rows
+
+    def _train_if_needed(self) -> None:
+        size = len(self._ids)
+        if size < self._min_train_size or (self._centroids is not None and size < 2 * self._trained_size):
+            return
+
+        n_lists = max(1, min(self._n_lists or int(np.sqrt(size)), size))
+        log.debug(f"Clustering {size:,} vectors into {n_lists:,} lists...")
+
+        # k-means on a sample is enough to place the centroids, all vectors are assigned afterwards
+        rng = np.random.default_rng(0)
+        sample_rows = rng.choice(size, min(size, 64 * n_lists), replace=False)
+        sample = self._vectors[sample_rows].astype(np.float32)
+        if self._scales is not None:
+            sample *= self._scales[sample_rows, np.newaxis]
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(10):
+            sample_assignments = np.argmax(sample @ centroids.T, axis=1)
+            for list_ix in range(n_lists):
+                members = sample[sample_assignments == list_ix]
+                if len(members) > 0:
+                    centroids[list_ix] = members.mean(axis=0)
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        assignments = np.concatenate([
+            self._assign(self._dequantized_rows(np.arange(start, min(start + self._BLOCK_ROWS, size))), centroids)
+            for start in range(0, size, self._BLOCK_ROWS)
+        ])
+
+        self._centroids, self._assignments, self._trained_size, self._list_rows = centroids, assignments, size, None
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+    def _state(self) -> Dict[str, Any]:
+        with self._lock:
+            state = super()._state()
+            if self._centroids is not None:
+                state["centroids"] = self._centroids
+                state["assignments"] = self._assignments
+                state["trained_size"] = np.array(self._trained_size)
+
+        return state
+
+    def _load_state(self, state: Any) -> None:
+        super()._load_state(state)
+        if "centroids" in state:
+            self._centroids = state["centroids"]
+            self._assignments = state["assignments"]
+            self._trained_size = int(state["trained_size"])
+
+
+class ChromaVectorIndex(VectorIndex):
+    """
+    Vectors kept in a chromadb collection (HNSW index)
+    """
+    _client: Any
+    _collection: Any
+
+    def __init__(self, directory: Optional[str], name: str) -> None:
+        """
+        :param directory: Where chromadb persists its data, None keeps the collection in memory only
+        :param name: Name of the collection
+        """
+        super().__init__()
+
+        import chromadb
+
+        self._client = chromadb.PersistentClient(path=directory) if directory else chromadb.Client()
+        self._collection = self._client.get_or_create_collection(
+            name=name,
+            embedding_function=None,  # Embeddings are always passed explicitly
+        )
+        self.metadata = dict(self._collection.metadata or {})
+
+    def ids(self) -> List[str]:
+        return self._collection.get(include=[])["ids"]
+
+    def add(self, ids: List[str], vectors: np.ndarray, payloads: List[Dict[str, str]]) -> None:
+        if len(ids) < 1:
+            return
+
+        self._collection.upsert(
+            ids=ids,
+            embeddings=np.asarray(vectors, dtype=np.float32).tolist(),
+            documents=[payload["source"] for payload in payloads],
+            metadatas=[{key: value for key, value in payload.items() if key != "source"} for payload in payloads],
+        )
+
+    def remove(self, ids: List[str]) -> None:
+        if len(ids) > 0:
+            self._collection.delete(ids=ids)
+
+    def search(self, queries: np.ndarray, count: int) -> List[List[SearchHit]]:
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        count = min(count, len(self))
+        if count < 1:
+            return [[] for _ in range(len(queries))]
+
+        results = self._collection.query(query_embeddings=queries.tolist(), n_results=count)
+
+        return [
+            [
+                # Squared L2 distance of normalized vectors is 2 - 2 * cosine similarity
+                SearchHit(vector_id, {"source": document, **metadata}, 1.0 - distance / 2.0)
+                for vector_id, document, metadata, distance in zip(ids, documents, metadatas, distances)
+            ]
+            for ids, documents, metadatas, distances in
+            zip(results["ids"], results["documents"], results["metadatas"], results["distances"])
+        ]
+
+    def get_vectors(self, ids: List[str]) -> np.ndarray:
+        if len(ids) < 1:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        result = self._collection.get(ids=ids, include=["embeddings"])
+        vectors_by_id = dict(zip(result["ids"], result["embeddings"]))
+
+        return np.array([vectors_by_id[vector_id] for vector_id in ids], dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self._collection.count()
+
+    def flush(self) -> None:
+        if self.metadata != (self._collection.metadata or {}):
+            self._collection.modify(metadata=self.metadata)
+
+    @property
+    def max_batch_size(self) -> Optional[int]:
+        return self._client.get_max_batch_size()
+
+
+def open_vector_index(config: Dict, directory: Optional[str], name: str) -> VectorIndex:
+    """
+    Open (or create) a vector index
+    :param config: Index configuration: 'type' ('chromadb', 'exact' or 'ivf'), 'quantization' ('float16' or 'int8'),
+                   'n_lists', 'n_probe'
+    :param directory: Where the index is persisted, None keeps it in memory only
+    :param name: Name of the index, unique in the directory
+    :return: Index
+    """
+    index_type = config.get("type") or "chromadb"
+    quantization = config.get("quantization")
+
+    if index_type == "chromadb":
+        return ChromaVectorIndex(directory, name)
+
+    file_path = os.path.join(directory, f"{name}-{index_type}-{quantization or 'float32'}.npz") if directory else None
+    if index_type == "exact":
+        return ExactVectorIndex(file_path, quantization)
+    if index_type == "ivf":
+        return IvfVectorIndex(file_path, quantization, config.get("n_lists"), config.get("n_probe") or 8)
+
+    raise RuntimeError(f"Unknown vector index type '{index_type}', it should be 'chromadb', 'exact' or 'ivf'")
+
+
+def _quantize(vectors: np.ndarray, quantization: Optional[str]) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    if quantization == "float16":
+        return vectors.astype(np.float16), None
+
+    if quantization == "int8":
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+        return np.round(vectors / scales[:, np.newaxis]).astype(np.int8), scales.astype(np.float32)
+
+    return vectors, None